@@ -28,314 +28,242 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import time
+
+# Reference of the --startup-report timings, taken before importing the other modules.
+STARTED = time.perf_counter()
+
 import argparse
+from etsm_engine import LineBuffer, TERMINATORS
+from etsm_index import TraceIndex
+from etsm_capture import FLAG_CONDITION, FLAG_EVENT, FLAG_MATCH, write_capture
+from etsm_port import (DEFAULT_PORT, Port, PortGroup, add_port_arguments, find_available_ports, open_capture,
+                       open_detection_pool, open_event_bus, open_metrics_server, open_trace_log)
+from etsm_scheduler import CommandScheduler
+from etsm_scrollback import FLAG_DETECTED, FLAG_MARKER, LineFilter, LineStore
+from collections import OrderedDict, deque
+from etsm_stats import StartupTimer, export_latency, format_duration, format_interval, format_timestamp
+import bisect
+import html
 import os
-from pyqtgraph.Qt import QtGui, QtCore, QtWidgets
-import serial
-from serial.tools import list_ports
+import re
 import signal
 import sys
-import time
+import threading
+import zlib
 
+if __name__ == '__main__' and '--headless' in sys.argv[1:]:
+    # The headless mode must not import Qt at all.
+    import etsm_headless
+    sys.exit(etsm_headless.main(sys.argv[1:]))
 
-def find_available_ports():
-    """
-    Detect, parse and store all the ports detected/connected to the PC.
-    :return: array containing all the ports
-    """
-    ports = []
-    raw_ports = list(list_ports.comports())
-    for p in raw_ports:
-        ports.append(p[0])
-    return ports
+from PyQt5 import QtCore, QtGui, QtWidgets
+import serial
 
 
-class Port(QtCore.QObject):
-    """
-    Class emulating the communication with a given port.
-    """
-    sig_display_port = QtCore.pyqtSignal(str, int)
-    sig_clean_command_area = QtCore.pyqtSignal()
-    sig_pattern_detected = QtCore.pyqtSignal(str)
-
-    def __init__(self, port_name, baudrate, pattern, command):
-        super(Port, self).__init__()
-        self._port = None
-        self._port_name = port_name
-        self._baudrate = str(baudrate)
-        self._pattern = pattern
-        self._command = command
-        self._conditions = {}
-        self.exit = False
+# Background of the matched parts of the lines: patterns, then one colour per condition.
+HIGHLIGHT_COLOURS = ('#ffff00', '#a6f0a6', '#a6d8ff', '#ffc080', '#ffb0d8', '#b0f0f0', '#d8c0ff', '#e0e0a0')
 
-        self.open_port()
 
-    def run(self):
-        """
-        Collects every lines sent trought the port, check if the line matches
-        with entered pattern and/or condition and send a event to displays the line.
-        """
-        while not self.exit:
-            try:
-                line = self._port.readline().decode("utf-8")
-            except (serial.SerialException, TypeError) as e:
-                pass
-            if line != "":
-                if self._pattern or self._conditions:
-                    ret = self.detect(line)
-                    self.sig_display_port.emit(line, ret)
-                else:
-                    self.sig_display_port.emit(line, 0)
-
-    def stop(self):
-        self.exit = True
-
-    def detect(self, line):
-        """
-        Check if the line is matches with a pattern/condition and send
-        the corresponding event.
-        :param line: the line to process
-        :return: True if the line matches with pattern/condition, else False.
-        """
-        res = False
-        for pat in self._pattern:
-            if pat in line:
-                res = True
-        for cond in self._conditions.values():
-            if cond[0] in line:
-                res = True
-                if cond[2] == 'Event':
-                    self.sig_pattern_detected.emit(cond[1])
-                else:
-                    self.send_command(cond[1])
-        return res
-
-    def open_port(self):
-        """
-        Open the port with specified name and baudrate.
-        """
-        try:
-            self._port = serial.Serial(self._port_name, self._baudrate, timeout=1)
-        except serial.SerialException:
-            print("Can't open port " + self._port_name + ".")
-            sys.exit()
+def condition_colour(cond_id):
+    """
+    Gets the highlight colour of a condition.
+    :param cond_id: ID of the condition.
+    :return: Index in HIGHLIGHT_COLOURS.
+    """
+    if not isinstance(cond_id, int):
+        cond_id = zlib.crc32(str(cond_id).encode('utf-8'))
+    return 1 + (cond_id - 1) % (len(HIGHLIGHT_COLOURS) - 1)
 
-    def close_port(self):
-        self._port.close()
 
-    def send_command(self, command):
-        """
-        Send the command to the current port.
-        :param command: The command to send.
-        """
-        self._port.write((command+"\r").encode())
+def match_spans(matches):
+    """
+    Converts the matches reported by Port.detect() into highlighted spans.
+    :param matches: List of (key, start, end).
+    :return: Tuple of (start, end, colour index), the parts matching a condition after the patterns.
+    """
+    spans = []
+    for key, start, end in matches:
+        if key[0] == 'pattern':
+            spans.append((start, end, 0))
+        elif key[0] != 'rearm' and end > start:
+            spans.append((start, end, condition_colour(key[1])))
+    spans.sort(key=lambda span: span[2] != 0)
+    return tuple(spans)
 
-    def send_script(self, script, file=False):
-        """
-        Send a script or a set of command to the current port.
-        Parse it and send each command.
-        :param script: File or set of command to send.
-        :param file: True if the script is a file to read, else False.
-        """
-        '''open the script or group of command and send each command, if delay put in sleep'''
-        if file:
-            try:
-                with open(script, mode='r') as f:
-                    command_lines = f.readlines()
-                    for command in command_lines:
-                        if command.split(' ')[0] == 'delay':
-                            time.sleep(int(command.split(' ')[1]))
-                        else:
-                            self.send_command(command)
-            except IOError:
-                print("Can't read script " + script + ".")
-        else:
-            for command in script:
-                if command.split(' ')[0] == 'delay':
-                    time.sleep(int(command.split(' ')[1]))
-                else:
-                    self.send_command(command)
 
-    def command_manager(self, text):
-        """
-        Get the command entered by the user, if a script name is detected
-        calls the function that handles script, else send the single command.
-        :param text: The string entered by the user, can be a command, or a file/script.
-        """
-        if text:
-            if len(text.split('.')) > 1:
-                if text.split('.')[1] == ('txt' or 'sh'):
-                    self.send_script(text, file=True)
-                else:
-                    print('bad extension')
+def highlight_html(line, spans):
+    """
+    Renders a line with its highlighted spans as html, a later span overrides an earlier one.
+    :param line: The line to render.
+    :param spans: Tuple of (start, end, colour index).
+    :return: The html fragment.
+    """
+    colours = [None] * len(line)
+    for start, end, colour in spans:
+        colours[start:end] = [colour] * len(colours[start:end])
+    parts = []
+    start = 0
+    for end in range(1, len(line) + 1):
+        if end == len(line) or colours[end] != colours[start]:
+            text = html.escape(line[start:end])
+            if colours[start] is None:
+                parts.append(text)
             else:
-                self.send_command(text)
-            self.sig_clean_command_area.emit()
+                parts.append(f"<span style='background-color: {HIGHLIGHT_COLOURS[colours[start]]};'>{text}</span>")
+            start = end
+    return "".join(parts)
 
-    def pattern_manager(self, text):
-        """
-        Add the pattern entered by the user to the existing pattern array.
-        :param text: The new pattern to detect
-        """
-        if text:
-            if text not in self._pattern:
-                self._pattern.append(text)
-
-    def change_baudrate(self, new_baudrate):
-        """
-        Update the baudrate of the current port.
-        :param new_baudrate: Baudrate requested by the user.
-        :return: 1 if new baudrate is updated, 0 if no update.
-        """
-        if new_baudrate != self._baudrate:
-            self._baudrate = new_baudrate
-            self._port.baudrate = self._baudrate
-            return 1
-        else:
-            return 0
-
-    def change_port(self, new_port_name):
-        """
-        Update the current port.
-        :param new_port_name: New port name requested by the user.
-        :return: 1 if new port is updated, 0 if no update.
-        """
-        if new_port_name != self._port_name:
-            self._port_name = new_port_name
-            self._port.port = self._port_name
-            return 1
-        else:
-            return 0
-
-    def save_traces(self, filename, traces):
-        """
-        Saves all the traces (within the console area ) of the current port in a file.
-        :param filename: The file where to save the traces.
-        :param traces: The traces to save.
-        """
-        with open(filename, 'w') as f:
-            f.write(traces)
-
-    def get_pattern(self):
-        """
-        Gets the patterns of the current port outside the class.
-        :return: the patterns of the current port to detect.
-        """
-        return self._pattern
-
-    def set_pattern(self, pattern):
-        """
-        Erases and updates the patterns to detect outside the class.
-        :param pattern: The new patterns to detect.
-        """
-        self._pattern = pattern
-
-    def add_pattern(self, pattern):
-        """
-        Adds a new pattern to detect outside the class.
-        :param pattern: The pattern to add.
-        """
-        self._pattern.append(pattern)
-
-    def del_pattern(self):
-        """
-        Deletes the patterns to detect.
-        """
-        self._pattern = []
-
-    def get_command(self):
-        """
-        Gets the command to send of the current port outside the class.
-        :return:
-        """
-        return self._command
 
-    def set_command(self, command):
-        """
-        Erases and updates the commands to send outside the class.
-        :param command: Commands to send.
-        """
-        self._command = command
-
-    def add_command(self, command):
-        """
-        Adds a new command to send outside the class.
-        :param command: The command to send.
-        """
-        self._command.append(command)
-
-    def del_command(self):
-        """
-        Deletes all the commands to send.
-        """
-        self._command = []
-
-    def get_port_name(self):
-        """
-        Gets the current port's name outside the class.
-        :return: The name of the port.
-        """
-        return self._port_name
-
-    def set_port_name(self, port_name):
-        """
-        Updates the name of the current port outside the class.
-        :param port_name: The new name of the port.
-        """
-        self._port_name = port_name
-
-    def get_port(self):
-        """
-        Gets the instance of the current port outside the class.
-        :return: Port instance.
-        """
-        return self._port
-
-    def get_baudrate(self):
-        """
-        Gets the baudrate of the current port outside the class.
-        :return: Port baudrate.
-        """
-        return self._baudrate
-
-    def add_condition(self, cond_id, pattern, action, type):
-        """
-        Adds new condition for the current port.
-        :param cond_id: ID number of the condition.
-        :param pattern: Pattern of the condition to detect.
-        :param action: Name of the action to trigger.
-        :param type: Type of the action to trigger, command or event.
-        """
-        self._conditions[cond_id] = [pattern, action, type]
-
-    def get_condition(self):
-        """
-        Gets all the conditions for the current port outside the class.
-        :return: Dict of all conditions.
-        """
-        return self._conditions
-
-    def get_specific_condition(self, cond_id):
-        """
-        Gets a specific condition for the current port outside the class.
-        :param cond_id: ID number of the condition.
-        :return: Specific condition.
-        """
-        return self._conditions.get(cond_id)
+class ConditionLimits(QtWidgets.QDialog):
+    """
+    Dialog editing how often a condition can fire.
+    """
 
-    def del_condition(self):
-        """
-        Deletes all the conditions of the current port.
-        """
-        self._conditions = {}
+    def __init__(self, limit=None, counters=None, parent=None):
+        super().__init__(parent)
+        limit = limit or {}
+        self.rearm_requested = False
+        self.setWindowTitle("Condition limits")
+        layout = QtWidgets.QFormLayout(self)
+        self.debounce_spin = QtWidgets.QSpinBox()
+        self.cooldown_spin = QtWidgets.QSpinBox()
+        self.rate_spin = QtWidgets.QDoubleSpinBox()
+        self.burst_spin = QtWidgets.QSpinBox()
+        self.once_check = QtWidgets.QCheckBox("Fire once until rearmed")
+        self.rearm_edit = QtWidgets.QLineEdit()
+        for spin in (self.debounce_spin, self.cooldown_spin):
+            spin.setRange(0, 86400000)
+            spin.setSuffix(" ms")
+            spin.setSpecialValueText("None")
+        self.debounce_spin.setToolTip("Ignore the triggers closer than this to the previous one, fired or not")
+        self.cooldown_spin.setToolTip("Ignore the triggers closer than this to the last fired one")
+        self.rate_spin.setRange(0, 100000)
+        self.rate_spin.setSuffix(" /s")
+        self.rate_spin.setSpecialValueText("No limit")
+        self.rate_spin.setToolTip("Average number of triggers per second")
+        self.burst_spin.setRange(1, 100000)
+        self.burst_spin.setToolTip("Number of triggers allowed at once")
+        self.rearm_edit.setPlaceholderText("Rearm pattern ...")
+        self.rearm_edit.setToolTip("A line matching this pattern rearms the condition")
+        self.debounce_spin.setValue(limit.get('debounce', 0))
+        self.cooldown_spin.setValue(limit.get('cooldown', 0))
+        self.rate_spin.setValue(limit.get('rate', 0))
+        self.burst_spin.setValue(limit.get('burst', 1))
+        self.once_check.setChecked(bool(limit.get('once')))
+        self.rearm_edit.setText(limit.get('rearm') or '')
+        layout.addRow("Debounce", self.debounce_spin)
+        layout.addRow("Cooldown", self.cooldown_spin)
+        layout.addRow("Rate", self.rate_spin)
+        layout.addRow("Burst", self.burst_spin)
+        layout.addRow(self.once_check)
+        layout.addRow("Rearm on", self.rearm_edit)
+        if counters:
+            suppressed = ", ".join(reason + " " + str(n) for reason, n in counters['suppressed'].items() if n)
+            layout.addRow("Fired", QtWidgets.QLabel(str(counters['fired'])))
+            layout.addRow("Suppressed", QtWidgets.QLabel(suppressed or "0"))
+            if not counters['armed']:
+                but_rearm = QtWidgets.QPushButton("Rearm now")
+                but_rearm.clicked.connect(self.rearm)
+                layout.addRow("Disarmed", but_rearm)
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def rearm(self):
+        self.rearm_requested = True
+        self.sender().setEnabled(False)
+
+    def get_limit(self):
+        """
+        Gets the limits entered by the user.
+        :return: Dict of the limits, None if the condition is not limited.
+        """
+        limit = {'debounce': self.debounce_spin.value(), 'cooldown': self.cooldown_spin.value(),
+                 'rate': self.rate_spin.value(), 'once': self.once_check.isChecked(),
+                 'rearm': self.rearm_edit.displayText()}
+        if limit['rate']:
+            limit['burst'] = self.burst_spin.value()
+        return dict((key, value) for key, value in limit.items() if value) or None
+
+
+class StatsPanel(QtWidgets.QDialog):
+    """
+    Live counters of a port and of its patterns and conditions, refreshed every second while shown.
+    """
+    COLUMNS = ("Type", "Rule", "Hits", "Hits/s", "Last match", "Last line")
 
-    def del_specific_condition(self, cond_id):
-        """
-        Deletes a specific condition of the condition port.
-        :param cond_id: ID number of the condition.
-        """
-        if cond_id in self._conditions:
-            del self._conditions[cond_id]
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.port = None
+        self.setWindowTitle("Statistics")
+        self.resize(900, 400)
+        layout = QtWidgets.QVBoxLayout(self)
+        self.port_label = QtWidgets.QLabel()
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.port_label)
+        layout.addWidget(self.table)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+
+    def set_port(self, port):
+        """
+        Shows the counters of another port.
+        :param port: The Port to show.
+        """
+        self.port = port
+        self.refresh()
+
+    def showEvent(self, event):
+        self.timer.start()
+        self.refresh()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        """
+        Updates the counters shown.
+        """
+        if self.port is None or not self.isVisible():
+            return
+        summary = self.port.get_stats().summary()
+        self.setWindowTitle("Statistics - " + self.port.get_port_name())
+        self.port_label.setText("Lines %d (%.1f/s) ; Bytes %d (%.1f/s) ; Decode errors %d ; "
+                                "Written %d commands, %d bytes in %d writes ; Pending %d bytes"
+                                % (summary['lines'], summary['lines_per_s'], summary['bytes'], summary['bytes_per_s'],
+                                   summary['decode_errors'], summary['written_commands'], summary['written_bytes'],
+                                   summary['write_calls'], summary['pending_bytes']))
+        resize = self.table.rowCount() != len(summary['rules'])
+        self.table.setRowCount(len(summary['rules']))
+        for row, rule in enumerate(summary['rules']):
+            name = rule['rule']
+            if rule['type'] == 'condition':
+                cond = self.port.get_specific_condition(rule['id'])
+                if cond is not None:
+                    name = "#" + name + " " + cond[0]
+            last_match = rule['last_match']
+            if last_match is not None:
+                last_match = time.strftime("%H:%M:%S", time.localtime(last_match)) + ".%03d" % (last_match % 1 * 1000)
+            values = (rule['type'].capitalize(), name, str(rule['hits']), "%.1f" % rule['hits_per_s'],
+                      last_match or "", rule['last_line'] or "")
+            for column, value in enumerate(values):
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QtWidgets.QTableWidgetItem(value))
+                elif item.text() != value:
+                    item.setText(value)
+        if resize:
+            for column in range(len(self.COLUMNS) - 1):
+                self.table.resizeColumnToContents(column)
 
 
 class Conditions(QtWidgets.QHBoxLayout):
@@ -343,9 +271,12 @@ class Conditions(QtWidgets.QHBoxLayout):
     Class representing a condition.
     """
     sig_remove_condition = QtCore.pyqtSignal(int)
-    sig_save_condition = QtCore.pyqtSignal(int, str, str, str)
+    sig_save_condition = QtCore.pyqtSignal(int, str, str, str, str, bool, object, object)
+    sig_rearm_condition = QtCore.pyqtSignal(int)
+    label_same_port = "This port"
+    rule_kinds = ("Line", "Sequence", "Count")
 
-    def __init__(self, num):
+    def __init__(self, num, ports=()):
         super().__init__()
         self.condition_number = num
         self.pattern_edit = QtWidgets.QLineEdit()
@@ -354,26 +285,65 @@ class Conditions(QtWidgets.QHBoxLayout):
         self.action_edit = QtWidgets.QLineEdit()
         self.but_condition_type = QtWidgets.QPushButton("Type")
         self.but_condition_type_menu = QtWidgets.QMenu()
+        self.target_combo = QtWidgets.QComboBox()
+        self.regex_check = QtWidgets.QCheckBox("Regex")
+        self.rule_combo = QtWidgets.QComboBox()
+        self.then_edit = QtWidgets.QLineEdit()
+        self.count_spin = QtWidgets.QSpinBox()
+        self.window_spin = QtWidgets.QSpinBox()
+        self.but_limits = QtWidgets.QPushButton("Limits")
         self.but_condition_remove = QtWidgets.QPushButton("X")
+        self.limit = None
+        self.counters = None
 
-        self.pattern_edit.setToolTip("Pattern ...")
+        self.pattern_edit.setToolTip("Pattern ...\nThe matched text is highlighted with this colour")
         self.pattern_edit.setPlaceholderText("Pattern ...")
+        self.pattern_edit.setStyleSheet("background-color: " + HIGHLIGHT_COLOURS[condition_colour(num)] + ";")
         self.resized_arrow_icon = self.arrow_icon.scaled(30, 30, QtCore.Qt.KeepAspectRatio)
         self.arrow_icon_label.setPixmap(self.resized_arrow_icon)
-        self.action_edit.setToolTip("Command or event ...")
+        self.action_edit.setToolTip("Command or event ...\nWith a regex, \\1 or \\g<name> is replaced by the captured group")
         self.action_edit.setPlaceholderText("Command or event ...")
         self.but_condition_type_menu.addAction("Command")
         self.but_condition_type_menu.addAction("Event")
-        self.but_condition_type_menu.triggered[QtGui.QAction].connect(self.condition_type_selection)
+        self.but_condition_type_menu.triggered[QtWidgets.QAction].connect(self.condition_type_selection)
         self.but_condition_type.setMenu(self.but_condition_type_menu)
         self.but_condition_type.setFixedSize(90, 25)
+        self.target_combo.setToolTip("Port receiving the command")
+        self.target_combo.addItem(self.label_same_port)
+        self.target_combo.addItems(list(ports))
         self.but_condition_remove.setFixedSize(25, 25)
         self.but_condition_remove.clicked.connect(self.remove_condition)
 
+        self.regex_check.setToolTip("The pattern is a regular expression")
+        self.rule_combo.addItems(self.rule_kinds)
+        self.rule_combo.setToolTip("Line: fire on each matching line\n"
+                                   "Sequence: fire when the pattern is followed by the next ones\n"
+                                   "Count: fire when the pattern is seen several times")
+        self.rule_combo.currentIndexChanged.connect(self.rule_kind_selection)
+        self.then_edit.setToolTip("Next patterns of the sequence, separated by ;")
+        self.then_edit.setPlaceholderText("Then ... ; ...")
+        self.count_spin.setRange(2, 1000000)
+        self.count_spin.setPrefix("x ")
+        self.count_spin.setToolTip("Number of occurrences")
+        self.window_spin.setRange(0, 86400000)
+        self.window_spin.setSuffix(" ms")
+        self.window_spin.setSpecialValueText("No limit")
+        self.window_spin.setToolTip("Time window of the sequence or of the occurrences")
+        self.rule_kind_selection(0)
+        self.but_limits.setToolTip("Debounce, cooldown, rate limit or fire once")
+        self.but_limits.clicked.connect(self.edit_limits)
+
         self.addWidget(self.pattern_edit)
+        self.addWidget(self.regex_check)
+        self.addWidget(self.rule_combo)
+        self.addWidget(self.then_edit)
+        self.addWidget(self.count_spin)
+        self.addWidget(self.window_spin)
         self.addWidget(self.arrow_icon_label)
         self.addWidget(self.action_edit)
         self.addWidget(self.but_condition_type)
+        self.addWidget(self.target_combo)
+        self.addWidget(self.but_limits)
         self.addWidget(self.but_condition_remove)
 
     def condition_type_selection(self, action):
@@ -383,10 +353,50 @@ class Conditions(QtWidgets.QHBoxLayout):
         """
         self.but_condition_type.setText(action.text())
 
+    def rule_kind_selection(self, index):
+        """
+        Shows the settings of the selected kind of rule.
+        :param index: Index of the kind in rule_kinds.
+        """
+        self.then_edit.setVisible(index == 1)
+        self.count_spin.setVisible(index == 2)
+        self.window_spin.setVisible(index != 0)
+
+    def edit_limits(self):
+        """
+        Opens the dialog editing the limits of the condition.
+        """
+        dialog = ConditionLimits(self.limit, self.counters, self.but_limits.window())
+        if dialog.exec_() == QtWidgets.QDialog.Accepted:
+            self.set_limit(dialog.get_limit(), self.counters)
+        if dialog.rearm_requested:
+            self.sig_rearm_condition.emit(self.condition_number)
+
+    def set_limit(self, limit, counters=None):
+        """
+        Sets the limits of the condition and shows its suppressed triggers.
+        :param limit: Dict of the limits, None if the condition is not limited.
+        :param counters: Fired and suppressed triggers, as returned by Port.get_trigger_counters().
+        """
+        self.limit = limit
+        self.counters = counters
+        text = "Limits"
+        if limit:
+            text += " *"
+        if counters and sum(counters['suppressed'].values()):
+            text += " (" + str(sum(counters['suppressed'].values())) + " suppressed)"
+        self.but_limits.setText(text)
+
     def remove_condition(self):
+        self.clear_widgets()
+        self.sig_remove_condition.emit(self.condition_number)
+
+    def clear_widgets(self):
+        """
+        Removes the widgets of the condition from the window.
+        """
         for i in reversed(range(self.count())):
             self.itemAt(i).widget().setParent(None)
-        self.sig_remove_condition.emit(self.condition_number)
 
     def clear_data(self):
         """
@@ -395,6 +405,43 @@ class Conditions(QtWidgets.QHBoxLayout):
         self.pattern_edit.clear()
         self.action_edit.clear()
         self.but_condition_type.setText("Type")
+        self.target_combo.setCurrentIndex(0)
+        self.regex_check.setChecked(False)
+        self.rule_combo.setCurrentIndex(0)
+        self.then_edit.clear()
+        self.count_spin.setValue(2)
+        self.window_spin.setValue(0)
+        self.set_limit(None)
+
+    def set_data(self, pattern, action, type, target=None, regex=False, rule=None, limit=None):
+        """
+        Fills the condition with saved data.
+        :param pattern: Pattern of the condition to detect.
+        :param action: Name of the action to trigger.
+        :param type: Type of the action, command or event.
+        :param target: Name of the port receiving the command, None for the current port.
+        :param regex: True if the pattern is a regular expression.
+        :param rule: None, ('sequence', (next patterns, ...), window ms) or ('count', count, window ms).
+        :param limit: None, or dict of the limits of the condition.
+        """
+        self.pattern_edit.setText(pattern)
+        self.set_limit(limit)
+        self.regex_check.setChecked(regex)
+        if rule is not None:
+            kind, arg, window = rule
+            if kind == 'sequence':
+                self.rule_combo.setCurrentIndex(1)
+                self.then_edit.setText(" ; ".join(arg))
+            else:
+                self.rule_combo.setCurrentIndex(2)
+                self.count_spin.setValue(arg)
+            self.window_spin.setValue(window)
+        self.action_edit.setText(action)
+        self.but_condition_type.setText(type)
+        if target is not None:
+            if self.target_combo.findText(target) < 0:
+                self.target_combo.addItem(target)
+            self.target_combo.setCurrentText(target)
 
     def save_data(self):
         """
@@ -403,22 +450,530 @@ class Conditions(QtWidgets.QHBoxLayout):
         pattern = self.pattern_edit.displayText()
         action = self.action_edit.displayText()
         type = self.but_condition_type.text()
+        target = self.target_combo.currentText()
+        if target == self.label_same_port:
+            target = ''
+        rule = None
+        if self.rule_combo.currentIndex() == 1:
+            steps = tuple(step.strip() for step in self.then_edit.displayText().split(';') if step.strip())
+            if steps:
+                rule = ('sequence', steps, self.window_spin.value())
+        elif self.rule_combo.currentIndex() == 2:
+            rule = ('count', self.count_spin.value(), self.window_spin.value())
         if pattern != '' and action != '' and type != 'Type':
-            self.sig_save_condition.emit(self.condition_number, pattern, action, type)
+            self.sig_save_condition.emit(self.condition_number, pattern, action, type, target,
+                                         self.regex_check.isChecked(), rule, self.limit)
         else:
             self.clear_data()
 
 
+class ConsoleView(QtWidgets.QAbstractScrollArea):
+    """
+    Read-only console rendering only the visible lines of a LineStore, or of a TraceIndex.
+    The view follows the end of the traces unless the user scrolled up or follow is False.
+    The matched parts of a line are highlighted with the colour of their pattern or condition,
+    a matched line without spans (history, trace file) is highlighted as a whole.
+    The lines can be prefixed with their receive time, the time since the previous line or
+    the time since the last matched line, see TIME_MODES.
+    """
+    TIME_MODES = ('none', 'absolute', 'delta', 'match')
+    TIME_WIDTH = 16
+
+    def __init__(self, store, parent=None, follow=True):
+        super().__init__(parent)
+        self._store = store
+        self._max_width = 0
+        self._current = None
+        self._colours = [QtGui.QColor(colour) for colour in HIGHLIGHT_COLOURS]
+        self._time_mode = 'none'
+        self.follow = follow
+        self.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.setContextMenuPolicy(QtCore.Qt.ActionsContextMenu)
+        self.copy_action = QtWidgets.QAction("Copy visible lines", self)
+        self.copy_action.triggered.connect(self.copy_visible_lines)
+        self.addAction(self.copy_action)
+        self.verticalScrollBar().valueChanged.connect(self.viewport().update)
+        self.horizontalScrollBar().valueChanged.connect(self.viewport().update)
+
+    def line_height(self):
+        return self.fontMetrics().lineSpacing()
+
+    def visible_rows(self):
+        """
+        Gets the number of lines fitting in the viewport.
+        :return: Number of visible lines.
+        """
+        return max(1, self.viewport().height() // self.line_height())
+
+    def refresh(self):
+        """
+        Updates the scroll range after lines have been added to the store.
+        """
+        bar = self.verticalScrollBar()
+        follow = self.follow and bar.value() >= bar.maximum()
+        rows = self.visible_rows()
+        bar.setPageStep(rows)
+        bar.setRange(0, max(0, len(self._store) - rows))
+        if follow:
+            bar.setValue(bar.maximum())
+        self.viewport().update()
+
+    def set_store(self, store):
+        """
+        Shows another store, as the lines matching a filter instead of the whole scrollback.
+        :param store: LineStore, TraceIndex or LineFilter.
+        """
+        if store is not self._store:
+            self._store = store
+            self._current = None
+            self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+            self.refresh()
+
+    def set_time_mode(self, mode):
+        """
+        Sets the timing information displayed before the lines.
+        :param mode: One of TIME_MODES.
+        """
+        if mode not in self.TIME_MODES:
+            raise ValueError("Unknown time mode " + str(mode) + ".")
+        self._time_mode = mode
+        self._max_width = 0
+        self.viewport().update()
+
+    def get_time_mode(self):
+        """
+        Gets the timing information displayed before the lines.
+        :return: One of TIME_MODES.
+        """
+        return self._time_mode
+
+    def time_prefixes(self, first, lines):
+        """
+        Formats the timing information of consecutive lines of the store.
+        :param first: Index of the first line.
+        :param lines: The (line, flags) starting at first.
+        :return: List of the prefixes, None if no time is displayed or the store has no timestamps.
+        """
+        mode = self._time_mode
+        if mode == 'none':
+            return None
+        times = self._store.get_times(max(0, first - 1), first + len(lines))
+        if times is None:
+            return None
+        previous = times.pop(0) if first > 0 and times else 0
+        prefixes = []
+        for row, received in enumerate(times):
+            prefix = ''
+            if received:
+                if mode == 'absolute':
+                    prefix = format_timestamp(received)
+                elif mode == 'delta':
+                    prefix = format_interval(received - previous) if previous else ''
+                else:
+                    last_match = self._store.last_match_time(first + row)
+                    prefix = format_interval(received - last_match) if last_match else ''
+                previous = received
+            prefixes.append(prefix.rjust(self.TIME_WIDTH - 1) + ' ')
+        return prefixes
+
+    def set_current(self, index):
+        """
+        Highlights a line and scrolls to it if it is not visible.
+        :param index: Index of the line in the store, None to remove the highlight.
+        """
+        self._current = index
+        if index is not None:
+            bar = self.verticalScrollBar()
+            rows = self.visible_rows()
+            if not bar.value() <= index < bar.value() + rows:
+                bar.setValue(max(0, index - rows // 3))
+        self.viewport().update()
+
+    def get_current(self):
+        """
+        Gets the highlighted line.
+        :return: Index of the line, None if no line is highlighted.
+        """
+        return self._current
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.refresh()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self.viewport())
+        width = self.viewport().width()
+        painter.fillRect(self.viewport().rect(), QtCore.Qt.white)
+        height = self.line_height()
+        ascent = self.fontMetrics().ascent()
+        x = 4 - self.horizontalScrollBar().value()
+        first = self.verticalScrollBar().value()
+        normal_font = self.font()
+        bold_font = QtGui.QFont(normal_font)
+        bold_font.setBold(True)
+        marker_font = QtGui.QFont(normal_font)
+        marker_font.setItalic(True)
+        y = 0
+        max_width = self._max_width
+        current = self._current
+        stop = first + self.visible_rows() + 1
+        all_spans = self._store.get_spans(first, stop)
+        colours = self._colours
+        lines = self._store.get_range(first, stop)
+        prefixes = self.time_prefixes(first, lines)
+        x_text = x
+        if prefixes is not None:
+            prefix_width = self.fontMetrics().horizontalAdvance('0' * (self.TIME_WIDTH - 1))
+            x_text = x + prefix_width + self.fontMetrics().horizontalAdvance('  ')
+        for row, (text, flags) in enumerate(lines):
+            if first + row == current:
+                painter.fillRect(0, y, width, height, QtGui.QColor(160, 200, 255))
+            if prefixes is not None:
+                painter.setFont(normal_font)
+                painter.setPen(QtCore.Qt.darkGray)
+                painter.drawText(QtCore.QRect(x, y, prefix_width, height), QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter,
+                                 prefixes[row].strip())
+            spans = all_spans.get(first + row)
+            if flags & FLAG_MARKER:
+                painter.setFont(marker_font)
+                painter.setPen(QtCore.Qt.gray)
+            elif spans:
+                painter.setFont(normal_font)
+                painter.setPen(QtCore.Qt.black)
+                metrics = painter.fontMetrics()
+                for start, end, colour in spans:
+                    left = metrics.horizontalAdvance(text[:start])
+                    painter.fillRect(x_text + left, y, metrics.horizontalAdvance(text[start:end]), height,
+                                     colours[colour])
+            elif flags & FLAG_DETECTED:
+                if first + row != current:
+                    painter.fillRect(0, y, width, height, colours[0])
+                painter.setFont(bold_font)
+                painter.setPen(QtCore.Qt.black)
+            else:
+                painter.setFont(normal_font)
+                painter.setPen(QtCore.Qt.black)
+            painter.drawText(x_text, y + ascent, text)
+            max_width = max(max_width, x_text - x + painter.fontMetrics().horizontalAdvance(text) + 8)
+            y += height
+        painter.end()
+        if max_width != self._max_width:
+            self._max_width = max_width
+            self.horizontalScrollBar().setPageStep(width)
+            self.horizontalScrollBar().setRange(0, max(0, max_width - width))
+
+    def copy_visible_lines(self):
+        """
+        Copies the lines currently displayed into the clipboard.
+        """
+        first = self.verticalScrollBar().value()
+        lines = self._store.get_range(first, first + self.visible_rows())
+        prefixes = self.time_prefixes(first, lines) or [''] * len(lines)
+        QtWidgets.QApplication.clipboard().setText("\n".join(prefix + text
+                                                             for prefix, (text, flags) in zip(prefixes, lines)))
+
+
+class PortTab(QtWidgets.QWidget):
+    """
+    Console of one monitored port, with the buffers and logs attached to it.
+    The filters of the last searches are kept and updated as the lines arrive.
+    """
+    SEARCH_CACHE = 8
+    SEARCH_STEP = 50000
+
+    def __init__(self, port, display_buffer, console_store, trace_log=None, parent=None):
+        super().__init__(parent)
+        self.port = port
+        self.display_buffer = display_buffer
+        self.console_store = console_store
+        self.trace_log = trace_log
+        self.filters = OrderedDict()
+        self.search = None
+        self.filtered = False
+        self.zone_console = ConsoleView(console_store)
+        self.layout = QtWidgets.QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.layout.addWidget(self.zone_console)
+        self.setLayout(self.layout)
+
+    def drain_display_buffer(self, max_lines):
+        """
+        Displays by batch the lines queued by the reader thread.
+        :param max_lines: Maximum number of lines displayed at once.
+        :return: Number of lines displayed.
+        """
+        lines, skipped = self.display_buffer.drain(max_lines)
+        if skipped:
+            self.console_store.append(f"... {skipped} lines skipped ...", FLAG_MARKER)
+        for line, matches, received in lines:
+            self.display_port(line, matches, received)
+        searching = self.search is not None and not self.search.is_complete()
+        if searching:
+            self.search.update(self.SEARCH_STEP)
+        if lines or skipped or searching:
+            self.zone_console.refresh()
+        return len(lines)
+
+    def display_port(self, line, matches, received=0):
+        """
+        Displays line in the console area and highlights the parts matching a pattern or a condition.
+        The console is repainted by drain_display_buffer once the whole batch is stored.
+        :param line: The line to displays
+        :param matches: The matches reported by the detection, None or empty if nothing matched.
+        :param received: Receive timestamp of the line (time.perf_counter_ns()).
+        :return:
+        """
+        if matches:
+            self.console_store.append(line, FLAG_DETECTED, match_spans(matches), received)
+        else:
+            self.console_store.append(line, 0, None, received)
+
+    def set_search(self, pattern):
+        """
+        Searches the scrollback, the search goes on in the background while the lines are displayed.
+        A filter typed after one of the last searches only checks the lines matching it.
+        :param pattern: Literal pattern, or regular expression with the 're:' prefix, empty to stop searching.
+        :raise re.error: If the regular expression is not valid.
+        """
+        search = None
+        if pattern:
+            search = self.filters.pop(pattern, None)
+            if search is None:
+                bases = [f for f in self.filters.values() if f.is_complete() and f.is_refined_by(pattern)]
+                search = LineFilter(self.console_store, pattern, min(bases, key=len) if bases else None)
+            self.filters[pattern] = search
+            while len(self.filters) > self.SEARCH_CACHE:
+                self.filters.popitem(last=False)
+            search.update(self.SEARCH_STEP)
+        self.search = search
+        self.show_filtered(self.filtered)
+
+    def show_filtered(self, enabled):
+        """
+        Shows only the lines matching the search, or the whole scrollback.
+        :param enabled: True to show only the matching lines.
+        """
+        self.filtered = enabled
+        self.zone_console.set_store(self.search if enabled and self.search is not None else self.console_store)
+
+    def find(self, backward=False):
+        """
+        Highlights the next (or previous) line matching the search.
+        :param backward: True to search towards the beginning of the scrollback.
+        :return: True if a line has been found.
+        """
+        if self.search is None:
+            return False
+        current = self.zone_console.get_current()
+        if self.filtered:
+            row = (len(self.search) if backward else -1) if current is None else current
+            row += -1 if backward else 1
+            if not 0 <= row < len(self.search):
+                return False
+            self.zone_console.set_current(row)
+            return True
+        if current is None:
+            current = self.zone_console.verticalScrollBar().value() - (0 if backward else 1)
+        found = self.search.next_match(current, backward)
+        if found is None:
+            return False
+        self.zone_console.set_current(found)
+        return True
+
+    def console_html(self):
+        """
+        Renders the whole scrollback, history included, as html.
+        Each line is prefixed with its receive time.
+        :return: Generator of html fragments.
+        """
+        yield "<html><body style='font-family: monospace;'>\n"
+        store = self.console_store
+        for start in range(0, len(store), 4096):
+            all_spans = store.get_spans(start, start + 4096)
+            times = store.get_times(start, start + 4096)
+            for index, (line, flags) in enumerate(store.get_range(start, start + 4096), start):
+                spans = all_spans.get(index)
+                received = times[index - start]
+                if received:
+                    yield f"<span style='color: gray;'>{format_timestamp(received)} </span>"
+                if flags & FLAG_MARKER:
+                    yield f"<i><span style='color: gray;'>{html.escape(line)}</span></i><br>\n"
+                elif spans:
+                    yield highlight_html(line, spans) + "<br>\n"
+                elif flags & FLAG_DETECTED:
+                    yield f"<b><span style='background-color: yellow;'>{html.escape(line)}</span></b><br>\n"
+                else:
+                    yield f"<span style='background-color: white;'>{html.escape(line)}</span><br>\n"
+        yield "</body></html>\n"
+
+    def capture_records(self):
+        """
+        Converts the whole scrollback, history included, into capture records.
+        :return: Generator of (port name, line, flags, receive timestamp).
+        """
+        store = self.console_store
+        port_name = self.port.get_port_name()
+        for start in range(0, len(store), 4096):
+            all_spans = store.get_spans(start, start + 4096)
+            times = store.get_times(start, start + 4096)
+            for index, (line, flags) in enumerate(store.get_range(start, start + 4096), start):
+                capture_flags = 0
+                if flags & FLAG_MARKER:
+                    capture_flags = FLAG_EVENT
+                elif flags & FLAG_DETECTED:
+                    capture_flags = FLAG_MATCH
+                    if any(span[2] for span in all_spans.get(index, ())):
+                        capture_flags |= FLAG_CONDITION
+                yield port_name, line, capture_flags, times[index - start]
+
+    def release(self):
+        """
+        Closes the port, the console history and the trace log of the tab.
+        """
+        self.port.close_port()
+        self.console_store.close()
+        if self.trace_log is not None:
+            self.trace_log.close()
+
+
+class TraceViewer(QtWidgets.QMainWindow):
+    """
+    Offline viewer of a trace file, opened through a TraceIndex so that jumping to
+    a line or to the next match of a pattern does not read the whole file.
+    """
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.index = TraceIndex(path)
+        self.setWindowTitle("ETSM - " + path)
+        self.resize(1000, 700)
+        self.zone_console = ConsoleView(self.index, follow=False)
+        self.setCentralWidget(self.zone_console)
+        self.toolbar = self.addToolBar("viewer")
+        self.edit_line = QtWidgets.QSpinBox()
+        self.edit_line.setPrefix("Line ")
+        self.edit_line.setKeyboardTracking(False)
+        self.edit_pattern = QtWidgets.QLineEdit()
+        self.edit_pattern.setPlaceholderText("Pattern, re: for a regular expression")
+        self.but_previous = QtWidgets.QPushButton("Previous")
+        self.but_next = QtWidgets.QPushButton("Next")
+        self.but_reload = QtWidgets.QPushButton("Reload")
+        self.status_label = QtWidgets.QLabel()
+        self.toolbar.addWidget(self.edit_line)
+        self.toolbar.addWidget(self.edit_pattern)
+        self.toolbar.addWidget(self.but_previous)
+        self.toolbar.addWidget(self.but_next)
+        self.toolbar.addWidget(self.but_reload)
+        self.statusBar().addPermanentWidget(self.status_label)
+
+        self.edit_line.valueChanged.connect(self.go_to_line)
+        self.edit_pattern.returnPressed.connect(lambda: self.find(False))
+        self.but_next.clicked.connect(lambda: self.find(False))
+        self.but_previous.clicked.connect(lambda: self.find(True))
+        self.but_reload.clicked.connect(self.reload)
+        self.update_range()
+
+    def update_range(self):
+        """
+        Updates the line selector and the status bar with the number of lines of the trace.
+        """
+        self.edit_line.setRange(1, max(1, len(self.index)))
+        self.status_label.setText(str(len(self.index)) + " lines")
+        self.zone_console.refresh()
+
+    def go_to_line(self, number):
+        """
+        Shows a line of the trace.
+        :param number: Number of the line, from 1.
+        """
+        self.zone_console.set_current(number - 1)
+
+    def find(self, backward=False):
+        """
+        Shows the next (or previous) line matching the pattern, the matching lines are
+        indexed on the first search of a pattern.
+        :param backward: True to search towards the beginning of the trace.
+        """
+        pattern = self.edit_pattern.text()
+        if not pattern:
+            return
+        current = self.zone_console.get_current()
+        if current is None:
+            current = self.zone_console.verticalScrollBar().value() - (0 if backward else 1)
+        try:
+            found = self.index.next_match(pattern, current, backward)
+        except re.error as e:
+            self.statusBar().showMessage("Invalid regular expression: " + str(e), 5000)
+            return
+        if found is None:
+            self.statusBar().showMessage("No more match", 3000)
+            return
+        self.statusBar().showMessage("Match " + str(bisect.bisect_left(self.index.matches(pattern), found) + 1) +
+                                     "/" + str(len(self.index.matches(pattern))))
+        self.edit_line.blockSignals(True)
+        self.edit_line.setValue(found + 1)
+        self.edit_line.blockSignals(False)
+        self.zone_console.set_current(found)
+
+    def reload(self):
+        """
+        Takes into account the lines appended to the trace, only the new part is indexed.
+        """
+        self.index.refresh()
+        self.update_range()
+
+    def closeEvent(self, event):
+        self.index.close()
+        super().closeEvent(event)
+
+
 class Etsm(QtWidgets.QMainWindow):
-    sig_stop_thread = QtCore.pyqtSignal()
+    sig_ports_found = QtCore.pyqtSignal(list)
 
-    def __init__(self, parent=None, port_name=None, baudrate=115200, displayed=1, pattern=[], command=[]):
+    def __init__(self, parent=None, port_name=None, baudrate=115200, displayed=1, pattern=[], command=[],
+                 display_buffer=10000, overload_policy=LineBuffer.DROP, display_interval=50, display_batch=2000,
+                 scrollback=100000, history_dir=None, trace_log_factory=None, terminator='\n', encoding='utf-8',
+                 idle_flush=0.2, event_bus=None, startup=None, time_mode='none', capture=None,
+                 detection_pool=None, flow_control='none', char_delay=0, line_delay=0, drain=False):
         super().__init__(parent)
-        self.port_name = port_name
+        self.startup = startup
+        self.time_mode = time_mode
+        self.port_names = [port_name] if isinstance(port_name, str) else list(port_name)
         self.baudrate = str(baudrate)
         self.displayed = displayed
         self.pattern = pattern
         self.command = command
+        self.display_buffer_size = display_buffer
+        self.overload_policy = overload_policy
+        self.scrollback = scrollback
+        self.history_dir = history_dir
+        self.trace_log_factory = trace_log_factory
+        self.event_bus = event_bus
+        self.capture = capture
+        self.detection_pool = detection_pool
+        self.metrics = None
+        self.ports = PortGroup()
+        self.scheduler = CommandScheduler()
+        # Results of the expect steps, appended by the scheduler thread and shown by the display timer.
+        self.expect_results = deque()
+        self.scheduler.sig_expect_done.connect(lambda job, result: self.expect_results.append((job, result)))
+        self.terminator = terminator
+        self.encoding = encoding
+        self.idle_flush = idle_flush
+        self.flow_control = flow_control
+        self.char_delay = char_delay
+        self.line_delay = line_delay
+        self.drain = drain
+
+        # The ports are opened and read before the rest of the interface is built,
+        # the lines received meanwhile wait in the display buffers.
+        opened_ports = [self.open_port(name) for name in self.port_names]
+        self.ports.start()
+        self.mark_startup("ports opened, reader started")
+
+        self.display_interval = display_interval
+        self.display_batch = display_batch
+        self.display_timer = QtCore.QTimer(self)
         self.window_title = "Event Trigger Software Management"
         self.width = 650
         self.height = 650
@@ -426,6 +981,7 @@ class Etsm(QtWidgets.QMainWindow):
         self.settings_menu = QtWidgets.QMenu("Settings")
         self.port_config_menu = QtWidgets.QMenu("Port Configurator")
         self.select_port_menu = QtWidgets.QMenu("&Port Selector")
+        self.open_port_menu = QtWidgets.QMenu("&Open port in new tab")
         self.refresh_port = QtWidgets.QAction("Refresh ...")
         self.port_checked = None
         self.select_baudrate_menu = QtWidgets.QMenu("&Baudrate selector")
@@ -434,10 +990,17 @@ class Etsm(QtWidgets.QMainWindow):
         self.list_baudrate_action = []
         self.file_menu = QtWidgets.QMenu("File")
         self.file_action = QtWidgets.QAction("&Save Traces as ...")
+        self.export_latency_action = QtWidgets.QAction("&Export latency statistics ...")
+        self.stats_action = QtWidgets.QAction("S&tatistics ...")
+        self.open_trace_action = QtWidgets.QAction("&Open trace file ...")
+        self.trace_viewers = []
+        self.stats_panel = StatsPanel(self)
+        self.first_trace_displayed = False
         self.toolbar = self.addToolBar("toolbar")
-        self.command_manager_action = QtGui.QAction()
-        self.pattern_manager_action = QtGui.QAction()
-        self.conditions_manager_action = QtGui.QAction()
+        self.command_manager_action = QtWidgets.QAction()
+        self.pattern_manager_action = QtWidgets.QAction()
+        self.conditions_manager_action = QtWidgets.QAction()
+        self.time_combo = QtWidgets.QComboBox()
         self.command_historic_window = QtWidgets.QDialog()
         self.command_historic_window_lay = QtWidgets.QVBoxLayout()
         self.command_historic_window_edit = QtWidgets.QTextEdit()
@@ -446,15 +1009,15 @@ class Etsm(QtWidgets.QMainWindow):
         self.pattern_historic_window_lay = QtWidgets.QVBoxLayout()
         self.pattern_historic_window_edit = QtWidgets.QTextEdit()
         self.pattern_historic_window_but = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Save | QtWidgets.QDialogButtonBox.Cancel)
-        self.conditions_window_init_cond = Conditions(1)
         self.conditions_window = QtWidgets.QDialog()
         self.conditions_window_toolbar = QtWidgets.QToolBar()
+        self.conditions_port = None
         self.list_conditions = {}
-        self.list_conditions_number = 1
-        self.conditions_window_toolbar_action_add = QtGui.QAction("Add")
+        self.list_conditions_number = 0
+        self.conditions_window_toolbar_action_add = QtWidgets.QAction("Add")
         self.conditions_window_but = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Save | QtWidgets.QDialogButtonBox.Cancel)
         self.conditions_window_layout = QtWidgets.QVBoxLayout()
-        self.available_ports = find_available_ports()
+        self.available_ports = []
         self.label_command = QtWidgets.QLabel("Command")
         self.edit_command = QtWidgets.QLineEdit()
         self.label_send_command = "Send"
@@ -464,27 +1027,59 @@ class Etsm(QtWidgets.QMainWindow):
         self.label_accept_pattern = "OK"
         self.but_accept_pattern = QtWidgets.QPushButton()
         self.label_console = QtWidgets.QLabel("Console")
-        self.zone_console = QtWidgets.QPlainTextEdit()
+        self.port_tabs = QtWidgets.QTabWidget()
+        self.label_search = QtWidgets.QLabel("Search")
+        self.edit_search = QtWidgets.QLineEdit()
+        self.but_search_previous = QtWidgets.QPushButton("Previous")
+        self.but_search_next = QtWidgets.QPushButton("Next")
+        self.check_filter = QtWidgets.QCheckBox("Only matching lines")
+        self.search_status_label = QtWidgets.QLabel()
+        self.search_layout = QtWidgets.QHBoxLayout()
         self.status_bar = self.statusBar()
         self.status_bar_label = QtWidgets.QLabel()
+        self.status_queue_label = QtWidgets.QLabel()
+        self.status_latency_label = QtWidgets.QLabel()
+        self.status_workers_label = QtWidgets.QLabel()
+        self.script_progress = QtWidgets.QProgressBar()
+        self.but_cancel_script = QtWidgets.QPushButton("Cancel")
         self.layout = QtWidgets.QGridLayout()
         self.global_layout = QtWidgets.QHBoxLayout()
         self.global_widget = QtWidgets.QWidget()
 
         signal.signal(signal.SIGINT, self.exit_app)
-        self.setup_graphics()
+        self.setup_graphics(opened_ports)
+        self.mark_startup("user interface built")
+        self.sig_ports_found.connect(self.ports_found)
+        self.enumerate_ports()
+
+    @property
+    def worker(self):
+        """
+        Port of the current tab.
+        """
+        return self.port_tabs.currentWidget().port
+
+    def mark_startup(self, step):
+        """
+        Records the end of a startup step when the startup report is requested.
+        :param step: Description of the step.
+        """
+        if self.startup is not None:
+            self.startup.mark(step)
 
-    def setup_graphics(self):
-        self.worker = Port(self.port_name, self.baudrate, self.pattern, self.command)
-        self.thread_rx = QtCore.QThread(self)
+    def print_startup_report(self):
+        """
+        Prints the startup steps recorded since the previous report.
+        """
+        if self.startup is not None:
+            print(self.startup.report())
 
-        self.worker.sig_display_port.connect(self.display_port)
-        self.worker.sig_clean_command_area.connect(self.clean_command_area)
-        self.sig_stop_thread.connect(self.worker.stop)
+    def setup_graphics(self, opened_ports):
+        for port, display_buffer, trace_log in opened_ports:
+            self.add_port_tab(port, display_buffer, trace_log)
 
-        self.worker.moveToThread(self.thread_rx)
-        self.thread_rx.started.connect(self.worker.run)
-        self.thread_rx.finished.connect(self.thread_rx.deleteLater)
+        self.display_timer.setInterval(self.display_interval)
+        self.display_timer.timeout.connect(self.drain_display_buffer)
 
         self.setWindowTitle(self.window_title)
         self.resize(self.width, self.height)
@@ -492,7 +1087,6 @@ class Etsm(QtWidgets.QMainWindow):
         # Configures buttons
         self.but_send_command.setText(self.label_send_command)
         self.but_accept_pattern.setText(self.label_accept_pattern)
-        self.zone_console.setReadOnly(True)
 
         # Configures menu bar
         self.menu_bar.setNativeMenuBar(False)
@@ -500,34 +1094,29 @@ class Etsm(QtWidgets.QMainWindow):
         self.settings_menu.addAction("&Help ...")
         self.settings_menu.addAction("&Exit")
 
-        self.select_port_menu.addAction(self.refresh_port)
-
-        for i, p in enumerate(self.available_ports):
-            self.list_port_action.append(self.select_port_menu.addAction(p))
-            self.list_port_action[i].setCheckable(True)
-            if p == self.port_name:
-                self.list_port_action[i].setChecked(True)
-                self.port_checked = self.list_port_action[i]
+        self.fill_port_menus()
 
         for j, b in enumerate(serial.SerialBase.BAUDRATES):
             self.list_baudrate_action.append(self.select_baudrate_menu.addAction(str(b)))
             self.list_baudrate_action[j].setCheckable(True)
-            if str(b) == self.baudrate:
-                self.list_baudrate_action[j].setChecked(True)
-                self.baudrate_checked = self.list_baudrate_action[j]
+        self.update_port_menus()
 
         self.port_config_menu.addMenu(self.select_port_menu)
         self.port_config_menu.addMenu(self.select_baudrate_menu)
+        self.port_config_menu.addMenu(self.open_port_menu)
 
         self.file_menu.addAction(self.file_action)
+        self.file_menu.addAction(self.export_latency_action)
+        self.file_menu.addAction(self.stats_action)
+        self.file_menu.addAction(self.open_trace_action)
 
         self.menu_bar.addMenu(self.settings_menu)
         self.menu_bar.addMenu(self.port_config_menu)
         self.menu_bar.addMenu(self.file_menu)
 
-        self.settings_menu.triggered[QtGui.QAction].connect(self.settings)
-        self.port_config_menu.triggered[QtGui.QAction].connect(self.port_config_changed)
-        self.file_menu.triggered[QtGui.QAction].connect(self.save_into_file)
+        self.settings_menu.triggered[QtWidgets.QAction].connect(self.settings)
+        self.port_config_menu.triggered[QtWidgets.QAction].connect(self.port_config_changed)
+        self.file_menu.triggered[QtWidgets.QAction].connect(self.save_into_file)
 
         self.command_manager_action.setIcon(QtGui.QIcon('upload.png'))
         self.command_manager_action.setToolTip("Command manager")
@@ -544,6 +1133,12 @@ class Etsm(QtWidgets.QMainWindow):
         self.conditions_manager_action.triggered.connect(self.conditions_manager_window)
         self.toolbar.addAction(self.conditions_manager_action)
 
+        self.time_combo.addItems(["No time", "Receive time", "Since previous line", "Since last match"])
+        self.time_combo.setToolTip("Timing information displayed before the lines")
+        self.time_combo.setCurrentIndex(ConsoleView.TIME_MODES.index(self.time_mode))
+        self.time_combo.currentIndexChanged.connect(lambda index: self.set_time_mode(ConsoleView.TIME_MODES[index]))
+        self.toolbar.addWidget(self.time_combo)
+
         self.command_historic_window.setWindowTitle("Command Manager Window")
         self.pattern_historic_window.setWindowTitle("Pattern Manager Window")
 
@@ -554,7 +1149,9 @@ class Etsm(QtWidgets.QMainWindow):
         self.pattern_historic_window_but.accepted.connect(self.save_pattern_window)
         self.pattern_historic_window_but.rejected.connect(self.cancel_pattern_window)
 
-        self.command_historic_window_edit.setPlaceholderText("Enter set of commands to send ....\nClick on :"
+        self.command_historic_window_edit.setPlaceholderText("Enter set of commands to send ....\n"
+                                                             "'delay 2' or 'delay 250ms' pauses between commands."
+                                                             "\nClick on :"
                                                              "\n'Apply' to send the commands,"
                                                              "\n'Cancel' to exit the command manager,"
                                                              "\n'Save' to save the set of commands without sending it.")
@@ -562,7 +1159,8 @@ class Etsm(QtWidgets.QMainWindow):
         self.command_historic_window_lay.addWidget(self.command_historic_window_but)
         self.command_historic_window.setLayout(self.command_historic_window_lay)
 
-        self.pattern_historic_window_edit.setPlaceholderText("Enter the different patterns to detect ...")
+        self.pattern_historic_window_edit.setPlaceholderText("Enter the different patterns to detect ...\n"
+                                                             "Prefix a pattern with 're:' for a regular expression.")
         self.pattern_historic_window_lay.addWidget(self.pattern_historic_window_edit)
         self.pattern_historic_window_lay.addWidget(self.pattern_historic_window_but)
         self.pattern_historic_window.setLayout(self.pattern_historic_window_lay)
@@ -571,22 +1169,22 @@ class Etsm(QtWidgets.QMainWindow):
         self.edit_command.setPlaceholderText("Enter command to send or script file (.sh or .txt) ...")
         self.but_send_command.setToolTip("Send command")
         self.edit_pattern.setToolTip("Enter pattern to detect")
-        self.edit_pattern.setPlaceholderText("Enter pattern to detect ...")
+        self.edit_pattern.setPlaceholderText("Enter pattern to detect ('re:' prefix for a regular expression) ...")
         self.but_accept_pattern.setToolTip("Add pattern")
+        self.edit_search.setToolTip("Search the console (Ctrl+F)")
+        self.edit_search.setPlaceholderText("Search the console ('re:' prefix for a regular expression) ...")
+        self.check_filter.setToolTip("Show only the lines matching the search")
+        QtWidgets.QShortcut(QtGui.QKeySequence.Find, self, self.edit_search.setFocus)
 
         self.conditions_window.setWindowTitle("Conditions Manager Window")
-        self.list_conditions[1] = self.conditions_window_init_cond
-        self.conditions_window_init_cond.sig_remove_condition.connect(self.remove_condition)
-        self.conditions_window_init_cond.sig_save_condition.connect(self.save_condition)
         self.conditions_window_toolbar.addAction(self.conditions_window_toolbar_action_add)
-        self.conditions_window_toolbar_action_add.triggered.connect(self.create_condition)
+        self.conditions_window_toolbar_action_add.triggered.connect(lambda: self.create_condition())
 
         self.conditions_window_toolbar.addWidget(self.conditions_window_but)
         self.conditions_window_but.accepted.connect(self.save_condition_window)
         self.conditions_window_but.rejected.connect(self.cancel_condition_window)
 
         self.conditions_window_layout.addWidget(self.conditions_window_toolbar)
-        self.conditions_window_layout.addLayout(self.conditions_window_init_cond)
 
         self.conditions_window.setLayout(self.conditions_window_layout)
 
@@ -598,7 +1196,14 @@ class Etsm(QtWidgets.QMainWindow):
         self.layout.addWidget(self.edit_pattern, 1, 1, 1, 1)
         self.layout.addWidget(self.but_accept_pattern, 1, 2, 1, 1)
         self.layout.addWidget(self.label_console, 2, 0, 1, 1)
-        self.layout.addWidget(self.zone_console, 3, 1, 1, 1)
+        self.layout.addWidget(self.port_tabs, 3, 1, 1, 1)
+        self.search_layout.addWidget(self.edit_search)
+        self.search_layout.addWidget(self.but_search_previous)
+        self.search_layout.addWidget(self.but_search_next)
+        self.search_layout.addWidget(self.check_filter)
+        self.search_layout.addWidget(self.search_status_label)
+        self.layout.addWidget(self.label_search, 4, 0, 1, 1)
+        self.layout.addLayout(self.search_layout, 4, 1, 1, 1)
 
         self.global_layout.addLayout(self.layout)
 
@@ -608,13 +1213,34 @@ class Etsm(QtWidgets.QMainWindow):
         # Connect buttons to functions
         self.but_send_command.clicked.connect(lambda: self.worker.command_manager(self.edit_command.displayText()))
         self.but_accept_pattern.clicked.connect(self.add_pattern_from_but)
+        self.edit_search.textChanged.connect(self.search_changed)
+        self.edit_search.returnPressed.connect(lambda: self.find(False))
+        self.but_search_next.clicked.connect(lambda: self.find(False))
+        self.but_search_previous.clicked.connect(lambda: self.find(True))
+        self.check_filter.toggled.connect(lambda checked: self.port_tabs.currentWidget().show_filtered(checked))
 
-        self.status_bar_label.setText("Connected to " + self.port_name + " ; Baudrate " + str(self.baudrate))
-        self.status_bar.addPermanentWidget(self.status_bar_label)
-
-        self.thread_rx.start()
+        self.port_tabs.setTabsClosable(True)
+        self.port_tabs.tabCloseRequested.connect(self.close_port_tab)
+        self.port_tabs.currentChanged.connect(self.current_port_changed)
 
-        app.aboutToQuit.connect(self.exit_app)
+        self.update_status_bar()
+        self.status_bar.addPermanentWidget(self.status_bar_label)
+        self.status_bar.addPermanentWidget(self.status_queue_label)
+        self.status_bar.addPermanentWidget(self.status_latency_label)
+        if self.detection_pool is not None:
+            self.status_workers_label.setToolTip("Busy time of each detection worker over the last second")
+            self.status_bar.addPermanentWidget(self.status_workers_label)
+        self.script_progress.setMaximumWidth(200)
+        self.script_progress.hide()
+        self.but_cancel_script.setToolTip("Cancel the running scripts")
+        self.but_cancel_script.clicked.connect(lambda: self.scheduler.cancel())
+        self.but_cancel_script.hide()
+        self.status_bar.addPermanentWidget(self.script_progress)
+        self.status_bar.addPermanentWidget(self.but_cancel_script)
+
+        self.display_timer.start()
+
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.shutdown)
 
     def cancel_command_window(self):
         """
@@ -628,12 +1254,176 @@ class Etsm(QtWidgets.QMainWindow):
         """
         self.pattern_historic_window.hide()
 
+    def open_port_tab(self, port_name):
+        """
+        Opens a port in a new console tab, read by the common reader thread.
+        :param port_name: Name of the port to open.
+        """
+        self.add_port_tab(*self.open_port(port_name))
+
+    def open_port(self, port_name):
+        """
+        Opens a port and adds it to the common reader thread.
+        :param port_name: Name of the port to open.
+        :return: (port, display buffer, trace log), to be given to add_port_tab.
+        """
+        display_buffer = LineBuffer(self.display_buffer_size, self.overload_policy)
+        trace_log = self.trace_log_factory(port_name) if self.trace_log_factory else None
+        port = Port(port_name, self.baudrate, list(self.pattern), list(self.command), display_buffer,
+                    trace_log, self.terminator, self.encoding, self.idle_flush, self.flow_control, self.char_delay,
+                    self.line_delay, self.drain)
+        port.sig_clean_command_area.connect(self.clean_command_area)
+        port.set_scheduler(self.scheduler)
+        port.set_event_bus(self.event_bus)
+        port.set_capture(self.capture)
+        port.set_detection_pool(self.detection_pool)
+        self.ports.add(port)
+        return port, display_buffer, trace_log
+
+    def add_port_tab(self, port, display_buffer, trace_log=None):
+        """
+        Shows an opened port in a new console tab.
+        :param port: The Port returned by open_port.
+        :param display_buffer: Its display buffer.
+        :param trace_log: Its trace log, None if the traces are not logged.
+        """
+        port_name = port.get_port_name()
+        tab = PortTab(port, display_buffer, LineStore(self.scrollback, self.history_dir), trace_log)
+        tab.zone_console.set_time_mode(self.time_mode)
+        self.port_tabs.setCurrentIndex(self.port_tabs.addTab(tab, port_name))
+
+    def set_time_mode(self, mode):
+        """
+        Sets the timing information displayed before the lines of all the consoles.
+        :param mode: One of ConsoleView.TIME_MODES.
+        """
+        self.time_mode = mode
+        for index in range(self.port_tabs.count()):
+            self.port_tabs.widget(index).zone_console.set_time_mode(mode)
+
+    def close_port_tab(self, index):
+        """
+        Closes a console tab and its port, the last tab can't be closed.
+        :param index: Index of the tab to close.
+        """
+        if self.port_tabs.count() < 2:
+            return
+        tab = self.port_tabs.widget(index)
+        self.ports.remove(tab.port)
+        self.port_tabs.removeTab(index)
+        tab.release()
+        tab.deleteLater()
+
+    def current_port_changed(self, index):
+        """
+        Updates the menus and the status bar for the port of the selected tab.
+        :param index: Index of the selected tab.
+        """
+        if index >= 0:
+            self.update_port_menus()
+            self.update_status_bar()
+            self.search_changed(self.edit_search.text())
+            self.stats_panel.set_port(self.worker)
+
+    def search_changed(self, pattern):
+        """
+        Searches the console of the current port as the search is typed.
+        :param pattern: The searched pattern.
+        """
+        tab = self.port_tabs.currentWidget()
+        tab.filtered = self.check_filter.isChecked()
+        try:
+            tab.set_search(pattern)
+        except re.error as e:
+            tab.set_search('')
+            self.status_bar.showMessage("Invalid regular expression: " + str(e), 5000)
+        self.update_search_status()
+
+    def find(self, backward=False):
+        """
+        Highlights the next (or previous) line of the console matching the search.
+        :param backward: True to search towards the beginning of the console.
+        """
+        if not self.port_tabs.currentWidget().find(backward):
+            self.status_bar.showMessage("No more match", 3000)
+
+    def update_search_status(self):
+        """
+        Displays the number of lines matching the search of the current port.
+        """
+        search = self.port_tabs.currentWidget().search
+        if search is None:
+            self.search_status_label.clear()
+        elif search.is_complete():
+            self.search_status_label.setText(str(len(search)) + " lines")
+        else:
+            self.search_status_label.setText(str(len(search)) + " lines, searching " +
+                                             str(int(search.get_progress() * 100)) + "%")
+
+    def enumerate_ports(self):
+        """
+        Lists the available ports in a background thread, enumerating them can be slow
+        with many adapters. The menus are filled by ports_found once done.
+        """
+        threading.Thread(target=lambda: self.sig_ports_found.emit(find_available_ports()), name='etsm-ports',
+                         daemon=True).start()
+
+    def ports_found(self, ports):
+        """
+        Fills the port menus with the enumerated ports.
+        :param ports: Names of the available ports.
+        """
+        self.available_ports = ports
+        self.fill_port_menus()
+        if self.startup is not None:
+            self.mark_startup("ports enumerated")
+            self.print_startup_report()
+
+    def fill_port_menus(self):
+        """
+        Lists the available ports in the port selector and in the open port menus.
+        """
+        self.list_port_action.clear()
+        self.select_port_menu.clear()
+        self.open_port_menu.clear()
+        self.select_port_menu.addAction(self.refresh_port)
+        for i, p in enumerate(self.available_ports):
+            self.list_port_action.append(self.select_port_menu.addAction(p))
+            self.list_port_action[i].setCheckable(True)
+            self.open_port_menu.addAction(p)
+        self.update_port_menus()
+
+    def update_port_menus(self):
+        """
+        Checks the port and the baudrate of the current port in the menus.
+        """
+        if self.port_tabs.currentWidget() is None:
+            return
+        self.port_checked = None
+        for action in self.list_port_action:
+            action.setChecked(action.text() == self.worker.get_port_name())
+            if action.isChecked():
+                self.port_checked = action
+        self.baudrate_checked = None
+        for action in self.list_baudrate_action:
+            action.setChecked(action.text() == self.worker.get_baudrate())
+            if action.isChecked():
+                self.baudrate_checked = action
+
+    def update_status_bar(self):
+        """
+        Displays the port and the baudrate of the current port in the status bar.
+        """
+        state = "Connected to " if self.worker.is_connected() else "Waiting for "
+        self.status_bar_label.setText(
+            state + self.worker.get_port_name() + " ; Baudrate " + self.worker.get_baudrate())
+
     def cancel_condition_window(self):
         """
         Hides conditions manager window.
         """
         for key in self.list_conditions:
-            if key not in self.worker.get_condition():
+            if key not in self.conditions_port.get_condition():
                 self.list_conditions[key].clear_data()
         self.conditions_window.hide()
 
@@ -695,30 +1485,55 @@ class Etsm(QtWidgets.QMainWindow):
 
     def conditions_manager_window(self):
         """
-        Displays conditions manager window.
-        """
+        Displays conditions manager window with the conditions of the current port.
+        """
+        self.conditions_port = self.worker
+        for key in list(self.list_conditions):
+            self.list_conditions[key].clear_widgets()
+            self.conditions_window_layout.removeItem(self.list_conditions[key])
+            del self.list_conditions[key]
+        for cond_id, cond in self.conditions_port.get_condition().items():
+            new_cond = self.create_condition(cond_id)
+            new_cond.set_data(*cond)
+            new_cond.set_limit(cond[6], self.conditions_port.get_trigger_counters().get(cond_id))
+        self.create_condition()
+        self.conditions_window.setWindowTitle("Conditions Manager Window - " + self.conditions_port.get_port_name())
+        self.conditions_window.adjustSize()
         self.conditions_window.show()
 
-    def create_condition(self):
+    def create_condition(self, condition_id=None):
         """
         Creates a new basic empty condition.
+        :param condition_id: ID of the condition, a new one if None.
+        :return: The created condition.
         """
-        self.list_conditions_number += 1
-        new_cond = Conditions(self.list_conditions_number)
+        if condition_id is None:
+            self.list_conditions_number += 1
+            condition_id = self.list_conditions_number
+        else:
+            self.list_conditions_number = max(self.list_conditions_number, condition_id)
+        others = [p.get_port_name() for p in self.ports if p is not self.conditions_port]
+        new_cond = Conditions(condition_id, others)
         new_cond.sig_remove_condition.connect(self.remove_condition)
         new_cond.sig_save_condition.connect(self.save_condition)
-        self.list_conditions[self.list_conditions_number] = new_cond
-        self.conditions_window_layout.addLayout(self.list_conditions.get(self.list_conditions_number))
+        new_cond.sig_rearm_condition.connect(self.conditions_port.rearm_condition)
+        self.list_conditions[condition_id] = new_cond
+        self.conditions_window_layout.addLayout(new_cond)
+        return new_cond
 
-    def save_condition(self, condition_id, pattern, action, type):
+    def save_condition(self, condition_id, pattern, action, type, target, regex, rule, limit):
         """
         Saves condition with user entries.
         :param condition_id: Automatically assigned ID condition
         :param pattern: Pattern to detect.
         :param action: Name of the action.
         :param type: Type of the action, command or event.
+        :param target: Name of the port receiving the command, '' for the current port.
+        :param regex: True if the pattern is a regular expression.
+        :param rule: None, or the sequence or count rule of the condition.
+        :param limit: None, or the limits of the condition.
         """
-        self.worker.add_condition(condition_id, pattern, action, type)
+        self.conditions_port.add_condition(condition_id, pattern, action, type, target or None, regex, rule, limit)
 
     def remove_condition(self, condition_id):
         """
@@ -727,14 +1542,14 @@ class Etsm(QtWidgets.QMainWindow):
         """
         self.conditions_window_layout.removeItem(self.list_conditions.get(condition_id))
         del self.list_conditions[condition_id]
-        self.worker.del_specific_condition(condition_id)
+        self.conditions_port.del_specific_condition(condition_id)
         self.conditions_window.adjustSize()
 
     def send_command_window(self, but):
         """
         Gathers all the commands from command window and send it to the port.
         """
-        if self.command_historic_window_but.standardButton(but) == QtGui.QDialogButtonBox.Apply:
+        if self.command_historic_window_but.standardButton(but) == QtWidgets.QDialogButtonBox.Apply:
             com = []
             commands = self.command_historic_window_edit.toPlainText()
             for p in commands.split('\n'):
@@ -748,13 +1563,28 @@ class Etsm(QtWidgets.QMainWindow):
 
     def exit_app(self, event=None, *args):
         """
-        Stop the different threads and close the app.
+        Close the app, the threads are stopped by shutdown when the event loop quits.
         """
-        self.sig_stop_thread.emit()
-        self.thread_rx.quit()
-        self.thread_rx.wait()
         QtWidgets.QApplication.quit()
 
+    def shutdown(self):
+        """
+        Stop the different threads and release the ports, once, when the app quits.
+        """
+        self.display_timer.stop()
+        self.scheduler.stop()
+        self.ports.close()
+        for index in range(self.port_tabs.count()):
+            self.port_tabs.widget(index).release()
+        if self.event_bus is not None:
+            self.event_bus.close()
+        if self.capture is not None:
+            self.capture.close()
+        if self.detection_pool is not None:
+            self.detection_pool.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
     def settings(self, action):
         """
         Manages interactions with settings menu.
@@ -777,39 +1607,75 @@ class Etsm(QtWidgets.QMainWindow):
         :param action: Action requested by the user.
         """
         if action.text() == "Refresh ...":
-            self.list_port_action.clear()
-            self.select_port_menu.clear()
-            self.available_ports = find_available_ports()
-            self.select_port_menu.addAction(self.refresh_port)
-            for i, p in enumerate(self.available_ports):
-                self.list_port_action.append(self.select_port_menu.addAction(p))
-                self.list_port_action[i].setCheckable(True)
-                if p == self.worker.get_port_name():
-                    self.list_port_action[i].setChecked(True)
-                    self.port_checked = self.list_port_action[i]
+            self.enumerate_ports()
+        elif action.parentWidget() == self.open_port_menu:
+            self.open_port_tab(action.text())
         else:
             if action.parentWidget() == self.select_port_menu:
                 if self.worker.change_port(action.text()):
-                    self.port_checked.setChecked(False)
-                    self.port_checked = action
+                    self.port_tabs.setTabText(self.port_tabs.currentIndex(), action.text())
             if action.parentWidget() == self.select_baudrate_menu:
-                if self.worker.change_baudrate(action.text()):
-                    self.baudrate_checked.setChecked(False)
-                    self.baudrate_checked = action
-            self.status_bar_label.setText(
-                "Connected to " + self.worker.get_port_name() + " ; Baudrate " + self.worker.get_baudrate())
+                self.worker.change_baudrate(action.text())
+            self.update_port_menus()
+            self.update_status_bar()
 
     def save_into_file(self, action):
         """
         Opens dialog box and saves traces into correct html file.
         """
-        name = QtGui.QFileDialog.getSaveFileName(caption='Save traces', filter='html')
+        if action == self.export_latency_action:
+            self.export_latency()
+            return
+        if action == self.stats_action:
+            self.stats_panel.set_port(self.worker)
+            self.stats_panel.show()
+            self.stats_panel.raise_()
+            return
+        if action == self.open_trace_action:
+            self.open_trace()
+            return
+        name = QtWidgets.QFileDialog.getSaveFileName(caption='Save traces',
+                                                     filter='HTML (*.html);;ETSM capture (*.etsmcap)')
         if name[0]:
             filename = os.path.splitext(name[0])[0]
-            if filename:
+            if filename and 'etsmcap' in name[1]:
+                write_capture(filename + '.etsmcap', self.port_tabs.currentWidget().capture_records())
+            elif filename:
                 filename += '.html'
-                text= self.zone_console.document()
-                self.worker.save_traces(filename, str(text.toHtml()))
+                self.worker.save_traces(filename, self.port_tabs.currentWidget().console_html())
+
+    def port_stats(self):
+        """
+        Gets the counters of all the ports, for the metrics endpoint.
+        :return: Dict {port name: PortStats}.
+        """
+        return dict((port.get_port_name(), port.get_stats()) for port in self.ports)
+
+    def export_latency(self):
+        """
+        Opens dialog box and exports the trigger latency statistics of all the ports, as JSON or CSV.
+        """
+        name = QtWidgets.QFileDialog.getSaveFileName(caption='Export latency statistics',
+                                                     filter='JSON (*.json);;CSV (*.csv)')
+        if name[0]:
+            filename = name[0]
+            if not os.path.splitext(filename)[1]:
+                filename += '.csv' if 'csv' in name[1].lower() else '.json'
+            export_latency(filename, dict((port.get_port_name(), port.get_latency()) for port in self.ports))
+
+    def open_trace(self):
+        """
+        Opens dialog box and shows a trace file, for example a log, in a trace viewer.
+        """
+        name = QtWidgets.QFileDialog.getOpenFileName(caption='Open trace file')
+        if name[0]:
+            try:
+                viewer = TraceViewer(name[0])
+            except OSError as e:
+                self.status_bar.showMessage("Can't open " + name[0] + ": " + str(e), 5000)
+                return
+            self.trace_viewers.append(viewer)
+            viewer.show()
 
     def add_pattern_from_but(self):
         """
@@ -819,25 +1685,119 @@ class Etsm(QtWidgets.QMainWindow):
         self.worker.pattern_manager(pattern)
         self.edit_pattern.clear()
 
-    def display_port(self, line, detected):
-        """
-        Displays line in the console area and highlight it if detected from pattern.
-        :param line: The line to displays
-        :param detected: The line has been detected as a pattern or not.
-        :return:
-        """
-        if detected:
-            self.zone_console.appendHtml(f"<b><span style='background-color: yellow;'>{line}<b>")
+    def drain_display_buffer(self):
+        """
+        Displays by batch the lines queued by the reader thread and updates the queue counters.
+        """
+        drained = 0
+        for index in range(self.port_tabs.count()):
+            tab = self.port_tabs.widget(index)
+            drained += tab.drain_display_buffer(self.display_batch)
+            # A reconnected USB adapter may come back under another name.
+            if self.port_tabs.tabText(index) != tab.port.get_port_name():
+                self.port_tabs.setTabText(index, tab.port.get_port_name())
+        self.update_status_bar()
+        if drained and self.startup is not None and not self.first_trace_displayed:
+            self.first_trace_displayed = True
+            self.mark_startup("first trace displayed")
+            self.print_startup_report()
+        display_buffer = self.port_tabs.currentWidget().display_buffer
+        status = ("Queue " + str(len(display_buffer)) + "/" + str(display_buffer.get_maxlen()) +
+                  " ; Dropped " + str(display_buffer.dropped))
+        if self.event_bus is not None:
+            subscribers = self.event_bus.stats()
+            status += (" ; Bus " + str(len(subscribers)) + " subscribers, " +
+                       str(sum(s['dropped'] for s in subscribers)) + " dropped")
+        self.status_queue_label.setText(status)
+        self.status_latency_label.setText(self.worker.get_latency().short_summary())
+        if self.detection_pool is not None:
+            self.status_workers_label.setText(self.detection_pool.short_summary())
+        self.update_search_status()
+        self.update_script_progress()
+
+    def update_script_progress(self):
+        """
+        Shows the progress of the running scripts and the result of their last expect step in the status bar.
+        """
+        while self.expect_results:
+            job, result = self.expect_results.popleft()
+            text = os.path.basename(job.name) + ": " + result['pattern']
+            if result['matched']:
+                text += " received after " + format_duration(int(result['latency'] * 1000000))
+            else:
+                text += (" not received within " + format_duration(int(result['latency'] * 1000000)) + ", " +
+                         result['action'])
+            self.status_bar.showMessage(text, 5000)
+        jobs = self.scheduler.jobs()
+        if not jobs:
+            self.script_progress.hide()
+            self.but_cancel_script.hide()
+            return
+        done = sum(job.progress()[0] for job in jobs)
+        total = sum(job.progress()[1] for job in jobs)
+        self.script_progress.setMaximum(max(1, total))
+        self.script_progress.setValue(done)
+        if len(jobs) == 1:
+            self.script_progress.setFormat(os.path.basename(jobs[0].name) + " %v/%m")
         else:
-            self.zone_console.appendHtml(f"<span style='background-color: white;'>{line}")
+            self.script_progress.setFormat(str(len(jobs)) + " scripts %v/%m")
+        self.script_progress.show()
+        self.but_cancel_script.show()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='ETSM Tool')
-    parser.add_argument('-p', '--port', required=False, help='Specify port to open', default='/dev/ttyUSB0', type=str)
+    add_port_arguments(parser)
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without graphical interface, see python3 etsm_headless.py --help')
+    parser.add_argument('--display-buffer', required=False, help='Maximum number of lines waiting to be displayed',
+                        default=10000, type=int)
+    parser.add_argument('--overload-policy', required=False, help='What to do with the lines that can not be displayed',
+                        default=LineBuffer.DROP, choices=LineBuffer.POLICIES)
+    parser.add_argument('--display-interval', required=False, help='Console refresh period in ms', default=50, type=int)
+    parser.add_argument('--display-batch', required=False, help='Maximum number of lines displayed per refresh',
+                        default=2000, type=int)
+    parser.add_argument('--scrollback', required=False, help='Number of console lines kept in memory',
+                        default=100000, type=int)
+    parser.add_argument('--history-dir', required=False, help='Directory of the console history file',
+                        default=None, type=str)
+    parser.add_argument('--timestamps', required=False, choices=ConsoleView.TIME_MODES, default='none',
+                        help='Timing displayed before the lines: receive time, time since the previous line '
+                             'or since the last matched line')
+    parser.add_argument('--startup-report', action='store_true', help='Print the duration of the startup steps')
+    parser.add_argument('--view', required=False, help='Open a trace file in the trace viewer instead of a port',
+                        default=None, type=str)
     args = parser.parse_args()
 
+    if args.view:
+        app = QtWidgets.QApplication([])
+        viewer = TraceViewer(args.view)
+        viewer.show()
+        sys.exit(app.exec_())
+
+    port_names = args.port or [DEFAULT_PORT]
+
+    def trace_log_factory(port_name):
+        # Every port but the first one of the command line gets its own log name.
+        return open_trace_log(args, port_name if len(port_names) > 1 or port_name != port_names[0] else None)
+
+    startup = StartupTimer(STARTED) if args.startup_report else None
+    if startup is not None:
+        startup.mark("modules imported, options parsed")
     app = QtWidgets.QApplication([])
-    etsm = Etsm(port_name=args.port, baudrate=115200)
+    if startup is not None:
+        startup.mark("application created")
+    etsm = Etsm(port_name=port_names, baudrate=args.baudrate, display_buffer=args.display_buffer,
+                overload_policy=args.overload_policy, display_interval=args.display_interval,
+                display_batch=args.display_batch, scrollback=args.scrollback, history_dir=args.history_dir,
+                trace_log_factory=trace_log_factory, terminator=TERMINATORS[args.eol], encoding=args.encoding,
+                idle_flush=args.idle_flush / 1000.0, event_bus=open_event_bus(args), startup=startup,
+                time_mode=args.timestamps, capture=open_capture(args), detection_pool=open_detection_pool(args),
+                flow_control=args.flow_control, char_delay=args.char_delay / 1000.0,
+                line_delay=args.line_delay / 1000.0, drain=args.drain)
+    etsm.metrics = open_metrics_server(args, etsm.port_stats)
     etsm.show()
+    if startup is not None:
+        etsm.mark_startup("window shown")
+        QtCore.QTimer.singleShot(0, lambda: (etsm.mark_startup("event loop running"), etsm.print_startup_report()))
     QtWidgets.QApplication.instance().exec_()
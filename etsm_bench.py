@@ -0,0 +1,319 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks of the ETSM, driving a Port through a virtual serial device.
+The results are written as JSON so that versions can be compared.
+
+$ python3 etsm_bench.py -o bench.json
+$ python3 etsm_bench.py --device loop --lines 200000 --rate 50000 --match-ratio 0.01 --gui
+"""
+
+import argparse
+from etsm_engine import LineBuffer
+from etsm_port import Port, PortGroup
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import threading
+import time
+
+KEYWORD = 'TRIGGER'
+
+
+def generate_lines(count, length=80, match_ratio=0.0, keywords=(KEYWORD,), seed=0):
+    """
+    Generates reproducible synthetic traces.
+    The noise is made of lower case words so that it never matches the upper case keywords.
+    :param count: Number of lines.
+    :param length: Length of each line, without terminator.
+    :param match_ratio: Fraction of the lines holding one of the keywords.
+    :param keywords: Keywords inserted in the matching lines.
+    :param seed: Seed of the generator.
+    :return: List of the lines.
+    """
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + string.digits + '    '
+    pool = [''.join(rng.choice(alphabet) for _ in range(length)) for _ in range(min(count, 1024) or 1)]
+    lines = []
+    for i in range(count):
+        line = pool[i % len(pool)]
+        if match_ratio and rng.random() < match_ratio:
+            keyword = rng.choice(keywords)
+            pos = rng.randint(0, max(0, length - len(keyword)))
+            line = (line[:pos] + keyword + line[pos + len(keyword):])[:max(length, len(keyword))]
+        lines.append(line)
+    return lines
+
+
+def open_device(device):
+    """
+    Opens a virtual serial device.
+    :param device: 'pty' for a pseudo terminal pair (POSIX only) or 'loop' for pyserial loop://.
+    :return: (port name, writer fd or None), with loop:// the traces are written to the port itself.
+    """
+    if device == 'loop':
+        return 'loop://', None
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    os.close(slave)
+    return name, master
+
+
+def write_all(port, fd, data):
+    """
+    Writes bytes to the far end of the device.
+    """
+    if fd is None:
+        port.get_port().write(data)
+        return
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def bench_throughput(device, lines, rate, terminator='\n'):
+    """
+    Measures the sustained reception rate of a Port read by a PortGroup.
+    :param device: 'pty' or 'loop'.
+    :param lines: The lines to send.
+    :param rate: Offered rate in lines per second, 0 to send as fast as possible.
+    :return: Dict of the results.
+    """
+    name, fd = open_device(device)
+    display_buffer = LineBuffer(len(lines) + 1)
+    port = Port(name, 115200, [KEYWORD], [], display_buffer)
+    group = PortGroup()
+    group.add(port)
+    group.start()
+    data = [(line + terminator).encode('utf-8') for line in lines]
+    total_bytes = sum(len(d) for d in data)
+
+    def writer():
+        batch = max(1, rate // 100) if rate else 256
+        start = time.perf_counter()
+        for i in range(0, len(data), batch):
+            write_all(port, fd, b''.join(data[i:i + batch]))
+            if rate:
+                delay = start + (i + batch) / float(rate) - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    last, last_change = 0, time.perf_counter()
+    while display_buffer.pushed < len(lines) and time.perf_counter() - last_change < 2:
+        time.sleep(0.001)
+        if display_buffer.pushed != last:
+            last, last_change = display_buffer.pushed, time.perf_counter()
+    elapsed = (last_change if display_buffer.pushed < len(lines) else time.perf_counter()) - start
+    thread.join()
+    group.close()
+    port.close_port()
+    if fd is not None:
+        os.close(fd)
+    received = display_buffer.pushed
+    return {'device': device, 'offered_rate': rate, 'lines': received, 'lost': len(lines) - received,
+            'bytes': total_bytes * received // len(lines), 'seconds': round(elapsed, 6),
+            'lines_per_s': round(received / elapsed, 1),
+            'bytes_per_s': round(total_bytes * received / len(lines) / elapsed, 1)}
+
+
+def bench_detect(pattern_counts, condition_counts, lines_count, length, match_ratio, seed):
+    """
+    Measures the cost of Port.detect against the number of patterns and conditions.
+    The conditions are events without listener, so that only the detection is measured.
+    :return: List of dicts of the results.
+    """
+    port = Port('loop://', 115200, [], [])
+    results = []
+    for n_patterns in pattern_counts:
+        for n_conditions in condition_counts:
+            patterns = ['PAT%04d' % i for i in range(n_patterns)]
+            conditions = ['CND%04d' % i for i in range(n_conditions)]
+            lines = generate_lines(lines_count, length, match_ratio, tuple(patterns + conditions) or (KEYWORD,), seed)
+            port.set_pattern(patterns)
+            port.del_condition()
+            for i, cond in enumerate(conditions):
+                port.add_condition(i + 1, cond, 'EVENT', 'Event')
+            detect = port.detect
+            start = time.perf_counter()
+            for line in lines:
+                detect(line)
+            elapsed = time.perf_counter() - start
+            results.append({'patterns': n_patterns, 'conditions': n_conditions, 'lines': lines_count,
+                            'ns_per_line': round(elapsed * 1e9 / lines_count, 1),
+                            'lines_per_s': round(lines_count / elapsed, 1)})
+    port.close_port()
+    return results
+
+
+def bench_reaction(count):
+    """
+    Measures the reaction latency of a condition through a pseudo terminal: time between the
+    write of the trigger line and the reception of the command on the device side.
+    :param count: Number of triggers.
+    :return: Dict of the results, in microseconds.
+    """
+    import select
+    name, fd = open_device('pty')
+    port = Port(name, 115200, [], [])
+    port.add_condition(1, KEYWORD, 'ACK', 'Command')
+    group = PortGroup()
+    group.add(port)
+    group.start()
+    time.sleep(0.1)
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        write_all(port, fd, b'line with ' + KEYWORD.encode() + b'\n')
+        received = b''
+        while b'ACK' not in received:
+            if not select.select([fd], [], [], 1)[0]:
+                break
+            received += os.read(fd, 4096)
+        if b'ACK' in received:
+            samples.append((time.perf_counter() - start) * 1e6)
+        time.sleep(0.002)
+    internal = port.get_latency().summary()['stages']['complete']
+    group.close()
+    port.close_port()
+    os.close(fd)
+    samples.sort()
+    result = {'count': len(samples), 'lost': count - len(samples), 'internal': internal}
+    if samples:
+        result.update({'mean_us': round(sum(samples) / len(samples), 1),
+                       'p50_us': round(samples[len(samples) // 2], 1),
+                       'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 1),
+                       'max_us': round(samples[-1], 1)})
+    return result
+
+
+def bench_gui(lines, batch=2000):
+    """
+    Measures the append throughput of the console, display_port plus the repaint of each batch.
+    :param lines: The lines to display.
+    :param batch: Number of lines displayed per refresh, as --display-batch.
+    :return: Dict of the results.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets
+    from etsm_scrollback import LineStore
+    import etsm
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    display_buffer = LineBuffer(len(lines) + 1)
+    tab = etsm.PortTab(None, display_buffer, LineStore())
+    tab.resize(800, 600)
+    tab.show()
+    for line in lines:
+        pos = line.find(KEYWORD)
+        display_buffer.push((line, [(('pattern', KEYWORD), pos, pos + len(KEYWORD))] if pos >= 0 else None,
+                             time.perf_counter_ns()))
+    start = time.perf_counter()
+    while len(display_buffer):
+        tab.drain_display_buffer(batch)
+        app.processEvents()
+    elapsed = time.perf_counter() - start
+    tab.console_store.close()
+    return {'lines': len(lines), 'batch': batch, 'seconds': round(elapsed, 6),
+            'lines_per_s': round(len(lines) / elapsed, 1)}
+
+
+def version():
+    """
+    Gets the version of the benchmarked tree.
+    :return: Output of git describe, None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def counts(text):
+    return [int(n) for n in text.split(',') if n]
+
+
+def main(argv=None):
+    """
+    Runs the benchmarks and writes the results as JSON.
+    :param argv: Command line options, sys.argv[1:] if None.
+    :return: Exit status.
+    """
+    parser = argparse.ArgumentParser(description='ETSM benchmarks')
+    parser.add_argument('--device', choices=('pty', 'loop'), default='loop' if os.name != 'posix' else 'pty',
+                        help='Virtual serial device, pty pair (POSIX) or pyserial loop://')
+    parser.add_argument('--lines', type=int, default=100000, help='Number of lines of the throughput benchmark')
+    parser.add_argument('--length', type=int, default=80, help='Length of the generated lines')
+    parser.add_argument('--rate', type=int, default=0, help='Offered rate in lines/s, 0 for as fast as possible')
+    parser.add_argument('--match-ratio', type=float, default=0.01, help='Fraction of the lines holding a keyword')
+    parser.add_argument('--patterns', type=counts, default='0,10,100,1000',
+                        help='Comma separated pattern counts of the detect benchmark')
+    parser.add_argument('--conditions', type=counts, default='0,10,100',
+                        help='Comma separated condition counts of the detect benchmark')
+    parser.add_argument('--detect-lines', type=int, default=20000, help='Number of lines per detect measure')
+    parser.add_argument('--reactions', type=int, default=200,
+                        help='Number of triggers of the reaction benchmark, 0 to skip it (pty only)')
+    parser.add_argument('--gui', action='store_true', help='Also measure the console append throughput (Qt)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the trace generator')
+    parser.add_argument('-o', '--output', default='-', help='JSON output file, - for stdout')
+    args = parser.parse_args(argv)
+
+    lines = generate_lines(args.lines, args.length, args.match_ratio, seed=args.seed)
+    results = {'throughput': bench_throughput(args.device, lines, args.rate),
+               'detect': bench_detect(args.patterns, args.conditions, args.detect_lines, args.length,
+                                      args.match_ratio, args.seed)}
+    if args.reactions and os.name == 'posix':
+        results['reaction'] = bench_reaction(args.reactions)
+    if args.gui:
+        results['gui'] = bench_gui(lines)
+    report = {'version': version(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'time': time.time(), 'params': dict((k, v) for k, v in vars(args).items() if k != 'output'),
+              'results': results}
+    data = json.dumps(report, indent=2) + '\n'
+    if args.output == '-':
+        sys.stdout.write(data)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,340 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Event bus of the ETSM: the events of the conditions are published on a Unix domain
+socket, to which third party programs subscribe.
+
+Each message is a frame: a big-endian header (length of the rest of the frame: uint32,
+timestamp: float64, event length: uint16, port length: uint16, line length: uint32)
+followed by the UTF-8 event name, port name and matched line.
+
+$ python3 etsm_bus.py /tmp/etsm.sock
+"""
+
+import argparse
+import os
+import selectors
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+
+HEADER = struct.Struct('>IdHHI')
+_SIZE = struct.Struct('>I')
+
+
+def encode_frame(event, port, line, timestamp):
+    """
+    Encodes an event message.
+    :return: The frame bytes.
+    """
+    event = event.encode('utf-8', 'replace')[:0xffff]
+    port = port.encode('utf-8', 'replace')[:0xffff]
+    line = line.encode('utf-8', 'replace')
+    size = HEADER.size - _SIZE.size + len(event) + len(port) + len(line)
+    return HEADER.pack(size, timestamp, len(event), len(port), len(line)) + event + port + line
+
+
+def decode_frames(buffer):
+    """
+    Decodes the complete frames at the start of a buffer.
+    :param buffer: bytearray of the received bytes, the decoded frames are removed from it.
+    :return: List of (timestamp, event, port, line).
+    """
+    messages = []
+    pos = 0
+    while len(buffer) - pos >= HEADER.size:
+        size, timestamp, event_len, port_len, line_len = HEADER.unpack_from(buffer, pos)
+        end = pos + _SIZE.size + size
+        if len(buffer) < end:
+            break
+        start = pos + HEADER.size
+        event = bytes(buffer[start:start + event_len]).decode('utf-8', 'replace')
+        start += event_len
+        port = bytes(buffer[start:start + port_len]).decode('utf-8', 'replace')
+        start += port_len
+        line = bytes(buffer[start:start + line_len]).decode('utf-8', 'replace')
+        messages.append((timestamp, event, port, line))
+        pos = end
+    del buffer[:pos]
+    return messages
+
+
+class _Subscriber(object):
+    """
+    Connection of a subscriber with the frames waiting to be sent to it.
+    """
+    __slots__ = ('sock', 'pending', 'queued', 'sent_bytes', 'dropped', 'high_water', 'writing')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = bytearray()
+        self.queued = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.writing = False
+
+
+class EventBus(object):
+    """
+    Publish/subscribe endpoint on a Unix domain socket.
+    publish() only appends the frame to the buffer of each subscriber and never blocks,
+    a background thread sends everything buffered in one write per subscriber, so the
+    frames are batched when the events come faster than the subscriber reads them.
+    A subscriber whose buffer is full loses the new frames, they are counted as dropped.
+    """
+
+    def __init__(self, path, max_pending=1 << 20):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("Unix domain sockets are not supported on this platform.")
+        self._path = path
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self.published = 0
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # Stale socket of a previous run.
+            os.remove(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(8)
+        self._server.setblocking(False)
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._wake_pending = False
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ, 'accept')
+        self._selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
+        self.exit = False
+        self._thread = threading.Thread(target=self._run, name='etsm-bus', daemon=True)
+        self._thread.start()
+
+    def publish(self, event, port, line, timestamp=None):
+        """
+        Publishes an event to all the subscribers, never blocks the caller.
+        :param event: Name of the event.
+        :param port: Name of the port the line was received on.
+        :param line: The line which triggered the event.
+        :param timestamp: Time of the event (time.time()), now if None.
+        """
+        if not self._subscribers:
+            return
+        frame = encode_frame(event, port, line, timestamp or time.time())
+        wake = False
+        with self._lock:
+            self.published += 1
+            for sub in self._subscribers:
+                if len(sub.pending) + len(frame) > self._max_pending:
+                    sub.dropped += 1
+                    continue
+                sub.pending += frame
+                sub.queued += 1
+                if len(sub.pending) > sub.high_water:
+                    sub.high_water = len(sub.pending)
+            if not self._wake_pending:
+                self._wake_pending = wake = True
+        if wake:
+            self._wake()
+
+    def stats(self):
+        """
+        Gets the backpressure counters of each subscriber.
+        :return: List of dicts with the queued and dropped frames, the sent, pending and high water bytes.
+        """
+        with self._lock:
+            return [{'subscriber': i, 'queued': sub.queued, 'dropped': sub.dropped, 'sent_bytes': sub.sent_bytes,
+                     'pending': len(sub.pending), 'high_water': sub.high_water}
+                    for i, sub in enumerate(self._subscribers)]
+
+    def get_path(self):
+        """
+        Gets the path of the socket.
+        :return: Path of the socket.
+        """
+        return self._path
+
+    def close(self):
+        """
+        Stops the bus, disconnects the subscribers and removes the socket.
+        """
+        if self._thread is None:
+            return
+        self.exit = True
+        self._wake()
+        self._thread.join()
+        self._thread = None
+        for sub in self._subscribers:
+            sub.sock.close()
+        self._subscribers = []
+        self._selector.close()
+        self._server.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except OSError:
+            pass
+
+    def _drop(self, sub):
+        # A subscriber dropped by a failed flush can still have events in the same select() batch.
+        with self._lock:
+            if sub not in self._subscribers:
+                return
+            self._subscribers.remove(sub)
+        self._selector.unregister(sub.sock)
+        sub.sock.close()
+
+    def _flush(self, sub):
+        """
+        Sends as much of the pending frames of a subscriber as its socket accepts.
+        """
+        with self._lock:
+            data = bytes(sub.pending)
+        try:
+            sent = sub.sock.send(data) if data else 0
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._drop(sub)
+            return
+        with self._lock:
+            del sub.pending[:sent]
+            sub.sent_bytes += sent
+            writing = bool(sub.pending)
+        if writing != sub.writing:
+            sub.writing = writing
+            self._selector.modify(sub.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0), sub)
+
+    def _run(self):
+        while not self.exit:
+            for key, mask in self._selector.select(1):
+                if key.data == 'accept':
+                    try:
+                        sock, _ = self._server.accept()
+                    except OSError:
+                        continue
+                    sock.setblocking(False)
+                    sub = _Subscriber(sock)
+                    with self._lock:
+                        self._subscribers.append(sub)
+                    self._selector.register(sock, selectors.EVENT_READ, sub)
+                elif key.data == 'wake':
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    with self._lock:
+                        self._wake_pending = False
+                        subscribers = [sub for sub in self._subscribers if sub.pending]
+                    for sub in subscribers:
+                        self._flush(sub)
+                else:
+                    sub = key.data
+                    if mask & selectors.EVENT_READ:
+                        try:
+                            data = sub.sock.recv(4096)
+                        except (BlockingIOError, InterruptedError):
+                            data = None
+                        except OSError:
+                            data = b''
+                        if data == b'':
+                            self._drop(sub)
+                            continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(sub)
+
+
+class EventSubscriber(object):
+    """
+    Client of the event bus, for the third party programs.
+    """
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._buffer = bytearray()
+
+    def receive(self, timeout=None):
+        """
+        Waits for events.
+        :param timeout: Maximum wait in seconds, None to wait forever.
+        :return: List of (timestamp, event, port, line), empty on timeout.
+        :raise ConnectionError: If the bus is closed.
+        """
+        self._sock.settimeout(timeout)
+        while True:
+            try:
+                data = self._sock.recv(1 << 16)
+            except socket.timeout:
+                return []
+            if not data:
+                raise ConnectionError("Event bus closed.")
+            self._buffer += data
+            messages = decode_frames(self._buffer)
+            if messages:
+                return messages
+
+    def __iter__(self):
+        try:
+            while True:
+                for message in self.receive():
+                    yield message
+        except ConnectionError:
+            return
+
+    def close(self):
+        """
+        Disconnects from the bus.
+        """
+        self._sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints the events published on an ETSM event bus')
+    parser.add_argument('path', help='Socket of the event bus (--event-bus option of the ETSM)')
+    args = parser.parse_args()
+    subscriber = EventSubscriber(args.path)
+    try:
+        for timestamp, event, port, line in subscriber:
+            print(str(timestamp) + '\t' + port + '\t' + event + '\t' + line, flush=True)
+    except KeyboardInterrupt:
+        pass
+    subscriber.close()
@@ -0,0 +1,347 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Compact binary capture of the traces received by the ETSM.
+
+A capture starts with a header (magic "ETSMCAP1", int64 offset in ns from the receive
+timestamps to the wall clock) followed by length-prefixed little-endian records:
+uint32 length of the data, int64 receive timestamp (ns, monotonic), uint16 port id,
+uint8 flags, then the data. A record with FLAG_PORT declares a port id, its data is the
+UTF-8 name of the port, a NUL byte and the encoding of its lines.
+The lines are kept as the bytes received, undecodable ones included, and are only decoded
+when the capture is read. The events of the ETSM itself (FLAG_EVENT) are UTF-8 text.
+
+$ python3 etsm_capture.py capture.etsmcap --format text
+$ python3 etsm_capture.py capture.etsmcap --format ndjson -o capture.ndjson
+$ python3 etsm_capture.py capture.etsmcap --format html -o capture.html
+"""
+
+import argparse
+import codecs
+from collections import namedtuple
+import datetime
+from etsm_stats import wall_offset_ns
+import html
+import json
+import queue
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b'ETSMCAP1'
+FILE_HEADER = struct.Struct('<8sq')
+RECORD_HEADER = struct.Struct('<IqHB')
+
+FLAG_MATCH = 0x01
+FLAG_CONDITION = 0x02
+FLAG_EVENT = 0x04
+FLAG_PORT = 0x80
+
+CaptureRecord = namedtuple('CaptureRecord', 'timestamp received port flags line data')
+CaptureRecord.__doc__ = """
+A line of a capture: wall clock timestamp (seconds), receive timestamp (ns, monotonic),
+port name, FLAG_* bits, the decoded line and its bytes as captured.
+"""
+
+
+def encode_record(received, port_id, flags, data):
+    """
+    Encodes a capture record.
+    :param received: Receive timestamp in ns.
+    :param port_id: Id of the port.
+    :param flags: FLAG_* bits.
+    :param data: The line as bytes.
+    :return: The record bytes.
+    """
+    return RECORD_HEADER.pack(len(data), received, port_id, flags) + data
+
+
+def encode_port_record(port_id, port_name, encoding):
+    """
+    Encodes the record declaring a port.
+    :param port_id: Id of the port.
+    :param port_name: Name of the port.
+    :param encoding: Encoding of the lines of the port.
+    :return: The record bytes.
+    """
+    return encode_record(0, port_id, FLAG_PORT,
+                         port_name.encode('utf-8', 'replace') + b'\0' + encoding.encode('ascii', 'replace'))
+
+
+def encode_line(line, flags, encoding):
+    """
+    Gets the data of a line record.
+    :param line: The line, bytes as received or text.
+    :param flags: FLAG_* bits, the text of an event is always UTF-8.
+    :param encoding: Encoding of the text of the other lines.
+    :return: The data bytes.
+    """
+    if isinstance(line, bytes):
+        return line
+    return line.encode('utf-8' if flags & FLAG_EVENT else encoding, 'replace')
+
+
+class CaptureWriter(object):
+    """
+    Appends the received lines of one or several ports to a capture file.
+    As TraceLog, the callers only queue the lines, the records are packed and written by a
+    background thread through a large buffer, flushed once nothing is left to write.
+    """
+
+    def __init__(self, path, buffer_size=1 << 16):
+        self._path = path
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._file.write(FILE_HEADER.pack(MAGIC, wall_offset_ns()))
+        self._ports = {}
+        self._queue = queue.SimpleQueue()
+        self.records = 0
+        self.bytes = FILE_HEADER.size
+        self._thread = threading.Thread(target=self._run, name='etsm-capture', daemon=True)
+        self._thread.start()
+
+    def write(self, port_name, line, flags=0, received=None, encoding='utf-8'):
+        """
+        Queues a received line, never blocks the caller.
+        :param port_name: Name of the port the line was received from.
+        :param line: The line received, preferably its bytes as received, or its text.
+        :param flags: FLAG_* bits.
+        :param received: Receive timestamp (time.perf_counter_ns()), now if None.
+        :param encoding: Encoding of the lines of the port, recorded with its first record.
+        """
+        self._queue.put((received or time.perf_counter_ns(), port_name, flags, line, encoding))
+
+    def write_event(self, port_name, text, received=None, encoding='utf-8'):
+        """
+        Queues a record describing an event of the ETSM itself (reconnection, ...).
+        :param port_name: Name of the port concerned.
+        :param text: Description of the event.
+        :param received: Time of the event (time.perf_counter_ns()), now if None.
+        :param encoding: Encoding of the lines of the port, the event itself is UTF-8.
+        """
+        self.write(port_name, text, FLAG_EVENT, received, encoding)
+
+    def get_path(self):
+        """
+        Gets the path of the capture.
+        :return: Path of the capture file.
+        """
+        return self._path
+
+    def close(self):
+        """
+        Writes the remaining records and closes the capture.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _pack(self, record):
+        received, port_name, flags, line, encoding = record
+        port_id = self._ports.get(port_name)
+        data = b''
+        if port_id is None:
+            port_id = self._ports[port_name] = len(self._ports)
+            data = encode_port_record(port_id, port_name, encoding)
+        return data + encode_record(received, port_id, flags, encode_line(line, flags, encoding))
+
+    def _run(self):
+        running = True
+        while running:
+            records = [self._queue.get()]
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if records[-1] is None:
+                running = False
+                records.pop()
+            data = b''.join(self._pack(record) for record in records)
+            self._file.write(data)
+            self.records += len(records)
+            self.bytes += len(data)
+            self._file.flush()
+        self._file.close()
+
+
+def write_capture(path, records):
+    """
+    Writes a whole capture at once, for example from the console scrollback.
+    The lines of a scrollback are already decoded, their text is stored in UTF-8 and the
+    bytes of the undecodable characters are lost.
+    :param path: The capture file.
+    :param records: Iterable of (port name, line, flags, receive timestamp in ns), the line as text.
+    """
+    ports = {}
+    with open(path, 'wb', buffering=1 << 20) as f:
+        f.write(FILE_HEADER.pack(MAGIC, wall_offset_ns()))
+        for port_name, line, flags, received in records:
+            port_id = ports.get(port_name)
+            if port_id is None:
+                port_id = ports[port_name] = len(ports)
+                f.write(encode_port_record(port_id, port_name, 'utf-8'))
+            f.write(encode_record(received, port_id, flags, line.encode('utf-8', 'replace')))
+
+
+def read_capture(path, block_size=1 << 20):
+    """
+    Reads a capture by blocks, without loading it.
+    The lines are decoded with the encoding of their port, invalid bytes being replaced.
+    A record cut by the end of the file (capture still written or interrupted) is ignored.
+    :param path: The capture file.
+    :param block_size: Number of bytes read at once.
+    :return: Generator of CaptureRecord.
+    :raise ValueError: If the file is not a capture.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + " is not an ETSM capture.")
+        offset = FILE_HEADER.unpack(header)[1]
+        ports = {}
+        encodings = {}
+        unpack = RECORD_HEADER.unpack_from
+        size = RECORD_HEADER.size
+        buf = b''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            buf = buf + block if buf else block
+            pos = 0
+            end = len(buf)
+            while pos + size <= end:
+                length, received, port_id, flags = unpack(buf, pos)
+                if pos + size + length > end:
+                    break
+                data = buf[pos + size:pos + size + length]
+                pos += size + length
+                if flags & FLAG_PORT:
+                    name, _, encoding = data.partition(b'\0')
+                    ports[port_id] = name.decode('utf-8', 'replace')
+                    encodings[port_id] = _lookup_encoding(encoding.decode('ascii', 'replace'))
+                else:
+                    encoding = 'utf-8' if flags & FLAG_EVENT else encodings.get(port_id, 'utf-8')
+                    yield CaptureRecord((received + offset) / 1e9, received, ports.get(port_id, str(port_id)),
+                                        flags, data.decode(encoding, 'replace'), data)
+            buf = buf[pos:]
+
+
+def _lookup_encoding(encoding):
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        print("Unknown encoding " + encoding + ", the lines are decoded as UTF-8.")
+        return 'utf-8'
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='microseconds')
+
+
+def _text_flag(flags):
+    if flags & FLAG_EVENT:
+        return '#'
+    return 'M' if flags & FLAG_MATCH else '-'
+
+
+def to_text(records, out):
+    """
+    Converts capture records to text, one "<timestamp> TAB <flag> TAB <port> TAB <line>" line each,
+    the flag being the one of the trace log ('M' matched, '-' other line, '#' event of the ETSM).
+    :param records: Iterable of CaptureRecord.
+    :param out: Text stream.
+    """
+    out.writelines(_isoformat(r.timestamp) + '\t' + _text_flag(r.flags) + '\t' + r.port + '\t' + r.line + '\n'
+                   for r in records)
+
+
+def to_ndjson(records, out):
+    """
+    Converts capture records to one JSON object per line, as the records of the headless mode.
+    :param records: Iterable of CaptureRecord.
+    :param out: Text stream.
+    """
+    for r in records:
+        if r.flags & FLAG_EVENT:
+            record = {'type': 'etsm', 'port': r.port, 'text': r.line}
+        else:
+            record = {'type': 'match' if r.flags & FLAG_MATCH else 'line', 'port': r.port, 'line': r.line}
+            if r.flags & FLAG_CONDITION:
+                record['condition'] = True
+        record['ts'] = r.timestamp
+        out.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def to_html(records, out):
+    """
+    Converts capture records to html, the matched lines are highlighted as in the console.
+    :param records: Iterable of CaptureRecord.
+    :param out: Text stream.
+    """
+    out.write("<html><body style='font-family: monospace;'>\n")
+    for r in records:
+        stamp = f"<span style='color: gray;'>{_isoformat(r.timestamp)} {html.escape(r.port)} </span>"
+        if r.flags & FLAG_EVENT:
+            out.write(f"{stamp}<i><span style='color: gray;'>{html.escape(r.line)}</span></i><br>\n")
+        elif r.flags & FLAG_MATCH:
+            out.write(f"{stamp}<b><span style='background-color: yellow;'>{html.escape(r.line)}</span></b><br>\n")
+        else:
+            out.write(f"{stamp}{html.escape(r.line)}<br>\n")
+    out.write("</body></html>\n")
+
+
+CONVERTERS = {'text': to_text, 'ndjson': to_ndjson, 'html': to_html}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts an ETSM capture')
+    parser.add_argument('capture', help='Capture file, written with --capture or saved from the console')
+    parser.add_argument('--format', choices=sorted(CONVERTERS), default='text', help='Output format (default text)')
+    parser.add_argument('--port', default=None, help='Only convert the lines of this port')
+    parser.add_argument('--matched', action='store_true', help='Only convert the matched lines')
+    parser.add_argument('-o', '--output', default='-', help='Output file, - for stdout (default)')
+    args = parser.parse_args()
+    records = read_capture(args.capture)
+    if args.port is not None:
+        records = (r for r in records if r.port == args.port)
+    if args.matched:
+        records = (r for r in records if r.flags & FLAG_MATCH)
+    try:
+        if args.output == '-':
+            CONVERTERS[args.format](records, sys.stdout)
+        else:
+            with open(args.output, 'w', encoding='utf-8', buffering=1 << 20) as out:
+                CONVERTERS[args.format](records, out)
+    except (IOError, ValueError) as e:
+        print("Can't convert " + args.capture + ": " + str(e))
+        sys.exit(1)
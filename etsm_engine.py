@@ -0,0 +1,662 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Detection engine of the ETSM, independent from the graphical interface.
+"""
+
+import codecs
+from collections import deque
+import re
+import threading
+
+TERMINATORS = {'LF': '\n', 'CR': '\r', 'CRLF': '\r\n'}
+
+
+class PatternMatcher(object):
+    """
+    Multi-pattern substring matcher built as an Aho-Corasick automaton.
+    All the keywords are found in a single pass over the line, whatever their number.
+    """
+
+    def __init__(self, keywords=None):
+        self._root = {}
+        self._delta = [self._root]
+        self._out = [()]
+        self._size = 0
+        if keywords:
+            self.build(keywords)
+
+    def __len__(self):
+        return self._size
+
+    def build(self, keywords):
+        """
+        Compiles the automaton for the given keywords, replacing the previous ones.
+        :param keywords: Iterable of (key, needle) pairs, the key is reported when the needle is found.
+        """
+        goto = [{}]
+        out = [[]]
+        size = 0
+        for key, needle in keywords:
+            if not needle:
+                continue
+            state = 0
+            for ch in needle:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append([])
+                state = nxt
+            out[state].append((key, len(needle)))
+            size += 1
+
+        # Breadth-first resolution of the failure links. Each state only keeps the
+        # transitions that differ from the root ones, the root is the fallback.
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        root = dict(goto[0])
+        delta[0] = root
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            f = fail[state]
+            trans = dict(delta[f]) if f else {}
+            trans.update(goto[state])
+            delta[state] = trans
+            for ch, nxt in goto[state].items():
+                g = delta[f].get(ch) if f else None
+                if g is None:
+                    g = root.get(ch, 0)
+                fail[nxt] = g
+                out[nxt].extend(out[g])
+                queue.append(nxt)
+
+        self._root = root
+        self._delta = delta
+        self._out = [tuple(o) for o in out]
+        self._size = size
+
+    def search(self, text):
+        """
+        Finds every occurrence of every keyword in the text.
+        :param text: The line to process.
+        :return: List of (key, start, end) tuples, ordered by end position.
+        """
+        root = self._root
+        if not root:
+            return []
+        delta = self._delta
+        out = self._out
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            if state:
+                nxt = delta[state].get(ch)
+                if nxt is None:
+                    nxt = root.get(ch, 0)
+                state = nxt
+            else:
+                state = root.get(ch, 0)
+                if not state:
+                    continue
+            if out[state]:
+                end = i + 1
+                for key, length in out[state]:
+                    matches.append((key, end - length, end))
+        return matches
+
+
+class RegexMatcher(object):
+    """
+    Regular expression rules compiled into a single expression, evaluated once per line.
+    Each rule is wrapped in an optional lookahead anchored at the start of the line, so one
+    match reports the first occurrence of every rule along with its captured groups.
+    Rules which can't be combined (backreferences, named groups, inline flags) are kept apart.
+    """
+    _ISOLATED = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux-]+[:)]')
+
+    def __init__(self, rules=None):
+        self._combined = None
+        self._slots = []
+        self._isolated = []
+        if rules:
+            self.build(rules)
+
+    def __len__(self):
+        return len(self._slots) + len(self._isolated)
+
+    def build(self, rules):
+        """
+        Compiles the rules, replacing the previous ones.
+        :param rules: Iterable of (key, pattern) pairs, the key is reported when the pattern matches.
+        :raise re.error: If a pattern is not a valid regular expression.
+        """
+        parts = []
+        slots = []
+        isolated = []
+        group = 1
+        for key, pattern in rules:
+            compiled = re.compile(pattern)
+            if self._ISOLATED.search(pattern):
+                isolated.append((key, compiled))
+                continue
+            parts.append('(?=(?:.*?(' + pattern + '))?)')
+            slots.append((key, group, compiled.groups))
+            group += 1 + compiled.groups
+        combined = None
+        if parts:
+            try:
+                combined = re.compile(''.join(parts), re.DOTALL)
+            except re.error:
+                isolated = [(key, re.compile(pattern)) for key, pattern in rules]
+                slots = []
+        self._combined = combined
+        self._slots = slots
+        self._isolated = isolated
+
+    def search(self, text):
+        """
+        Finds the first occurrence of every rule in the text.
+        :param text: The line to process.
+        :return: List of (key, start, end, groups, named) tuples, groups is the tuple of the
+                 captured groups of the rule and named the dict of its named groups.
+        """
+        matches = []
+        if self._combined is not None:
+            m = self._combined.match(text)
+            for key, group, count in self._slots:
+                start = m.start(group)
+                if start >= 0:
+                    matches.append((key, start, m.end(group), m.groups()[group:group + count], {}))
+        for key, compiled in self._isolated:
+            m = compiled.search(text)
+            if m:
+                matches.append((key, m.start(), m.end(), m.groups(), m.groupdict()))
+        return matches
+
+
+def search_rules(matcher, regex_matcher, line):
+    """
+    Searches all the rules of a port in a line.
+    :param matcher: PatternMatcher of the keywords.
+    :param regex_matcher: RegexMatcher of the regular expressions.
+    :param line: The line to search.
+    :return: (matches, captures): the list of (key, start, end) sorted by start and the dict
+             key -> (groups, named) of the regex matches, None if there is no regex match.
+    """
+    matches = matcher.search(line)
+    captures = None
+    if regex_matcher:
+        captures = {}
+        for key, start, end, groups, named in regex_matcher.search(line):
+            matches.append((key, start, end))
+            captures[key] = (groups, named)
+        if captures:
+            matches.sort(key=lambda m: m[1])
+        else:
+            captures = None
+    return matches, captures
+
+
+_GROUP_REFERENCE = re.compile(r'\\(?:g<(\w+)>|(\d+))')
+
+
+def expand_groups(template, groups, named=None):
+    """
+    Substitutes the captured groups into a command or an event name.
+    \\1 or \\g<1> is replaced by the first group, \\g<name> by a named group, a group which
+    did not participate in the match is replaced by an empty string.
+    :param template: The action of the condition.
+    :param groups: Tuple of the captured groups.
+    :param named: Dict of the named groups.
+    :return: The action with the groups substituted.
+    """
+    if not groups and not named:
+        return template
+
+    def substitute(m):
+        ref = m.group(1) or m.group(2)
+        if ref.isdigit():
+            index = int(ref)
+            if 1 <= index <= len(groups):
+                return groups[index - 1] or ''
+            return m.group(0)
+        if named and ref in named:
+            return named[ref] or ''
+        return m.group(0)
+    return _GROUP_REFERENCE.sub(substitute, template)
+
+
+class SequenceTracker(object):
+    """
+    Incremental state machine of a sequence rule: the steps must be seen in order, the last
+    one within `window` seconds of the first one. For each step only the most recent start
+    of a partial sequence is kept, so a line costs the same whatever the history.
+    """
+
+    def __init__(self, steps, window=0):
+        self._last = steps - 1
+        self._window = window
+        self._started = [None] * (steps + 1)
+
+    def feed(self, step, now):
+        """
+        Advances the sequence with a matched step.
+        :param step: Index of the matched step, 0 for the first one.
+        :param now: Time of the line (time.monotonic()).
+        :return: True if the sequence is complete, it then starts over.
+        """
+        started = self._started
+        if step == 0:
+            start = now
+        else:
+            start = started[step]
+            if start is None:
+                return False
+            if self._window and now - start > self._window:
+                started[step] = None
+                return False
+        if step == self._last:
+            self.reset()
+            return True
+        nxt = started[step + 1]
+        if nxt is None or start > nxt:
+            started[step + 1] = start
+        return False
+
+    def reset(self):
+        """
+        Forgets the partial sequences.
+        """
+        self._started = [None] * len(self._started)
+
+
+class CountTracker(object):
+    """
+    Incremental state machine of a count rule: the pattern must be seen `count` times
+    within `window` seconds, only the times of the last `count` occurrences are kept.
+    """
+
+    def __init__(self, count, window=0):
+        self._times = deque(maxlen=max(1, count))
+        self._window = window
+
+    def feed(self, step, now):
+        """
+        Counts an occurrence of the pattern.
+        :param step: Always 0, a count rule has a single step.
+        :param now: Time of the line (time.monotonic()).
+        :return: True if the pattern has been seen enough times, the count then starts over.
+        """
+        times = self._times
+        times.append(now)
+        if len(times) == times.maxlen and (not self._window or now - times[0] <= self._window):
+            times.clear()
+            return True
+        return False
+
+    def reset(self):
+        """
+        Forgets the counted occurrences.
+        """
+        self._times.clear()
+
+
+def make_tracker(rule):
+    """
+    Creates the state machine of a multi-line rule.
+    :param rule: ('sequence', (next patterns, ...), window in ms) or ('count', count, window in ms),
+                 a window of 0 means no time limit.
+    :return: SequenceTracker or CountTracker instance.
+    :raise ValueError: If the rule is not valid.
+    """
+    kind, arg, window = rule
+    if kind == 'sequence':
+        return SequenceTracker(len(arg) + 1, window / 1000.0)
+    if kind == 'count':
+        return CountTracker(int(arg), window / 1000.0)
+    raise ValueError("Unknown rule " + str(kind) + ".")
+
+
+LIMITS = ('debounce', 'cooldown', 'rate', 'burst', 'once', 'rearm')
+
+
+class TriggerLimiter(object):
+    """
+    Limits how often a condition fires, to avoid flooding a device looping on an error:
+     - debounce: a trigger is suppressed while the previous one, fired or not, is less than debounce ms old,
+       a storm of lines fires once and the condition fires again only after a quiet period,
+     - cooldown: a trigger is suppressed while the last fired one is less than cooldown ms old,
+     - rate, burst: token bucket, at most burst triggers at once and rate triggers per second on average,
+     - once: the condition fires once, then is disarmed until rearm() (or a line matching its rearm pattern).
+    The suppressed triggers are counted by reason.
+    """
+
+    def __init__(self, debounce=0, cooldown=0, rate=0, burst=0, once=False, rearm=None):
+        self._debounce = debounce / 1000.0
+        self._cooldown = cooldown / 1000.0
+        self._rate = float(rate)
+        self._burst = float(max(1, burst or 1))
+        self._once = once
+        self._tokens = self._burst
+        self._refilled = None
+        self._last_trigger = None
+        self._last_fire = None
+        self._armed = True
+        self.fired = 0
+        self.suppressed = dict((reason, 0) for reason in ('debounce', 'cooldown', 'rate', 'once'))
+
+    def allow(self, now):
+        """
+        Checks a trigger of the condition against the limits.
+        :param now: Time of the line (time.monotonic()).
+        :return: True if the condition can fire, False if the trigger is suppressed.
+        """
+        reason = None
+        last_trigger = self._last_trigger
+        self._last_trigger = now
+        if self._once and not self._armed:
+            reason = 'once'
+        elif self._debounce and last_trigger is not None and now - last_trigger < self._debounce:
+            reason = 'debounce'
+        elif self._cooldown and self._last_fire is not None and now - self._last_fire < self._cooldown:
+            reason = 'cooldown'
+        elif self._rate:
+            if self._refilled is not None:
+                self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self._rate)
+            self._refilled = now
+            if self._tokens < 1:
+                reason = 'rate'
+            else:
+                self._tokens -= 1
+        if reason is not None:
+            self.suppressed[reason] += 1
+            return False
+        self._last_fire = now
+        self._armed = False
+        self.fired += 1
+        return True
+
+    def rearm(self):
+        """
+        Allows a "once" condition to fire again.
+        """
+        self._armed = True
+
+    def is_armed(self):
+        """
+        Tells if a "once" condition can fire.
+        :return: True if the condition is armed.
+        """
+        return self._armed or not self._once
+
+    def get_suppressed(self):
+        """
+        Gets the total number of suppressed triggers.
+        :return: Number of triggers suppressed for any reason.
+        """
+        return sum(self.suppressed.values())
+
+
+def make_limiter(limit):
+    """
+    Creates the limiter of a condition.
+    :param limit: Dict of the limits of the condition, with the keys of LIMITS: debounce and cooldown
+                  in ms, rate in triggers per second, burst, once and the rearm pattern.
+    :return: TriggerLimiter instance, None if the condition has no limit.
+    :raise ValueError: If a limit is not valid.
+    """
+    if not limit:
+        return None
+    unknown = set(limit) - set(LIMITS)
+    if unknown:
+        raise ValueError("Unknown limit " + ", ".join(sorted(unknown)) + ".")
+    values = dict(limit)
+    values.pop('rearm', None)
+    return TriggerLimiter(**values)
+
+
+class Hook(object):
+    """
+    Minimal replacement of a Qt signal, usable without Qt.
+    The connected callables are called in the thread emitting the hook.
+    """
+
+    def __init__(self):
+        self._slots = []
+
+    def __bool__(self):
+        return bool(self._slots)
+
+    def connect(self, slot):
+        """
+        Connects a callable to the hook.
+        :param slot: The callable to call on emit.
+        """
+        self._slots.append(slot)
+
+    def disconnect(self, slot):
+        """
+        Disconnects a callable from the hook.
+        :param slot: The callable to remove.
+        """
+        if slot in self._slots:
+            self._slots.remove(slot)
+
+    def emit(self, *args):
+        """
+        Calls all the connected callables with the given arguments.
+        """
+        for slot in list(self._slots):
+            slot(*args)
+
+
+class LineBuffer(object):
+    """
+    Bounded and thread safe buffer carrying the received lines from the reader
+    thread to the display, which drains it by batches.
+    When the buffer is full the oldest lines are dropped from the display only,
+    the detection has already been done by the reader.
+    """
+    DROP = 'drop'
+    SUMMARISE = 'summarise'
+    POLICIES = (DROP, SUMMARISE)
+
+    def __init__(self, maxlen=10000, policy=DROP):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown overload policy " + str(policy) + ".")
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._maxlen = max(1, int(maxlen))
+        self._policy = policy
+        self._skipped = 0
+        self.pushed = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, item):
+        """
+        Appends an item, dropping the oldest one if the buffer is full.
+        :param item: The item to queue.
+        """
+        with self._lock:
+            if len(self._items) >= self._maxlen:
+                self._items.popleft()
+                self._skipped += 1
+                self.dropped += 1
+            self._items.append(item)
+            self.pushed += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+
+    def drain(self, max_items=None):
+        """
+        Removes and returns the queued items.
+        :param max_items: Maximum number of items to return, None for all of them.
+        :return: (items, skipped) where skipped is the number of items dropped before
+                 the first returned one when the policy is 'summarise', else 0.
+        """
+        with self._lock:
+            if max_items is None or max_items >= len(self._items):
+                items = list(self._items)
+                self._items.clear()
+            else:
+                items = [self._items.popleft() for _ in range(max_items)]
+            skipped = self._skipped
+            self._skipped = 0
+        if self._policy != self.SUMMARISE:
+            skipped = 0
+        return items, skipped
+
+    def get_maxlen(self):
+        """
+        Gets the capacity of the buffer.
+        :return: Maximum number of queued items.
+        """
+        return self._maxlen
+
+    def get_policy(self):
+        """
+        Gets the overload policy of the buffer.
+        :return: 'drop' or 'summarise'.
+        """
+        return self._policy
+
+
+class LineFramer(object):
+    """
+    Incremental splitter turning the chunks of bytes read from the port into lines.
+    The bytes are decoded incrementally, a character split over two reads is kept
+    until completed and invalid bytes are replaced instead of raising.
+    With keep_raw, the bytes are split too and raw_lines holds the bytes of the lines returned
+    by the last feed() or flush(), as received. With an encoding that is not ASCII compatible
+    (UTF-16, ...), the terminator can't be found in the bytes and the lines are encoded back, as
+    the line partially received when keep_raw is set.
+    """
+
+    def __init__(self, terminator='\n', encoding='utf-8'):
+        self._terminator = terminator
+        self._encoding = encoding
+        self._strip_cr = terminator == '\n'
+        self._decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self._pending = ''
+        raw_terminator = terminator.encode(encoding, 'replace')
+        self._raw_terminator = raw_terminator if raw_terminator == terminator.encode('ascii') else None
+        self._raw_pending = b''
+        # The raw pending bytes hold the whole partial line.
+        self._raw_synced = True
+        self.keep_raw = False
+        self.raw_lines = []
+        self.decode_errors = 0
+
+    def feed(self, data):
+        """
+        Processes a chunk of received bytes.
+        :param data: The bytes read from the port.
+        :return: List of the completed lines, without their terminator.
+        """
+        keep_raw = self.keep_raw
+        self.raw_lines = []
+        raw_parts = None
+        if keep_raw and self._raw_terminator is not None:
+            raw_parts = (self._raw_pending + data).split(self._raw_terminator)
+            self._raw_pending = raw_parts.pop()
+        text = self._decoder.decode(data)
+        if not text:
+            return []
+        if '\ufffd' in text:
+            self.decode_errors += text.count('\ufffd')
+        parts = (self._pending + text).split(self._terminator)
+        self._pending = parts.pop()
+        if self._strip_cr:
+            parts = [p[:-1] if p.endswith('\r') else p for p in parts]
+        if keep_raw:
+            if raw_parts is None or len(raw_parts) != len(parts):
+                raw_parts = [p.encode(self._encoding, 'replace') for p in parts]
+            else:
+                if self._strip_cr:
+                    raw_parts = [p[:-1] if p.endswith(b'\r') else p for p in raw_parts]
+                if not self._raw_synced and raw_parts:
+                    raw_parts[0] = parts[0].encode(self._encoding, 'replace')
+            self.raw_lines = raw_parts
+            self._raw_synced = self._raw_synced or bool(parts)
+        else:
+            self._raw_pending = b''
+            self._raw_synced = not self._pending
+        return parts
+
+    def has_pending(self):
+        """
+        Checks if a partial line is waiting for its terminator.
+        :return: True if there is a partial line, or bytes of a partial character.
+        """
+        return bool(self._pending) or bool(self._decoder.getstate()[0])
+
+    def flush(self):
+        """
+        Returns the partial line, used when the device stays idle without ending it.
+        The bytes of a partial character ending the line are replaced, they are not kept for
+        the next line.
+        :return: The partial line, '' if there is none.
+        """
+        tail = self._decoder.decode(b'', final=True)
+        self._decoder.reset()
+        if '\ufffd' in tail:
+            self.decode_errors += tail.count('\ufffd')
+        line = self._pending + tail
+        self._pending = ''
+        if self._strip_cr and line.endswith('\r'):
+            line = line[:-1]
+        self.raw_lines = []
+        if self.keep_raw:
+            raw = self._raw_pending
+            if self._raw_terminator is None or not self._raw_synced:
+                raw = line.encode(self._encoding, 'replace')
+            elif self._strip_cr and raw.endswith(b'\r'):
+                raw = raw[:-1]
+            self.raw_lines = [raw]
+        self._raw_pending = b''
+        self._raw_synced = True
+        return line
+
+    def reset(self):
+        """
+        Drops the partial line and the undecoded bytes.
+        """
+        self._decoder.reset()
+        self._pending = ''
+        self._raw_pending = b''
+        self._raw_synced = True
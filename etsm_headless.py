@@ -0,0 +1,220 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Headless mode of the ETSM: only the detection and trigger engine runs, the
+matches and the events are streamed as NDJSON. Qt is never imported.
+
+$ python3 etsm_headless.py -p /dev/ttyUSB0 -c board.json -o events.ndjson
+"""
+
+import argparse
+from etsm_engine import TERMINATORS
+from etsm_port import (DEFAULT_PORT, Port, PortGroup, add_port_arguments, apply_config, load_config, open_capture,
+                       open_detection_pool, open_event_bus, open_metrics_server, open_trace_log)
+from etsm_scheduler import CommandScheduler
+from etsm_stats import export_latency, wall_time
+from functools import partial
+import json
+import signal
+import sys
+import threading
+import time
+
+
+class NdjsonWriter(object):
+    """
+    Writes one JSON record per line, flushed immediately so that consumers get
+    the records as soon as they happen.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        """
+        Writes a record, the current time is added as "ts" unless the record already has one.
+        :param record: Dict to serialise.
+        """
+        record.setdefault('ts', time.time())
+        data = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._stream.write(data)
+            self._stream.flush()
+
+
+def line_received(writer, port_name, all_lines, line, matches, received):
+    """
+    Writes a matching line, or any line if all_lines is True, "ts" is the time the line was received.
+    """
+    if matches:
+        writer.write({'type': 'match', 'port': port_name, 'line': line,
+                      'matches': [{'rule': key[0], 'id': key[1], 'start': start, 'end': end}
+                                  for key, start, end in matches], 'ts': wall_time(received)})
+    elif all_lines:
+        writer.write({'type': 'line', 'port': port_name, 'line': line, 'ts': wall_time(received)})
+
+
+def event_detected(writer, port_name, event):
+    """
+    Writes an event triggered by a condition.
+    """
+    writer.write({'type': 'event', 'port': port_name, 'event': event})
+
+
+def expect_done(writer, job, result):
+    """
+    Writes the result of an expect step of a script, with its latency in seconds.
+    """
+    record = {'type': 'expect', 'port': job.port.get_port_name(), 'script': job.name}
+    record.update(result)
+    record['latency'] = round(result['latency'], 6)
+    writer.write(record)
+
+
+def workers_stopped(writer, error):
+    """
+    Writes the failure of the detection pool, the rules are searched by the reader thread again.
+    """
+    writer.write({'type': 'workers_stopped', 'error': error})
+
+
+def connection_changed(writer, port_name, connected, gap):
+    """
+    Writes the disconnections and reconnections of a port, with the duration of the gap.
+    """
+    if connected:
+        writer.write({'type': 'reconnect', 'port': port_name, 'gap': round(gap, 6)})
+    else:
+        writer.write({'type': 'disconnect', 'port': port_name})
+
+
+def main(argv=None):
+    """
+    Runs the engine until interrupted or until the requested duration is elapsed.
+    :param argv: Command line options, sys.argv[1:] if None.
+    :return: Exit status.
+    """
+    parser = argparse.ArgumentParser(description='ETSM Tool, headless mode')
+    add_port_arguments(parser)
+    parser.add_argument('--headless', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('-c', '--config', required=False, help='JSON file with patterns, conditions and scripts',
+                        default=None, type=str)
+    parser.add_argument('-o', '--output', required=False, help='NDJSON output file, - for stdout',
+                        default='-', type=str)
+    parser.add_argument('--all-lines', action='store_true', help='Also output the lines which do not match')
+    parser.add_argument('--duration', required=False, help='Stop after this number of seconds, 0 to run forever',
+                        default=0, type=float)
+    parser.add_argument('--latency-report', required=False,
+                        help='Write the trigger latency statistics to this file on exit (.json or .csv)',
+                        default=None, type=str)
+    args = parser.parse_args(argv)
+
+    configs = load_config(args.config) if args.config else [{}]
+    if args.port:
+        # Explicit ports take the configuration with the same name, else the first one.
+        by_name = dict((c.get('port'), c) for c in configs)
+        configs = [dict(by_name.get(name, configs[0]), port=name) for name in args.port]
+    ports = PortGroup()
+    scheduler = CommandScheduler()
+    trace_logs = []
+    out = sys.stdout if args.output == '-' else open(args.output, 'a')
+    writer = NdjsonWriter(out)
+    scheduler.sig_expect_done.connect(partial(expect_done, writer))
+    event_bus = open_event_bus(args)
+    capture = open_capture(args)
+    detection_pool = open_detection_pool(args)
+    if detection_pool is not None:
+        detection_pool.sig_stopped.connect(partial(workers_stopped, writer))
+
+    for config in configs:
+        port_name = config.get('port', DEFAULT_PORT)
+        # An explicit baudrate takes precedence over the configuration file.
+        baudrate = args.baudrate if args.baudrate != parser.get_default('baudrate') else config.get('baudrate',
+                                                                                                     args.baudrate)
+        trace_log = open_trace_log(args, port_name if len(configs) > 1 else None)
+        if trace_log is not None:
+            trace_logs.append(trace_log)
+        port = Port(port_name, baudrate, [], [], None, trace_log, TERMINATORS[args.eol], args.encoding,
+                    args.idle_flush / 1000.0, args.flow_control, args.char_delay / 1000.0, args.line_delay / 1000.0,
+                    args.drain)
+        apply_config(port, config)
+        port.set_scheduler(scheduler)
+        port.set_event_bus(event_bus)
+        port.set_capture(capture)
+        port.set_detection_pool(detection_pool)
+        port.sig_line_received.connect(partial(line_received, writer, port_name, args.all_lines))
+        port.sig_pattern_detected.connect(partial(event_detected, writer, port_name))
+        port.sig_connection_changed.connect(partial(connection_changed, writer, port_name))
+        ports.add(port)
+        writer.write({'type': 'start', 'port': port_name, 'baudrate': baudrate})
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    metrics = open_metrics_server(args, lambda: dict((port.get_port_name(), port.get_stats()) for port in ports))
+    ports.start()
+    for config, port in zip(configs, ports):
+        if config.get('commands'):
+            port.send_script(config['commands'])
+        for script in config.get('scripts', []):
+            port.send_script(script, file=True)
+    stop.wait(args.duration or None)
+    scheduler.stop()
+    ports.close()
+    for port in ports:
+        port.close_port()
+        writer.write({'type': 'stop', 'port': port.get_port_name(), 'latency': port.get_latency().summary(),
+                      'triggers': port.get_trigger_counters(), 'stats': port.get_stats().summary()})
+    if args.latency_report:
+        export_latency(args.latency_report, dict((port.get_port_name(), port.get_latency()) for port in ports))
+    if event_bus is not None:
+        writer.write({'type': 'bus', 'path': event_bus.get_path(), 'subscribers': event_bus.stats()})
+        event_bus.close()
+    if metrics is not None:
+        metrics.close()
+    if detection_pool is not None:
+        writer.write({'type': 'workers', 'workers': detection_pool.stats()})
+        detection_pool.close()
+    if capture is not None:
+        capture.close()
+        writer.write({'type': 'capture', 'path': capture.get_path(), 'records': capture.records,
+                      'bytes': capture.bytes})
+    for trace_log in trace_logs:
+        trace_log.close()
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
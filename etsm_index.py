@@ -0,0 +1,339 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Indexed access to large trace files: the file is memory-mapped and the offsets of its
+lines, as well as the lines matching each searched pattern, are kept in sidecar index
+files so that reopening the trace does not scan it again.
+
+$ python3 etsm_index.py etsm.log --line 1000000 --count 20
+$ python3 etsm_index.py etsm.log --grep "re:ERR code=\d+"
+"""
+
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from etsm_scrollback import FLAG_DETECTED
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+REGEX_PREFIX = 're:'
+MAGIC = b'ETSMIDX2'
+HEADER = struct.Struct('<8sQQI')
+_NEWLINE = re.compile(b'\n')
+_HEAD_SIZE = 4096
+
+
+def compile_pattern(pattern):
+    """
+    Compiles a search pattern, a plain substring or a regular expression prefixed by "re:".
+    :param pattern: The pattern.
+    The regular expression is multi-line, "^" and "$" match at the beginning and end of each line.
+    :return: Compiled bytes regular expression.
+    :raise re.error: If the regular expression is not valid.
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        return re.compile(pattern[len(REGEX_PREFIX):].encode('utf-8'), re.MULTILINE)
+    return re.compile(re.escape(pattern.encode('utf-8')))
+
+
+class TraceIndex(object):
+    """
+    Memory-mapped trace file with a line index, usable as the store of a ConsoleView.
+    The index files are written in a "<trace>.etsmidx" directory next to the trace, or in
+    index_dir. They cover the beginning of the trace, when the trace has grown only the
+    new part is scanned. An index is rebuilt if the beginning of the trace has changed.
+    """
+
+    def __init__(self, path, index_dir=None):
+        self._path = path
+        self._index_dir = index_dir or path + '.etsmidx'
+        self._file = open(path, 'rb')
+        self._mm = None
+        self._size = 0
+        self._head_crc = 0
+        self._starts = array('Q', [0])
+        self._matches = {}
+        self._open_map()
+        self._starts, self._lines_end = self._load_index('lines', self._build_lines)
+
+    def __len__(self):
+        count = len(self._starts) - 1
+        return count + 1 if self._size > self._starts[-1] else count
+
+    def _open_map(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._head_crc = zlib.crc32(self._mm[:_HEAD_SIZE]) if self._mm is not None else 0
+
+    def _index_path(self, name):
+        return os.path.join(self._index_dir, name)
+
+    def _load_index(self, name, build):
+        """
+        Loads an index from its sidecar file, rebuilds it if it does not match the trace.
+        :param name: Name of the index file.
+        :param build: Function (values, start offset) scanning the trace from the offset and
+                      completing the values, returns the offset up to which the trace is indexed.
+        :return: (array of the index, offset up to which the trace is indexed).
+        """
+        try:
+            with open(self._index_path(name), 'rb') as f:
+                magic, indexed, count, head_crc = HEADER.unpack(f.read(HEADER.size))
+                if magic == MAGIC and head_crc == self._head_crc and indexed <= self._size:
+                    values = array('Q')
+                    values.fromfile(f, count)
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                    return self._extend_index(name, values, indexed, build)
+        except (OSError, EOFError, struct.error):
+            pass
+        return self._extend_index(name, array('Q'), None, build)
+
+    def _extend_index(self, name, values, indexed, build):
+        """
+        Scans the part of the trace following an index and saves the index if it changed.
+        :param indexed: Offset up to which the trace is indexed, None for a new index.
+        :return: (array of the index, offset up to which the trace is indexed).
+        """
+        if indexed is None or indexed < self._size:
+            end = build(values, indexed or 0)
+            if end != indexed:
+                self._save_index(name, values, end)
+            indexed = end
+        return values, indexed
+
+    def _save_index(self, name, values, indexed):
+        """
+        Writes an index file atomically, the trace stays usable if the directory is read-only.
+        """
+        try:
+            os.makedirs(self._index_dir, exist_ok=True)
+            tmp = self._index_path(name) + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, indexed, len(values), self._head_crc))
+                if sys.byteorder == 'big':
+                    values = array('Q', values)
+                    values.byteswap()
+                values.tofile(f)
+            os.replace(tmp, self._index_path(name))
+        except OSError as e:
+            print("Can't save index " + self._index_path(name) + ": " + str(e))
+
+    def _build_lines(self, starts, offset):
+        """
+        Appends the start offset of each line found after offset, the last value is the
+        offset following the last complete line.
+        """
+        if not starts:
+            starts.append(0)
+            offset = 0
+        if self._mm is not None:
+            starts.extend(m.end() for m in _NEWLINE.finditer(self._mm, offset))
+        return starts[-1]
+
+    def refresh(self):
+        """
+        Takes into account the lines appended to the trace since it was opened.
+        :return: Number of lines of the trace.
+        """
+        head_crc = self._head_crc
+        self._open_map()
+        if head_crc != self._head_crc or self._size < self._lines_end:
+            # The trace has been replaced, all its indexes are rebuilt.
+            self._starts, self._lines_end = self._extend_index('lines', array('Q'), None, self._build_lines)
+            self._matches = {}
+            return len(self)
+        self._starts, self._lines_end = self._extend_index('lines', self._starts, self._lines_end,
+                                                           self._build_lines)
+        for pattern, (lines, indexed) in list(self._matches.items()):
+            self._matches[pattern] = self._extend_index(self._match_name(pattern), lines, indexed,
+                                                        self._pattern_builder(compile_pattern(pattern)))
+        return len(self)
+
+    def _line_bytes(self, index):
+        start = self._starts[index]
+        if index + 1 < len(self._starts):
+            return self._mm[start:self._starts[index + 1] - 1]
+        return self._mm[start:self._size]
+
+    def get(self, index):
+        """
+        Gets a line of the trace.
+        :param index: Index of the line, from 0.
+        :return: (line, flags), FLAG_DETECTED is set for the records of a trace log marked as matched.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        text = self._line_bytes(index).rstrip(b'\r').decode('utf-8', 'replace')
+        fields = text.split('\t', 2)
+        return text, FLAG_DETECTED if len(fields) == 3 and fields[1] == 'M' else 0
+
+    def get_range(self, start, stop):
+        """
+        Gets consecutive lines of the trace.
+        :param start: Index of the first line.
+        :param stop: Index after the last line, clipped to the number of lines.
+        :return: List of (line, flags).
+        """
+        return [self.get(index) for index in range(max(0, start), min(stop, len(self)))]
+
+    def get_spans(self, start, stop):
+        """
+        Gets the highlighted spans of consecutive lines, a trace file only records whole matched lines.
+        :param start: Index of the first line.
+        :param stop: Index after the last line.
+        :return: Empty dict.
+        """
+        return {}
+
+    def get_times(self, start, stop):
+        """
+        Gets the receive timestamps of consecutive lines, the timestamps of a trace log are part of its text.
+        :return: None.
+        """
+        return None
+
+    def last_match_time(self, index):
+        """
+        Gets the receive timestamp of the last matched line before a line.
+        :return: None, the trace has no receive timestamps.
+        """
+        return None
+
+    def _pattern_builder(self, regex):
+        def build(lines, offset):
+            starts = self._starts
+            end = starts[-1] if self._size == starts[-1] else self._size
+            if self._mm is None:
+                return 0
+            pos = offset
+            while True:
+                m = regex.search(self._mm, pos, end)
+                if m is None:
+                    break
+                line = bisect_right(starts, m.start()) - 1
+                stop = starts[line + 1] - 1 if line + 1 < len(starts) else end
+                # A match must be within its line, as with LineFilter, the line is searched
+                # alone when the match spans a newline.
+                if m.end() <= stop or regex.search(self._mm, starts[line], stop) is not None:
+                    lines.append(line)
+                if line + 1 >= len(starts):
+                    break
+                pos = starts[line + 1]
+            # A partial last line is searched again once completed.
+            if end > starts[-1]:
+                if lines and lines[-1] == len(starts) - 1:
+                    lines.pop()
+                return starts[-1]
+            return end
+        return build
+
+    def matches(self, pattern):
+        """
+        Gets the lines matching a pattern, from its index file or by scanning the trace once.
+        :param pattern: A substring, or a regular expression prefixed by "re:".
+        :return: Sorted array of the indexes of the matching lines.
+        :raise re.error: If the regular expression is not valid.
+        """
+        if pattern not in self._matches:
+            self._matches[pattern] = self._load_index(self._match_name(pattern),
+                                                      self._pattern_builder(compile_pattern(pattern)))
+        return self._matches[pattern][0]
+
+    def _match_name(self, pattern):
+        return 'match-' + hashlib.sha1(pattern.encode('utf-8')).hexdigest()
+
+    def next_match(self, pattern, index, backward=False):
+        """
+        Finds the next line matching a pattern.
+        :param pattern: A substring, or a regular expression prefixed by "re:".
+        :param index: The search starts after this line (before it if backward).
+        :param backward: True to search towards the beginning of the trace.
+        :return: Index of the matching line, None if there is none.
+        """
+        lines = self.matches(pattern)
+        if backward:
+            pos = bisect_left(lines, index) - 1
+            return lines[pos] if pos >= 0 else None
+        pos = bisect_right(lines, index)
+        return lines[pos] if pos < len(lines) else None
+
+    def get_path(self):
+        """
+        Gets the path of the trace.
+        :return: Path of the trace file.
+        """
+        return self._path
+
+    def close(self):
+        """
+        Unmaps and closes the trace.
+        """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Indexed access to an ETSM trace file')
+    parser.add_argument('trace', help='Trace file, for example a --log file')
+    parser.add_argument('--line', type=int, default=None, help='Print the lines from this one (from 1)')
+    parser.add_argument('--count', type=int, default=1, help='Number of lines printed with --line')
+    parser.add_argument('--grep', default=None, help='Print the matching lines, "re:" prefix for a regular expression')
+    parser.add_argument('--index-dir', default=None, help='Directory of the index files (default <trace>.etsmidx)')
+    args = parser.parse_args()
+    index = TraceIndex(args.trace, args.index_dir)
+    if args.line is not None:
+        for n, (text, flags) in enumerate(index.get_range(args.line - 1, args.line - 1 + args.count), args.line):
+            print(str(n) + ':' + text)
+    if args.grep is not None:
+        try:
+            matching = index.matches(args.grep)
+        except re.error as e:
+            print("Invalid regular expression " + args.grep + ": " + str(e))
+            sys.exit(1)
+        for n in matching:
+            print(str(n + 1) + ':' + index.get(n)[0])
+    if args.line is None and args.grep is None:
+        print(str(len(index)) + " lines")
+    index.close()
@@ -0,0 +1,1600 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Serial port handling of the ETSM, independent from the graphical interface so
+that it can also run headless.
+"""
+
+from etsm_capture import FLAG_CONDITION, FLAG_MATCH, CaptureWriter
+from etsm_engine import (Hook, LIMITS, LineFramer, PatternMatcher, RegexMatcher, TERMINATORS, expand_groups,
+                         make_limiter, make_tracker, search_rules)
+from etsm_scheduler import CommandScheduler, parse_script
+from etsm_stats import LatencyStats, PortStats, wall_time
+from etsm_tracelog import COMPRESSIONS, TraceLog
+import codecs
+from collections import deque
+import json
+import os
+import re
+import selectors
+import serial
+import sys
+import threading
+import time
+
+
+DEFAULT_PORT = '/dev/ttyUSB0'
+REGEX_PREFIX = 're:'
+RECONNECT_INTERVAL = 0.002
+FLOW_CONTROLS = ('none', 'rtscts', 'xonxoff')
+
+
+def find_available_ports():
+    """
+    Detect, parse and store all the ports detected/connected to the PC.
+    :return: array containing all the ports
+    """
+    from serial.tools import list_ports
+    ports = []
+    raw_ports = list(list_ports.comports())
+    for p in raw_ports:
+        ports.append(p[0])
+    return ports
+
+
+class Port(object):
+    """
+    Class emulating the communication with a given port.
+    The traces are read by a dedicated thread started with start().
+    """
+
+    def __init__(self, port_name, baudrate, pattern, command, display_buffer=None, trace_log=None,
+                 terminator='\n', encoding='utf-8', idle_flush=0.2, flow_control='none', char_delay=0,
+                 line_delay=0, drain=False):
+        self.sig_clean_command_area = Hook()
+        self.sig_pattern_detected = Hook()
+        self.sig_line_received = Hook()
+        self.sig_connection_changed = Hook()
+        self._port = None
+        self._lost_at = None
+        self._thread = None
+        self._group = None
+        self._scheduler = None
+        self._event_bus = None
+        self._capture = None
+        self._detection_pool = None
+        self._detecting = deque()
+        self._last_rx = time.monotonic()
+        self._encoding = encoding
+        self._framer = LineFramer(terminator, encoding)
+        self._idle_flush = idle_flush
+        self._display_buffer = display_buffer
+        self._trace_log = trace_log
+        self._port_name = port_name
+        self._baudrate = str(baudrate)
+        self._pattern = pattern
+        self._command = command
+        self._conditions = {}
+        self._trackers = {}
+        self._tracker_rules = {}
+        self._limiters = {}
+        self._limiter_limits = {}
+        self._matcher = PatternMatcher()
+        self._regex_matcher = RegexMatcher()
+        self._has_rules = False
+        self._latency = LatencyStats()
+        self._stats = PortStats()
+        self._flow_control = flow_control
+        self._writer = WriteQueue(self.get_port, self._stats, port_name)
+        self._writer.set_pacing(char_delay, line_delay, drain)
+        self._writer.direct = flow_control == 'none'
+        self._t_read = 0
+        self._t_decode = 0
+        self.exit = False
+
+        self.compile_rules()
+        self.open_port()
+
+    def run(self):
+        """
+        Collects every lines sent trought the port, check if the line matches
+        with entered pattern and/or condition and queues the line to be displayed.
+        Only used when the port is not part of a PortGroup.
+        If the device disappears, it is reopened as soon as it is back.
+        """
+        while not self.exit:
+            try:
+                if self._detecting and not self._port.in_waiting:
+                    self._detecting[0][0].wait(self._port.timeout)
+                    self.process_detected()
+                elif not self.read_available():
+                    self.flush_idle(time.monotonic())
+            except (serial.SerialException, TypeError, OSError):
+                self.disconnected()
+                while not self.exit and not self.reconnect():
+                    time.sleep(RECONNECT_INTERVAL)
+
+    def read_available(self, now=None):
+        """
+        Reads all the bytes waiting in the port at once and processes the completed lines.
+        With a detection pool, the lines are submitted to the workers and processed by
+        process_detected() once searched, the conditions are still fired here in the order
+        of the lines. A small batch is searched here when nothing of the port is being searched.
+        Blocks up to the port timeout if nothing is waiting.
+        :param now: Current time.monotonic(), read if None.
+        :return: Number of bytes read.
+        """
+        data = self._port.read(self._port.in_waiting or 1)
+        if data:
+            self._t_read = time.perf_counter_ns()
+            self._last_rx = now if now is not None else time.monotonic()
+            lines = self._framer.feed(data)
+            self._t_decode = time.perf_counter_ns()
+            self._stats.record_read(len(data), len(lines), self._last_rx)
+            self._stats.decode_errors = self._framer.decode_errors
+            raw_lines = self._framer.raw_lines
+            pool = self._detection_pool
+            if (pool is not None and self._has_rules and lines and
+                    (self._detecting or len(lines) >= pool.min_batch)):
+                batch = pool.submit(id(self), lines)
+                if batch is not None:
+                    self._detecting.append((batch, lines, raw_lines, self._t_read, self._t_decode, self._last_rx))
+                    lines = []
+                else:
+                    # The pool stopped, the lines submitted before are processed first.
+                    self.process_detected(True)
+            for index, line in enumerate(lines):
+                self.process_line(line, None, raw_lines[index] if raw_lines else None)
+        self.process_detected()
+        return len(data)
+
+    def process_detected(self, wait=False):
+        """
+        Processes the batches of lines searched by the detection pool, in their order.
+        The lines of a batch the pool could not search are searched here.
+        :param wait: True to wait until all the submitted batches are processed.
+        :return: True if no batch is left to process.
+        """
+        if not self._detecting:
+            return True
+        current = (self._t_read, self._t_decode, self._last_rx)
+        while self._detecting:
+            batch, lines, raw_lines, t_read, t_decode, last_rx = self._detecting[0]
+            if not batch.is_done() and not (wait and batch.wait()):
+                break
+            self._detecting.popleft()
+            found = batch.get_results()
+            self._t_read, self._t_decode, self._last_rx = t_read, t_decode, last_rx
+            for index, line in enumerate(lines):
+                line_found = None if found is None else found[index] or ([], None)
+                self.process_line(line, line_found, raw_lines[index] if raw_lines else None)
+        self._t_read, self._t_decode, self._last_rx = current
+        return not self._detecting
+
+    def flush_idle(self, now):
+        """
+        Processes the partial line once the port stays idle for idle_flush seconds.
+        :param now: Current time.monotonic().
+        """
+        # The partial line follows the lines still being searched.
+        if (self._idle_flush and self._framer.has_pending() and now - self._last_rx >= self._idle_flush and
+                self.process_detected()):
+            self._t_read = self._t_decode = time.perf_counter_ns()
+            self._stats.record_read(0, 1, now)
+            self._process_flushed()
+
+    def _process_flushed(self):
+        line = self._framer.flush()
+        self.process_line(line, raw=self._framer.raw_lines[0] if self._framer.raw_lines else None)
+
+    def process_line(self, line, found=None, raw=None):
+        """
+        Detects, logs and queues for display a received line.
+        The line is timestamped with the time its last bytes were read (time.perf_counter_ns()).
+        :param line: The line received, without its terminator.
+        :param found: (matches, captures) already searched by the detection pool, None to search the line.
+        :param raw: The bytes of the line as received, written to the capture instead of the line.
+        """
+        ret = self.detect(line, found) if self._has_rules else None
+        received = self._t_read
+        if ret:
+            self._stats.record_matches(ret, line, received, self._last_rx)
+        if self._trace_log is not None:
+            self._trace_log.write(line, bool(ret), wall_time(received))
+        if self._capture is not None:
+            flags = 0
+            if ret:
+                flags = FLAG_MATCH
+                if any(key[0] != 'pattern' for key, start, end in ret):
+                    flags |= FLAG_CONDITION
+            self._capture.write(self._port_name, line if raw is None else raw, flags, received, self._encoding)
+        if self._display_buffer is not None:
+            self._display_buffer.push((line, ret, received))
+        if self.sig_line_received:
+            self.sig_line_received.emit(line, ret or [], received)
+
+    def start(self):
+        """
+        Starts the reader thread.
+        """
+        self.exit = False
+        self._thread = threading.Thread(target=self.run, name='etsm-rx-' + self._port_name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the reader thread and waits for it.
+        """
+        self.exit = True
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def detect(self, line, found=None):
+        """
+        Check if the line is matches with a pattern/condition and send
+        the corresponding event.
+        All the patterns and conditions are searched in a single pass over the line,
+        each triggered condition fires once, in the order of its first occurrence.
+        The groups captured by a regex condition are substituted into its action.
+        A sequence or count condition only fires when its state machine completes, the groups
+        substituted are then the ones of the line completing it.
+        A condition with limits only fires if its limiter allows it, a line matching its rearm
+        pattern rearms it.
+        The latency of each stage is measured from the read of the bytes holding the line.
+        :param line: the line to process
+        :param found: (matches, captures) already searched by the detection pool, None to search the line.
+        :return: List of (key, start, end) matches, empty if nothing matched. The key is
+                 ('pattern', pattern), ('condition', cond_id), ('step', cond_id, step) for
+                 the next steps of a sequence or ('rearm', cond_id) for a rearm pattern.
+        """
+        if found is None:
+            found = search_rules(self._matcher, self._regex_matcher, line)
+        matches, captures = found
+        t_read = self._t_read
+        self._latency.record_line(t_read, self._t_decode, time.perf_counter_ns())
+        fired = set()
+        fed = None
+        for key, start, end in matches:
+            if key[0] == 'rearm':
+                limiter = self._limiters.get(key[1])
+                if limiter is not None:
+                    limiter.rearm()
+            elif key[0] != 'pattern' and key[1] not in fired:
+                cond = self._conditions.get(key[1])
+                if cond is None:
+                    continue
+                tracker = self._trackers.get(key[1])
+                if tracker is not None:
+                    # Each step counts once per line.
+                    if fed is None:
+                        fed = set()
+                    if key in fed:
+                        continue
+                    fed.add(key)
+                    if not tracker.feed(key[2] if key[0] == 'step' else 0, self._last_rx):
+                        continue
+                fired.add(key[1])
+                limiter = self._limiters.get(key[1])
+                if limiter is not None and not limiter.allow(self._last_rx):
+                    continue
+                action = cond[1]
+                if captures and key in captures:
+                    action = expand_groups(action, *captures[key])
+                t_dispatch = time.perf_counter_ns()
+                if cond[2] == 'Event':
+                    self.sig_pattern_detected.emit(action)
+                    if self._event_bus is not None:
+                        self._event_bus.publish(action, self._port_name, line)
+                    self._latency.record_action(key[1], t_read, t_dispatch, time.perf_counter_ns())
+                else:
+                    # The command completes when its write queue has written it.
+                    self.route_command(action, cond[3], (self._latency, key[1], t_read, t_dispatch))
+        return matches
+
+    def route_command(self, command, target=None, latency=None):
+        """
+        Sends a command to the current port or to another port of the same group.
+        :param command: The command to send.
+        :param target: Name of the port to send the command to, None for the current port.
+        :param latency: Optional latency context of the condition sending the command, see WriteQueue.put.
+        """
+        if target is None or target == self._port_name:
+            self.send_command(command, latency)
+        elif self._group is None or not self._group.send_command(target, command, latency):
+            print("Can't send command to port " + target + ".")
+
+    def compile_rules(self):
+        """
+        Rebuilds the matchers from the current patterns and conditions.
+        Must be called every time the rule set changes.
+        Patterns starting with "re:" and regex conditions are regular expressions, the
+        invalid ones are reported and ignored.
+        """
+        keywords = []
+        regex = []
+        for pat in self._pattern:
+            if pat.startswith(REGEX_PREFIX):
+                regex.append((('pattern', pat), pat[len(REGEX_PREFIX):]))
+            else:
+                keywords.append((('pattern', pat), pat))
+        trackers = {}
+        limiters = {}
+        for cond_id, cond in self._conditions.items():
+            rules = regex if cond[4] else keywords
+            rules.append((('condition', cond_id), cond[0]))
+            limit = cond[6]
+            if limit:
+                if limit.get('rearm'):
+                    rules.append((('rearm', cond_id), limit['rearm']))
+                # The counters and the state of unchanged limits are kept.
+                if self._limiter_limits.get(cond_id) == limit:
+                    limiters[cond_id] = self._limiters[cond_id]
+                else:
+                    try:
+                        limiters[cond_id] = make_limiter(limit)
+                    except (TypeError, ValueError) as e:
+                        print("Invalid limits of condition " + str(cond_id) + ": " + str(e))
+            rule = cond[5]
+            if rule is None:
+                continue
+            if rule[0] == 'sequence':
+                for step, pattern in enumerate(rule[1], 1):
+                    rules.append((('step', cond_id, step), pattern))
+            # The progress of an unchanged rule is kept.
+            if self._tracker_rules.get(cond_id) == rule:
+                trackers[cond_id] = self._trackers[cond_id]
+            else:
+                trackers[cond_id] = make_tracker(rule)
+        self._trackers = trackers
+        self._tracker_rules = dict((cond_id, self._conditions[cond_id][5]) for cond_id in trackers)
+        self._limiters = limiters
+        self._limiter_limits = dict((cond_id, dict(self._conditions[cond_id][6])) for cond_id in limiters)
+        valid = []
+        for key, pattern in regex:
+            try:
+                re.compile(pattern)
+                valid.append((key, pattern))
+            except re.error as e:
+                print("Invalid regular expression " + pattern + ": " + str(e))
+        self._matcher = PatternMatcher(keywords)
+        self._regex_matcher = RegexMatcher(valid)
+        self._has_rules = bool(self._matcher or self._regex_matcher)
+        self._stats.set_rules([('pattern', pat) for pat in self._pattern] +
+                              [('condition', cond_id) for cond_id in self._conditions])
+        if self._detection_pool is not None:
+            self._detection_pool.set_rules(id(self), keywords, valid)
+
+    def open_port(self):
+        """
+        Open the port with specified name and baudrate.
+        The name can also be a pyserial URL, as loop:// or socket://host:port.
+        The flow control is handled by the driver, a write waits for the device to be ready.
+        """
+        try:
+            timeout = min(0.1, self._idle_flush) if self._idle_flush else 0.1
+            self._port = serial.serial_for_url(self._port_name, self._baudrate, timeout=timeout,
+                                               rtscts=self._flow_control == 'rtscts',
+                                               xonxoff=self._flow_control == 'xonxoff')
+        except serial.SerialException:
+            print("Can't open port " + self._port_name + ".")
+            sys.exit()
+
+    def close_port(self):
+        self._writer.close()
+        self._port.close()
+        if self._detection_pool is not None:
+            self._detection_pool.discard_rules(id(self))
+
+    def is_connected(self):
+        """
+        Checks if the device of the port is present.
+        :return: False between a disconnection and the reconnection.
+        """
+        return self._lost_at is None
+
+    def disconnected(self):
+        """
+        Handles the disappearance of the device: the lines being searched and the partial line
+        are processed, the port is closed and the disconnection is recorded in the trace log.
+        """
+        if self._lost_at is not None:
+            return
+        self.process_detected(True)
+        if self._framer.has_pending():
+            self._process_flushed()
+        self._framer.reset()
+        try:
+            self._port.close()
+        except (serial.SerialException, OSError):
+            pass
+        self._lost_at = time.monotonic()
+        print("Port " + self._port_name + " disconnected.")
+        if self._trace_log is not None:
+            self._trace_log.write_event("Port " + self._port_name + " disconnected")
+        if self._capture is not None:
+            self._capture.write_event(self._port_name, "Port " + self._port_name + " disconnected",
+                                      encoding=self._encoding)
+        self.sig_connection_changed.emit(False, 0.0)
+
+    def reconnect(self, port_name=None):
+        """
+        Reopens the device of the port after a disconnection. The traces already sent by the
+        device are read and processed at once, before the port is read again by its reader.
+        :param port_name: New path of the device, None to reopen the same path.
+        :return: True if the port is open again.
+        """
+        path = port_name or self._port_name
+        if path.startswith('/') and not os.path.exists(path):
+            return False
+        try:
+            if port_name is not None and port_name != self._port_name:
+                self._port.port = port_name
+            self._port.open()
+        except (serial.SerialException, OSError, ValueError):
+            return False
+        gap = time.monotonic() - self._lost_at if self._lost_at is not None else 0.0
+        self._lost_at = None
+        self._last_rx = time.monotonic()
+        text = "Port " + self._port_name + " reconnected"
+        if path != self._port_name:
+            text += " as " + path
+            self._port_name = path
+        text += " after " + format(gap, '.3f') + " s"
+        print(text + ".")
+        if self._trace_log is not None:
+            self._trace_log.write_event(text)
+        if self._capture is not None:
+            self._capture.write_event(self._port_name, text, encoding=self._encoding)
+        self.sig_connection_changed.emit(True, gap)
+        try:
+            while self._port.in_waiting:
+                self.read_available()
+        except (serial.SerialException, TypeError, OSError):
+            pass
+        return True
+
+    def send_command(self, command, latency=None):
+        """
+        Send the command to the current port, through its write queue.
+        A port disconnected or closed is reported, the command is dropped.
+        :param command: The command to send.
+        :param latency: Optional latency context of the condition sending the command, see WriteQueue.put.
+        :return: True if the command is written or queued.
+        """
+        if not self._port.is_open:
+            print("Can't send command " + command + ", port " + self._port_name + " is not open.")
+            return False
+        try:
+            self._writer.put((command+"\r").encode(self._encoding), latency)
+        except (serial.SerialException, TypeError, OSError) as e:
+            print("Can't send command " + command + " to port " + self._port_name + ": " + str(e))
+            return False
+        return True
+
+    def send_script(self, script, file=False):
+        """
+        Send a script or a set of command to the current port.
+        Parse it and hands it to the command scheduler, the call returns immediately.
+        "delay <duration>" lines pause the script: "delay 2" or "delay 2s" for seconds,
+        "delay 250ms" for milliseconds. "expect <pattern> <timeout ms>" lines wait for a
+        received line, "send_and_expect <command> <pattern> <timeout ms>" sends a command and
+        waits for its answer, see etsm_scheduler.parse_expect().
+        :param script: File or set of command to send.
+        :param file: True if the script is a file to read, else False.
+        :return: The ScriptJob following the script, None if the script can't be read.
+        """
+        if file:
+            try:
+                with open(script, mode='r') as f:
+                    steps = parse_script(f.readlines())
+            except IOError:
+                print("Can't read script " + script + ".")
+                return None
+            name = script
+        else:
+            steps = parse_script(script)
+            name = "commands"
+        if self._scheduler is None:
+            self._scheduler = CommandScheduler()
+        return self._scheduler.submit(self, steps, name)
+
+    def command_manager(self, text):
+        """
+        Get the command entered by the user, if a script name is detected
+        calls the function that handles script, else send the single command.
+        :param text: The string entered by the user, can be a command, or a file/script.
+        """
+        if text:
+            if len(text.split('.')) > 1:
+                if text.split('.')[1] == ('txt' or 'sh'):
+                    self.send_script(text, file=True)
+                else:
+                    print('bad extension')
+            else:
+                self.send_command(text)
+            self.sig_clean_command_area.emit()
+
+    def pattern_manager(self, text):
+        """
+        Add the pattern entered by the user to the existing pattern array.
+        :param text: The new pattern to detect
+        """
+        if text:
+            if text not in self._pattern:
+                self._pattern.append(text)
+                self.compile_rules()
+
+    def change_baudrate(self, new_baudrate):
+        """
+        Update the baudrate of the current port.
+        :param new_baudrate: Baudrate requested by the user.
+        :return: 1 if new baudrate is updated, 0 if no update.
+        """
+        if new_baudrate != self._baudrate:
+            self._baudrate = new_baudrate
+            self._port.baudrate = self._baudrate
+            return 1
+        else:
+            return 0
+
+    def change_port(self, new_port_name):
+        """
+        Update the current port.
+        :param new_port_name: New port name requested by the user.
+        :return: 1 if new port is updated, 0 if no update.
+        """
+        if new_port_name != self._port_name:
+            self._port_name = new_port_name
+            self._port.port = self._port_name
+            if self._group is not None:
+                self._group.refresh(self)
+            return 1
+        else:
+            return 0
+
+    def save_traces(self, filename, traces):
+        """
+        Saves all the traces (within the console area ) of the current port in a file.
+        :param filename: The file where to save the traces.
+        :param traces: The traces to save, a string or an iterable of strings.
+        """
+        with open(filename, 'w') as f:
+            if isinstance(traces, str):
+                f.write(traces)
+            else:
+                f.writelines(traces)
+
+    def get_pattern(self):
+        """
+        Gets the patterns of the current port outside the class.
+        :return: the patterns of the current port to detect.
+        """
+        return self._pattern
+
+    def set_pattern(self, pattern):
+        """
+        Erases and updates the patterns to detect outside the class.
+        :param pattern: The new patterns to detect.
+        """
+        self._pattern = pattern
+        self.compile_rules()
+
+    def add_pattern(self, pattern):
+        """
+        Adds a new pattern to detect outside the class.
+        :param pattern: The pattern to add.
+        """
+        self._pattern.append(pattern)
+        self.compile_rules()
+
+    def del_pattern(self):
+        """
+        Deletes the patterns to detect.
+        """
+        self._pattern = []
+        self.compile_rules()
+
+    def get_command(self):
+        """
+        Gets the command to send of the current port outside the class.
+        :return:
+        """
+        return self._command
+
+    def set_command(self, command):
+        """
+        Erases and updates the commands to send outside the class.
+        :param command: Commands to send.
+        """
+        self._command = command
+
+    def add_command(self, command):
+        """
+        Adds a new command to send outside the class.
+        :param command: The command to send.
+        """
+        self._command.append(command)
+
+    def del_command(self):
+        """
+        Deletes all the commands to send.
+        """
+        self._command = []
+
+    def get_port_name(self):
+        """
+        Gets the current port's name outside the class.
+        :return: The name of the port.
+        """
+        return self._port_name
+
+    def set_port_name(self, port_name):
+        """
+        Updates the name of the current port outside the class.
+        :param port_name: The new name of the port.
+        """
+        self._port_name = port_name
+
+    def get_display_buffer(self):
+        """
+        Gets the buffer of lines waiting to be displayed outside the class.
+        :return: LineBuffer instance, None if the lines are not displayed.
+        """
+        return self._display_buffer
+
+    def get_trace_log(self):
+        """
+        Gets the continuous trace log of the current port outside the class.
+        :return: TraceLog instance, None if the traces are not logged.
+        """
+        return self._trace_log
+
+    def get_latency(self):
+        """
+        Gets the trigger latency statistics of the current port outside the class.
+        :return: LatencyStats instance.
+        """
+        return self._latency
+
+    def get_stats(self):
+        """
+        Getter of the counters of the port and of its rules.
+        :return: PortStats instance.
+        """
+        return self._stats
+
+    def get_write_queue(self):
+        """
+        Getter of the queue of the commands written to the port.
+        :return: WriteQueue instance.
+        """
+        return self._writer
+
+    def get_flow_control(self):
+        """
+        Getter of the flow control of the port.
+        :return: One of FLOW_CONTROLS.
+        """
+        return self._flow_control
+
+    def set_flow_control(self, flow_control):
+        """
+        Setter of the flow control of the port, applied to the open port.
+        :param flow_control: One of FLOW_CONTROLS.
+        """
+        self._flow_control = flow_control
+        self._port.rtscts = flow_control == 'rtscts'
+        self._port.xonxoff = flow_control == 'xonxoff'
+        # A flow controlled write may block until the device is ready, so it is left to the queue thread.
+        self._writer.direct = flow_control == 'none'
+
+    def get_scheduler(self):
+        """
+        Gets the scheduler running the scripts of the current port outside the class.
+        :return: CommandScheduler instance, None until a script is sent.
+        """
+        return self._scheduler
+
+    def set_scheduler(self, scheduler):
+        """
+        Sets the scheduler running the scripts of the current port, it can be shared by several ports.
+        :param scheduler: CommandScheduler instance.
+        """
+        self._scheduler = scheduler
+
+    def get_event_bus(self):
+        """
+        Gets the bus the events of the current port are published on outside the class.
+        :return: EventBus instance, None if the events are not published.
+        """
+        return self._event_bus
+
+    def set_event_bus(self, event_bus):
+        """
+        Publishes the events of the current port on a bus, it can be shared by several ports.
+        :param event_bus: EventBus instance, None to stop publishing.
+        """
+        self._event_bus = event_bus
+
+    def get_capture(self):
+        """
+        Gets the capture the lines of the current port are written to outside the class.
+        :return: CaptureWriter instance, None if the lines are not captured.
+        """
+        return self._capture
+
+    def set_capture(self, capture):
+        """
+        Writes the received lines of the current port to a binary capture, it can be shared by several ports.
+        The lines are captured as the bytes received.
+        :param capture: CaptureWriter instance, None to stop capturing.
+        """
+        self._capture = capture
+        self._framer.keep_raw = capture is not None
+
+    def get_detection_pool(self):
+        """
+        Getter of the detection pool searching the rules of the port.
+        :return: DetectionPool instance, None if the rules are searched by the reader thread.
+        """
+        return self._detection_pool
+
+    def set_detection_pool(self, detection_pool):
+        """
+        Setter of the detection pool searching the rules of the port.
+        :param detection_pool: DetectionPool instance, None to search the rules in the reader thread.
+        """
+        if self._detection_pool is not None:
+            self._detection_pool.discard_rules(id(self))
+        self._detection_pool = detection_pool
+        self.compile_rules()
+
+    def get_group(self):
+        """
+        Gets the group the current port belongs to outside the class.
+        :return: PortGroup instance, None if the port is read by its own thread.
+        """
+        return self._group
+
+    def set_group(self, group):
+        """
+        Attaches the current port to a group, or detaches it with None.
+        :param group: PortGroup instance or None.
+        """
+        self._group = group
+
+    def get_port(self):
+        """
+        Gets the instance of the current port outside the class.
+        :return: Port instance.
+        """
+        return self._port
+
+    def get_baudrate(self):
+        """
+        Gets the baudrate of the current port outside the class.
+        :return: Port baudrate.
+        """
+        return self._baudrate
+
+    def add_condition(self, cond_id, pattern, action, type, target=None, regex=False, rule=None, limit=None):
+        """
+        Adds new condition for the current port.
+        :param cond_id: ID number of the condition.
+        :param pattern: Pattern of the condition to detect.
+        :param action: Name of the action to trigger, may refer to the groups of a regex (\\1, \\g<name>).
+        :param type: Type of the action to trigger, command or event.
+        :param target: Name of the port receiving the command, None for the current port.
+        :param regex: True if the pattern is a regular expression.
+        :param rule: None to fire on every matching line, ('sequence', (next patterns, ...), window ms)
+                     to fire when the pattern is followed by the next ones, ('count', count, window ms)
+                     to fire when the pattern is seen count times. A window of 0 means no time limit.
+        :param limit: None, or dict limiting how often the condition fires: debounce and cooldown in ms,
+                      rate in triggers per second with a burst, once to fire only until rearmed by
+                      rearm_condition() or by a line matching the rearm pattern.
+        """
+        self._conditions[cond_id] = [pattern, action, type, target, regex, rule, limit]
+        self.compile_rules()
+
+    def rearm_condition(self, cond_id):
+        """
+        Allows a condition limited to fire once to fire again.
+        :param cond_id: ID number of the condition.
+        """
+        limiter = self._limiters.get(cond_id)
+        if limiter is not None:
+            limiter.rearm()
+
+    def get_trigger_counters(self):
+        """
+        Gets the number of fired and suppressed triggers of the limited conditions.
+        :return: Dict {cond_id: {'fired': n, 'suppressed': {reason: n}, 'armed': bool}}.
+        """
+        return dict((cond_id, {'fired': limiter.fired, 'suppressed': dict(limiter.suppressed),
+                               'armed': limiter.is_armed()})
+                    for cond_id, limiter in self._limiters.items())
+
+    def get_condition(self):
+        """
+        Gets all the conditions for the current port outside the class.
+        :return: Dict of all conditions.
+        """
+        return self._conditions
+
+    def get_specific_condition(self, cond_id):
+        """
+        Gets a specific condition for the current port outside the class.
+        :param cond_id: ID number of the condition.
+        :return: Specific condition.
+        """
+        return self._conditions.get(cond_id)
+
+    def del_condition(self):
+        """
+        Deletes all the conditions of the current port.
+        """
+        self._conditions = {}
+        self.compile_rules()
+
+    def del_specific_condition(self, cond_id):
+        """
+        Deletes a specific condition of the condition port.
+        :param cond_id: ID number of the condition.
+        """
+        if cond_id in self._conditions:
+            del self._conditions[cond_id]
+            self.compile_rules()
+
+
+class WriteQueue(object):
+    """
+    Commands written to a port by a dedicated thread, so that a slow or flow controlled
+    device never blocks the interface, the reader or the scripts.
+    Without pacing, a command is written by the caller when nothing is queued, and the
+    commands queued during a write are coalesced into a single write. With a delay between
+    the characters or the lines, the commands are written one by one, and with drain each
+    write waits for the output buffer of the port to be empty.
+    The completion latency of a command sent by a condition is recorded once it is written,
+    or drained.
+    The thread is started on the first queued command.
+    """
+    COALESCE_SIZE = 4096
+    DRAIN_POLL = 0.001
+
+    def __init__(self, get_serial, stats, name=''):
+        """
+        :param get_serial: Callable returning the serial object to write to.
+        :param stats: PortStats counting the queued and written bytes.
+        :param name: Name of the port, for the messages.
+        """
+        self._get_serial = get_serial
+        self._stats = stats
+        self._name = name
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._writing = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._exit = False
+        self.char_delay = 0
+        self.line_delay = 0
+        self.drain = False
+        self.direct = True
+
+    def set_pacing(self, char_delay=0, line_delay=0, drain=False):
+        """
+        Paces the writes.
+        :param char_delay: Seconds between two characters.
+        :param line_delay: Seconds between two commands.
+        :param drain: Wait for the output buffer of the port to be empty after each write.
+        """
+        with self._cond:
+            self.char_delay = char_delay
+            self.line_delay = line_delay
+            self.drain = drain
+
+    def is_paced(self):
+        """
+        :return: True if the writes are paced or drained.
+        """
+        return bool(self.char_delay or self.line_delay or self.drain)
+
+    def put(self, data, latency=None):
+        """
+        Queues a command.
+        :param data: The bytes of the command.
+        :param latency: Optional (LatencyStats, cond_id, t_read, t_dispatch) of the condition sending
+                        the command, its action stages are recorded when the command is written.
+        :raise serial.SerialException: If the command is written directly and the write fails.
+        """
+        self._stats.record_queued(len(data))
+        with self._cond:
+            direct = self.direct and not self._writing and not self._pending and not self.is_paced()
+            if direct:
+                self._writing = True
+            else:
+                self._pending.append((data, latency))
+                self._pending_bytes += len(data)
+                if self._thread is None:
+                    self._exit = False
+                    self._thread = threading.Thread(target=self._run, name='etsm-tx-' + self._name, daemon=True)
+                    self._thread.start()
+                self._cond.notify_all()
+        if direct:
+            try:
+                self._write(self._get_serial(), data)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+            if latency is not None:
+                self._record_latency([latency])
+
+    def pending(self):
+        """
+        :return: Number of bytes queued and not written yet.
+        """
+        return self._pending_bytes
+
+    def is_idle(self):
+        """
+        :return: True if nothing is queued nor being written.
+        """
+        with self._cond:
+            return not self._pending and not self._writing
+
+    def clear(self):
+        """
+        Drops the queued commands, the write in progress is completed.
+        :return: Number of bytes dropped.
+        """
+        with self._cond:
+            dropped = self._pending_bytes
+            self._pending.clear()
+            self._pending_bytes = 0
+        if dropped:
+            self._stats.record_drop(dropped)
+        return dropped
+
+    def close(self):
+        """
+        Drops the queued commands and stops the thread.
+        """
+        self.clear()
+        with self._cond:
+            self._exit = True
+            self._cond.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._exit and (self._writing or not self._pending):
+                    self._cond.wait()
+                if self._exit:
+                    return
+                data, latency = self._pending.popleft()
+                latencies = [latency] if latency is not None else []
+                if not self.char_delay and not self.line_delay and self._pending:
+                    parts = [data]
+                    size = len(data)
+                    while self._pending and size + len(self._pending[0][0]) <= self.COALESCE_SIZE:
+                        data, latency = self._pending.popleft()
+                        parts.append(data)
+                        size += len(data)
+                        if latency is not None:
+                            latencies.append(latency)
+                    data = b''.join(parts)
+                self._pending_bytes -= len(data)
+                self._writing = True
+                line_delay = self.line_delay
+            try:
+                self._write(self._get_serial(), data)
+                if latencies:
+                    self._record_latency(latencies)
+            except (serial.SerialException, TypeError, OSError) as e:
+                self._stats.record_drop(len(data))
+                print("Can't write to port " + self._name + ", " + str(len(data) + self.clear()) +
+                      " bytes dropped: " + str(e))
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+            if line_delay:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._exit, line_delay)
+
+    def _write(self, port, data):
+        """
+        Writes the bytes, one by one with a delay between the characters.
+        """
+        if self.char_delay:
+            for i in range(len(data)):
+                port.write(data[i:i + 1])
+                self._stats.record_write(1)
+                time.sleep(self.char_delay)
+        else:
+            port.write(data)
+            self._stats.record_write(len(data))
+        if self.drain:
+            while getattr(port, 'out_waiting', 0) and not self._exit:
+                time.sleep(self.DRAIN_POLL)
+
+    @staticmethod
+    def _record_latency(latencies):
+        """
+        Records the action stages of the conditions whose commands have been written.
+        """
+        t_complete = time.perf_counter_ns()
+        for stats, cond_id, t_read, t_dispatch in latencies:
+            stats.record_action(cond_id, t_read, t_dispatch, t_complete)
+
+
+class PortSupervisor(object):
+    """
+    Reopens the ports of a group whose device has disappeared (board reset, unplugged cable).
+    The device path is checked every RECONNECT_INTERVAL, a USB adapter coming back under another
+    path is found by its serial number. The slow port enumerations run in this thread, never in
+    the reader one.
+    """
+    SCAN_INTERVAL = 0.5
+
+    def __init__(self, group):
+        self._group = group
+        self._cond = threading.Condition()
+        self._lost = []
+        self._unresolved = []
+        self._serial_numbers = {}
+        self._thread = None
+        self.exit = False
+
+    def watch(self, port):
+        """
+        Starts supervising a port, its USB serial number is looked up in the background.
+        :param port: The Port to supervise.
+        """
+        with self._cond:
+            if port not in self._serial_numbers and port not in self._unresolved:
+                self._unresolved.append(port)
+                self._cond.notify()
+
+    def forget(self, port):
+        """
+        Stops supervising a port.
+        :param port: The Port to forget.
+        """
+        with self._cond:
+            self._serial_numbers.pop(port, None)
+            for ports in (self._lost, self._unresolved):
+                if port in ports:
+                    ports.remove(port)
+
+    def lost(self, port):
+        """
+        Reports the disconnection of a port, it is given back to the group once reopened.
+        :param port: The disconnected Port.
+        """
+        with self._cond:
+            if port not in self._lost:
+                self._lost.append(port)
+                self._cond.notify()
+
+    def start(self):
+        """
+        Starts the supervisor thread.
+        """
+        self.exit = False
+        self._thread = threading.Thread(target=self._run, name='etsm-supervisor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the supervisor thread and waits for it.
+        """
+        with self._cond:
+            self.exit = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _scan(self):
+        """
+        Enumerates the USB serial ports.
+        :return: Dict {device path: serial number}.
+        """
+        from serial.tools import list_ports
+        try:
+            return dict((p.device, p.serial_number) for p in list_ports.comports() if p.serial_number)
+        except (OSError, ValueError):
+            return {}
+
+    def _run(self):
+        last_scan = 0
+        while True:
+            with self._cond:
+                while not self.exit and not self._lost and not self._unresolved:
+                    self._cond.wait()
+                if self.exit:
+                    return
+                lost = list(self._lost)
+                unresolved = self._unresolved
+                self._unresolved = []
+            if unresolved:
+                devices = self._scan()
+                with self._cond:
+                    for port in unresolved:
+                        number = devices.get(port.get_port_name())
+                        if number is not None:
+                            self._serial_numbers[port] = number
+            moved = {}
+            now = time.monotonic()
+            if lost and now - last_scan >= self.SCAN_INTERVAL and any(p in self._serial_numbers for p in lost):
+                last_scan = now
+                moved = dict((number, device) for device, number in self._scan().items())
+            for port in lost:
+                device = moved.get(self._serial_numbers.get(port))
+                if port.reconnect() or (device is not None and port.reconnect(device)):
+                    # A port forgotten meanwhile is not given back to the group.
+                    with self._cond:
+                        supervised = port in self._lost
+                        if supervised:
+                            self._lost.remove(port)
+                            self._group.add(port)
+                    if not supervised:
+                        # Removed from the group while reopened.
+                        port.get_port().close()
+            if lost:
+                time.sleep(RECONNECT_INTERVAL)
+
+
+class PortGroup(object):
+    """
+    Set of ports read by a single thread.
+    On POSIX systems the reads are multiplexed with a selector, elsewhere the ports
+    are polled. The group also routes the commands of a condition to another port.
+    A port whose device disappears is handed to a PortSupervisor until it is back.
+    The thread is woken up when the detection pool of a port has searched a batch of lines.
+    """
+    POLL_INTERVAL = 0.001
+
+    def __init__(self):
+        self._ports = []
+        self._lock = threading.Lock()
+        self._selector = None
+        self._wake_r, self._wake_w = os.pipe()
+        try:
+            os.set_blocking(self._wake_r, False)
+        except OSError:
+            pass
+        self._changes = []
+        self._registered = {}
+        self._thread = None
+        self._supervisor = PortSupervisor(self)
+        self._pools = []
+        self.exit = False
+        try:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        except (OSError, ValueError):
+            self._selector = None
+
+    def __iter__(self):
+        return iter(list(self._ports))
+
+    def __len__(self):
+        return len(self._ports)
+
+    def add(self, port):
+        """
+        Adds a port to the group, its reads are handled by the group thread.
+        :param port: The Port to add.
+        """
+        port.set_group(self)
+        pool = port.get_detection_pool()
+        with self._lock:
+            self._ports.append(port)
+            self._changes.append(('add', port))
+            if pool is not None and pool not in self._pools:
+                self._pools.append(pool)
+                pool.sig_done.connect(self._wake)
+        self._supervisor.watch(port)
+        self._wake()
+
+    def remove(self, port):
+        """
+        Removes a port from the group.
+        :param port: The Port to remove.
+        """
+        # Forgotten first, so that the supervisor can't give it back to the group.
+        self._supervisor.forget(port)
+        with self._lock:
+            if port in self._ports:
+                self._ports.remove(port)
+            self._changes.append(('remove', port))
+        port.set_group(None)
+        self._wake()
+
+    def _lose(self, port):
+        """
+        Takes a disconnected port out of the reads until the supervisor reopens it.
+        A port removed from the group meanwhile, to be closed, is not supervised.
+        """
+        with self._lock:
+            member = port in self._ports
+            if member:
+                self._ports.remove(port)
+            self._changes.append(('remove', port))
+        if member:
+            port.disconnected()
+            self._supervisor.lost(port)
+
+    def refresh(self, port):
+        """
+        Registers again a port whose device has been reopened.
+        :param port: The Port to refresh.
+        """
+        with self._lock:
+            self._changes.append(('remove', port))
+            self._changes.append(('add', port))
+        self._wake()
+
+    def get(self, port_name):
+        """
+        Gets a port of the group by its name.
+        :param port_name: Name of the port.
+        :return: The Port, None if not in the group.
+        """
+        for port in self._ports:
+            if port.get_port_name() == port_name:
+                return port
+        return None
+
+    def send_command(self, port_name, command, latency=None):
+        """
+        Sends a command to a port of the group.
+        :param port_name: Name of the port.
+        :param command: The command to send.
+        :param latency: Optional latency context of the condition sending the command, see WriteQueue.put.
+        :return: True if the port is part of the group.
+        """
+        port = self.get(port_name)
+        if port is None:
+            return False
+        port.send_command(command, latency)
+        return True
+
+    def start(self):
+        """
+        Starts the reader thread of the group.
+        """
+        self.exit = False
+        self._thread = threading.Thread(target=self.run, name='etsm-rx', daemon=True)
+        self._thread.start()
+        self._supervisor.start()
+
+    def stop(self):
+        """
+        Stops the reader thread of the group and waits for it.
+        """
+        self.exit = True
+        self._supervisor.stop()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except (OSError, TypeError):
+            pass
+
+    def _apply_changes(self):
+        with self._lock:
+            changes = self._changes
+            self._changes = []
+        for change, port in changes:
+            if change == 'remove':
+                fd = self._registered.pop(port, None)
+                if fd is not None:
+                    try:
+                        self._selector.unregister(fd)
+                    except (KeyError, ValueError):
+                        pass
+                continue
+            try:
+                port.get_port().timeout = 0
+            except (AttributeError, ValueError, serial.SerialException):
+                pass
+            if self._selector is None:
+                continue
+            try:
+                fd = port.get_port().fileno()
+                self._selector.register(fd, selectors.EVENT_READ, port)
+                self._registered[port] = fd
+            except (AttributeError, OSError, ValueError, KeyError, serial.SerialException):
+                # No file descriptor (Windows or closed port), this port is polled.
+                pass
+
+    def run(self):
+        """
+        Reads all the ports of the group until stopped.
+        """
+        while not self.exit:
+            self._apply_changes()
+            if self._selector is not None:
+                polled = [p for p in self._ports if p not in self._registered]
+                timeout = self.POLL_INTERVAL if polled else 0.05
+                ready = [key.data for key, mask in self._selector.select(timeout)]
+                if None in ready:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    ready = [p for p in ready if p is not None]
+            else:
+                polled = list(self._ports)
+                ready = []
+            now = time.monotonic()
+            received = False
+            for port in ready + polled:
+                try:
+                    if port.get_port().in_waiting or port in ready:
+                        received |= port.read_available(now) > 0
+                except (serial.SerialException, TypeError, OSError):
+                    self._lose(port)
+            for port in self._ports:
+                port.process_detected()
+                port.flush_idle(now)
+            if self._selector is None and not received:
+                time.sleep(self.POLL_INTERVAL)
+
+    def close(self):
+        """
+        Stops the group and releases its resources, the ports are not closed.
+        """
+        if self._wake_r is None:
+            return
+        self.stop()
+        for pool in self._pools:
+            pool.sig_done.disconnect(self._wake)
+        if self._selector is not None:
+            self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self._wake_r = self._wake_w = None
+
+
+def add_port_arguments(parser):
+    """
+    Adds the command line options shared by the graphical and the headless modes.
+    :param parser: The argparse parser to complete.
+    """
+    parser.add_argument('-p', '--port', required=False, action='append', type=str,
+                        help='Specify port to open (default ' + DEFAULT_PORT + '), repeat to monitor several ports')
+    parser.add_argument('-b', '--baudrate', required=False, help='Specify baudrate of the port', default=115200,
+                        type=int)
+    parser.add_argument('--log', required=False, help='Continuously append the traces to this file',
+                        default=None, type=str)
+    parser.add_argument('--log-max-bytes', required=False, help='Rotate the log when it reaches this size',
+                        default=0, type=int)
+    parser.add_argument('--log-rotate-seconds', required=False, help='Rotate the log after this duration',
+                        default=0, type=int)
+    parser.add_argument('--log-compress', required=False, help='Compression of the rotated logs',
+                        default='none', choices=COMPRESSIONS)
+    parser.add_argument('--log-keep', required=False, help='Number of rotated logs to keep, 0 for all',
+                        default=0, type=int)
+    parser.add_argument('--eol', required=False, help='Line terminator of the received traces',
+                        default='LF', choices=sorted(TERMINATORS))
+    parser.add_argument('--encoding', required=False, help='Encoding of the traces', default='utf-8', type=str)
+    parser.add_argument('--idle-flush', required=False,
+                        help='Delay in ms after which an unterminated line is displayed, 0 to wait for the terminator',
+                        default=200, type=int)
+    parser.add_argument('--event-bus', required=False,
+                        help='Publish the events on this Unix domain socket for external programs',
+                        default=None, type=str)
+    parser.add_argument('--capture', required=False,
+                        help='Write the received lines of all the ports to this compact binary capture file',
+                        default=None, type=str)
+    parser.add_argument('--flow-control', required=False, help='Flow control of the written commands',
+                        default='none', choices=FLOW_CONTROLS)
+    parser.add_argument('--char-delay', required=False, help='Delay in ms between the characters of the commands',
+                        default=0, type=float)
+    parser.add_argument('--line-delay', required=False, help='Delay in ms between the commands', default=0, type=float)
+    parser.add_argument('--drain', action='store_true',
+                        help='Wait for the output buffer of the port to be empty before writing the next command')
+    parser.add_argument('--metrics-port', required=False,
+                        help='Serve the counters of the ports on http://127.0.0.1:PORT/metrics for Prometheus',
+                        default=0, type=int)
+    parser.add_argument('--workers', required=False,
+                        help='Number of worker processes searching the rules, 0 to search them in the reader threads',
+                        default=0, type=int)
+
+
+def open_trace_log(args, port_name=None):
+    """
+    Checks the shared command line options and opens the trace log if requested.
+    Exits if the options are not valid.
+    :param args: The parsed command line options.
+    :param port_name: When several ports are monitored, name of the port whose
+                      base name is inserted in the log name (etsm.log -> etsm.ttyUSB0.log).
+    :return: TraceLog instance, None if no log is requested.
+    """
+    try:
+        codecs.lookup(args.encoding)
+    except LookupError:
+        print("Unknown encoding " + args.encoding + ".")
+        sys.exit()
+    if not args.log:
+        return None
+    path = args.log
+    if port_name is not None:
+        root, ext = os.path.splitext(path)
+        path = root + '.' + os.path.basename(port_name) + ext
+    try:
+        return TraceLog(path, args.log_max_bytes, args.log_rotate_seconds, args.log_compress, args.log_keep)
+    except (OSError, ValueError) as e:
+        print("Can't open trace log " + path + ": " + str(e))
+        sys.exit()
+
+
+def open_event_bus(args):
+    """
+    Opens the event bus if requested by the command line options.
+    Exits if the socket can't be created.
+    :param args: The parsed command line options.
+    :return: EventBus instance, None if no bus is requested.
+    """
+    if not args.event_bus:
+        return None
+    from etsm_bus import EventBus
+    try:
+        return EventBus(args.event_bus)
+    except (OSError, ValueError) as e:
+        print("Can't open event bus " + args.event_bus + ": " + str(e))
+        sys.exit()
+
+
+def open_capture(args):
+    """
+    Opens the binary capture if requested by the command line options.
+    Exits if the file can't be created.
+    :param args: The parsed command line options.
+    :return: CaptureWriter instance, None if no capture is requested.
+    """
+    if not args.capture:
+        return None
+    try:
+        return CaptureWriter(args.capture)
+    except OSError as e:
+        print("Can't open capture " + args.capture + ": " + str(e))
+        sys.exit()
+
+
+def open_metrics_server(args, source):
+    """
+    Starts the metrics endpoint if requested by the command line options.
+    Exits if the port can't be listened on.
+    :param args: The parsed command line options.
+    :param source: Callable returning the dict {port name: PortStats} to expose.
+    :return: MetricsServer instance, None if no endpoint is requested.
+    """
+    if not args.metrics_port:
+        return None
+    from etsm_stats import MetricsServer
+    try:
+        return MetricsServer(args.metrics_port, source)
+    except OSError as e:
+        print("Can't serve the metrics on port " + str(args.metrics_port) + ": " + str(e))
+        sys.exit()
+
+
+def open_detection_pool(args):
+    """
+    Starts the detection workers if requested by the command line options.
+    Exits if they can't be started.
+    :param args: The parsed command line options.
+    :return: DetectionPool instance, None if no worker is requested.
+    """
+    if args.workers <= 0:
+        return None
+    from etsm_workers import DetectionPool
+    try:
+        return DetectionPool(args.workers)
+    except (OSError, ValueError) as e:
+        print("Can't start the detection workers: " + str(e))
+        sys.exit()
+
+
+def load_config(path):
+    """
+    Loads a JSON configuration file describing the port, the patterns, the conditions
+    and the scripts to run, for example:
+    {"port": "/dev/ttyUSB0", "baudrate": 115200, "patterns": ["panic"],
+     "conditions": [{"pattern": "login:", "action": "root", "type": "Command"}],
+     "commands": ["uname -a"], "scripts": ["init.txt"]}
+    Several ports are described by a list of such objects: {"ports": [{...}, {...}]}.
+    A condition can fire on a sequence of patterns ({"pattern": "A", "then": ["B"], "within": 500})
+    or on a number of occurrences ({"pattern": "A", "count": 5, "within": 1000}), within in ms.
+    How often a condition fires is limited by the "debounce", "cooldown", "rate", "burst", "once" and
+    "rearm" keys, see Port.add_condition().
+    The writes are paced by the "char_delay" and "line_delay" keys (ms) and the "drain" and
+    "flow_control" keys, which take precedence over the command line options.
+    Exits if the file can't be read.
+    :param path: The configuration file.
+    :return: List of the port configurations, conditions are numbered from 1 if they have no id.
+    """
+    try:
+        with open(path, mode='r') as f:
+            config = json.load(f)
+    except (IOError, ValueError) as e:
+        print("Can't read config " + path + ": " + str(e))
+        sys.exit()
+    ports = config.get('ports') or [config]
+    for port in ports:
+        for i, cond in enumerate(port.get('conditions', [])):
+            cond.setdefault('id', i + 1)
+            cond.setdefault('type', 'Command')
+            cond.setdefault('target', None)
+            cond.setdefault('regex', False)
+            if cond.get('then'):
+                cond['rule'] = ('sequence', tuple(cond['then']), cond.get('within', 0))
+            elif cond.get('count'):
+                cond['rule'] = ('count', int(cond['count']), cond.get('within', 0))
+            else:
+                cond['rule'] = None
+            cond['limit'] = dict((key, cond[key]) for key in LIMITS if cond.get(key)) or None
+    return ports
+
+
+def apply_config(port, config):
+    """
+    Sets the patterns and the conditions of a configuration on a port.
+    :param port: The Port instance to configure.
+    :param config: Port configuration returned by load_config.
+    """
+    port.set_pattern(list(config.get('patterns', [])))
+    if 'flow_control' in config:
+        port.set_flow_control(config['flow_control'])
+    if any(key in config for key in ('char_delay', 'line_delay', 'drain')):
+        writer = port.get_write_queue()
+        writer.set_pacing(config.get('char_delay', writer.char_delay * 1000.0) / 1000.0,
+                          config.get('line_delay', writer.line_delay * 1000.0) / 1000.0,
+                          config.get('drain', writer.drain))
+    for cond in config.get('conditions', []):
+        port.add_condition(cond['id'], cond['pattern'], cond['action'], cond['type'], cond['target'], cond['regex'],
+                           cond['rule'], cond['limit'])
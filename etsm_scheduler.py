@@ -0,0 +1,473 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Command scheduler of the ETSM: scripts are run step by step by a dedicated
+thread, so that delays and expected lines never block the graphical interface
+nor the reader.
+"""
+
+from collections import deque
+from functools import partial
+import heapq
+import itertools
+import re
+import shlex
+import threading
+import time
+
+from etsm_engine import Hook
+
+REGEX_PREFIX = 're:'
+# Number of received lines kept for the expect steps of a script.
+EXPECT_BUFFER = 10000
+
+# A script queues at most this number of bytes ahead of the write queue of its port.
+SCRIPT_AHEAD = 4096
+# Period at which a script waiting for the write queue of its port checks it again.
+WRITE_POLL = 0.005
+
+
+def parse_delay(text):
+    """
+    Parses the duration of a delay step: "2" or "2s" are seconds, "250ms" milliseconds,
+    decimals are accepted.
+    :param text: The duration to parse.
+    :return: The duration in seconds.
+    :raise ValueError: If the duration is not valid.
+    """
+    text = text.strip().lower()
+    if text.endswith('ms'):
+        seconds = float(text[:-2]) / 1000.0
+    elif text.endswith('s'):
+        seconds = float(text[:-1])
+    else:
+        seconds = float(text)
+    if seconds < 0:
+        raise ValueError("negative delay")
+    return seconds
+
+
+def parse_timeout(text):
+    """
+    Parses the timeout of an expect step: "500" or "500ms" are milliseconds, "2s" seconds.
+    :param text: The timeout to parse.
+    :return: The timeout in seconds.
+    :raise ValueError: If the timeout is not valid.
+    """
+    text = text.strip().lower()
+    if text.endswith('s'):
+        return parse_delay(text)
+    return parse_delay(text + 'ms')
+
+
+def parse_expect(line):
+    """
+    Parses an expect step, the arguments are separated by spaces and quoted if they hold spaces:
+    expect <pattern> <timeout> [else abort|continue|goto <label>]
+    send_and_expect <command> <pattern> <timeout> [else abort|continue|goto <label>]
+    :param line: The line of the script.
+    :return: (command, pattern, timeout in seconds, (action, label)), command None for expect.
+    :raise ValueError: If the step is not valid.
+    """
+    lexer = shlex.shlex(line, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    lexer.escape = ''
+    args = list(lexer)
+    count = 3 if args[0] == 'send_and_expect' else 2
+    if len(args) < count + 1:
+        raise ValueError("missing arguments")
+    command = args[1] if count == 3 else None
+    pattern = args[count - 1]
+    timeout = parse_timeout(args[count])
+    rest = args[count + 1:]
+    if not rest or rest == ['else', 'abort']:
+        on_timeout = ('abort', None)
+    elif rest == ['else', 'continue']:
+        on_timeout = ('continue', None)
+    elif len(rest) == 3 and rest[:2] == ['else', 'goto']:
+        on_timeout = ('goto', rest[2])
+    else:
+        raise ValueError("expected else abort, else continue or else goto <label>")
+    if pattern.startswith(REGEX_PREFIX):
+        re.compile(pattern[len(REGEX_PREFIX):])
+    return command, pattern, timeout, on_timeout
+
+
+def parse_script(lines):
+    """
+    Parses the lines of a script into steps.
+    "delay <duration>" lines pause the script, "expect" and "send_and_expect" lines wait for
+    a line matching a pattern (see parse_expect), "label <name>" lines are the targets of
+    their "else goto <name>", any other line is a command to send.
+    :param lines: Iterable of the lines of the script.
+    :return: List of ('send', command), ('delay', seconds), ('expect', (command, pattern,
+             timeout, on_timeout)) and ('label', name) steps.
+    """
+    steps = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        words = line.split(' ')
+        if words[0] == 'delay':
+            try:
+                steps.append(('delay', parse_delay(' '.join(words[1:]))))
+            except ValueError:
+                print("Bad delay " + line + ".")
+        elif words[0] in ('expect', 'send_and_expect'):
+            try:
+                steps.append(('expect', parse_expect(line)))
+            except (ValueError, re.error) as e:
+                print("Bad expect " + line + ": " + str(e) + ".")
+        elif words[0] == 'label' and len(words) == 2:
+            steps.append(('label', words[1]))
+        else:
+            steps.append(('send', line))
+    labels = set(value for kind, value in steps if kind == 'label')
+    for index, (kind, value) in enumerate(steps):
+        if kind == 'expect' and value[3][0] == 'goto' and value[3][1] not in labels:
+            print("Unknown label " + value[3][1] + ", the script aborts if " + value[1] + " is not received.")
+            steps[index] = (kind, value[:3] + (('abort', None),))
+    return steps
+
+
+class ExpectBuffer(object):
+    """
+    Lines received by a port for the expect steps of a script. The lines received before
+    a command of the script are dropped when it is sent, an expected line is consumed with
+    the lines before it.
+    Fed by the reader thread of the port.
+    """
+
+    def __init__(self):
+        self._lines = deque(maxlen=EXPECT_BUFFER)
+        self._lock = threading.Lock()
+        self._match = None
+        self._on_match = None
+        self._matched = None
+
+    def feed(self, line, matches, received):
+        """
+        Slot of Port.sig_line_received.
+        """
+        with self._lock:
+            if self._match is not None and self._match(line):
+                self._lines.clear()
+                self._match = None
+                self._matched = (line, received)
+                on_match = self._on_match
+            else:
+                self._lines.append((line, received))
+                return
+        on_match()
+
+    def clear(self):
+        """
+        Drops the lines received so far.
+        """
+        with self._lock:
+            self._lines.clear()
+
+    def expect(self, pattern, on_match):
+        """
+        Searches the lines received so far, then waits for the pattern in the next lines.
+        :param pattern: Literal pattern, or regular expression with the 're:' prefix.
+        :param on_match: Called by the reader thread when the pattern is received.
+        :return: True if the pattern was already received.
+        """
+        if pattern.startswith(REGEX_PREFIX):
+            match = re.compile(pattern[len(REGEX_PREFIX):]).search
+        else:
+            match = lambda line: pattern in line
+        with self._lock:
+            self._matched = None
+            for index, (line, received) in enumerate(self._lines):
+                if match(line):
+                    for _ in range(index + 1):
+                        self._lines.popleft()
+                    self._matched = (line, received)
+                    return True
+            self._match = match
+            self._on_match = on_match
+        return False
+
+    def stop(self):
+        """
+        Stops waiting for the pattern.
+        :return: (line, receive timestamp) of the matching line, None if it was not received.
+        """
+        with self._lock:
+            self._match = None
+            self._on_match = None
+            matched = self._matched
+            self._matched = None
+            return matched
+
+    def get_matched(self):
+        """
+        :return: (line, receive timestamp) of the matching line, None if it was not received yet.
+        """
+        return self._matched
+
+
+class ScriptJob(object):
+    """
+    Script being run by the scheduler for a given port.
+    """
+
+    def __init__(self, port, steps, name=''):
+        self.port = port
+        self.steps = steps
+        self.name = name
+        self.index = 0
+        self.cancelled = False
+        self.done = False
+        self.results = []
+        self.epoch = 0
+        self.last_send = 0
+        self.deadline = None
+        self.expect_id = 0
+        self.expect_from = 0
+        self.buffer = ExpectBuffer() if any(kind == 'expect' for kind, value in steps) else None
+
+    def progress(self):
+        """
+        Gets the progress of the script.
+        :return: (number of steps started, total number of steps)
+        """
+        return self.index, len(self.steps)
+
+
+class CommandScheduler(object):
+    """
+    Runs the scripts of all the ports from a single thread, a script waiting for a delay
+    or an expected line lets the others run. The thread is started on the first submitted
+    script. sig_expect_done is emitted by the scheduler thread with (job, result) after
+    every expect step, see _expect().
+    """
+
+    def __init__(self):
+        self.sig_expect_done = Hook()
+        self._heap = []
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._thread = None
+        self.exit = False
+
+    def submit(self, port, steps, name=''):
+        """
+        Schedules a script.
+        :param port: The Port receiving the commands.
+        :param steps: Steps returned by parse_script.
+        :param name: Name of the script, for display.
+        :return: The ScriptJob, to follow its progress or to cancel it.
+        """
+        job = ScriptJob(port, steps, name)
+        if job.buffer is not None:
+            port.sig_line_received.connect(job.buffer.feed)
+        with self._cond:
+            if self._thread is None:
+                self.exit = False
+                self._thread = threading.Thread(target=self._run, name='etsm-scheduler', daemon=True)
+                self._thread.start()
+            self._jobs.append(job)
+            self._push(job, time.monotonic())
+            self._cond.notify()
+        return job
+
+    def _push(self, job, due):
+        """
+        Schedules the next step of a script, replacing its previous schedule.
+        Must be called with the condition held.
+        """
+        job.epoch += 1
+        heapq.heappush(self._heap, (due, next(self._seq), job, job.epoch))
+
+    def _wake(self, job, expect_id):
+        """
+        Runs the step of a script at once, called by the reader thread when the expected line is received.
+        """
+        with self._cond:
+            # A late line must not shorten the following steps.
+            if job.deadline is not None and job.expect_id == expect_id and job in self._jobs:
+                self._push(job, time.monotonic())
+                self._cond.notify()
+
+    def _finish(self, job):
+        """
+        Releases the resources of a finished or cancelled script.
+        """
+        if job.buffer is not None:
+            job.port.sig_line_received.disconnect(job.buffer.feed)
+            job.buffer.stop()
+
+    def cancel(self, job=None):
+        """
+        Cancels a script, the command being sent is not interrupted.
+        :param job: The ScriptJob to cancel, None to cancel all of them.
+        """
+        with self._cond:
+            for j in list(self._jobs):
+                if job is None or j is job:
+                    j.cancelled = True
+                    self._jobs.remove(j)
+                    self._finish(j)
+            self._cond.notify()
+
+    def jobs(self):
+        """
+        Gets the scripts not finished yet.
+        :return: List of ScriptJob.
+        """
+        with self._cond:
+            return list(self._jobs)
+
+    def stop(self):
+        """
+        Cancels all the scripts and stops the scheduler thread.
+        """
+        self.cancel()
+        with self._cond:
+            self.exit = True
+            self._cond.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.exit and not self._heap:
+                    self._cond.wait()
+                if self.exit:
+                    return
+                due, seq, job, epoch = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+            if job.cancelled or epoch != job.epoch:
+                continue
+            delay = self._step(job)
+            with self._cond:
+                if delay is None or job.cancelled:
+                    job.done = True
+                    if job in self._jobs:
+                        self._jobs.remove(job)
+                        self._finish(job)
+                else:
+                    if job.deadline is not None and job.buffer.get_matched() is not None:
+                        # The expected line was received while the step was running, its wake-up
+                        # would be replaced by the timeout.
+                        delay = 0
+                    self._push(job, time.monotonic() + delay)
+
+    def _step(self, job):
+        """
+        Runs the next step of a script.
+        A delay starts once the previous commands are written, and a command waits while
+        SCRIPT_AHEAD bytes are already queued, so that a cancelled script stops quickly.
+        :param job: The ScriptJob to advance.
+        :return: Seconds to wait before the following step, None once the script is finished.
+        """
+        if job.index >= len(job.steps):
+            return None
+        kind, value = job.steps[job.index]
+        if job.deadline is None:
+            writer = job.port.get_write_queue()
+            if writer.pending() >= SCRIPT_AHEAD or (kind == 'delay' and not writer.is_idle()):
+                return WRITE_POLL
+        if kind == 'expect':
+            return self._expect(job, *value)
+        job.index += 1
+        if kind == 'delay':
+            return value
+        if kind == 'label':
+            return 0
+        return 0 if self._send(job, value) else None
+
+    def _send(self, job, command):
+        """
+        Sends a command of a script, the lines received before it can't match the next expect steps.
+        :return: False if the script must be aborted.
+        """
+        if job.buffer is not None:
+            job.buffer.clear()
+        if not job.port.send_command(command):
+            print("Script " + job.name + " aborted.")
+            return False
+        job.last_send = time.perf_counter_ns()
+        return True
+
+    def _expect(self, job, command, pattern, timeout, on_timeout):
+        """
+        Runs an expect step: sends its command if any, then waits until a received line
+        matches the pattern or until the timeout. The step is run again when the line is
+        received or once the timeout is elapsed.
+        The result is a dict with the step number, the command, the pattern, matched (bool),
+        the matching line, the latency in seconds from the last command sent by the script
+        (or from the start of the step) to the receive time of the matching line, and on
+        timeout the action taken.
+        :return: Seconds to wait before running the step again or the following step, None
+                 if the script is aborted.
+        """
+        now = time.monotonic()
+        if job.deadline is None:
+            start = time.perf_counter_ns()
+            if command is not None and not self._send(job, command):
+                return None
+            job.expect_from = job.last_send or start
+            job.expect_id += 1
+            job.deadline = now + timeout
+            if not job.buffer.expect(pattern, partial(self._wake, job, job.expect_id)):
+                return timeout
+        if job.buffer.get_matched() is None and now < job.deadline:
+            return job.deadline - now
+        matched = job.buffer.stop()
+        job.deadline = None
+        result = {'step': job.index + 1, 'command': command, 'pattern': pattern, 'matched': matched is not None,
+                  'line': matched[0] if matched else None,
+                  'latency': max(0, matched[1] - job.expect_from) / 1e9 if matched else timeout}
+        action, label = on_timeout
+        job.index += 1
+        if matched is None:
+            result['action'] = action if label is None else action + ' ' + label
+            if action == 'goto':
+                job.index = job.steps.index(('label', label))
+        job.results.append(result)
+        self.sig_expect_done.emit(job, result)
+        if matched is None and action == 'abort':
+            print("Expect " + pattern + " timed out after " + format(timeout, 'g') + " s, script " + job.name +
+                  " aborted.")
+            return None
+        return 0
@@ -0,0 +1,434 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Console scrollback of the ETSM: a compact line store whose oldest lines are
+spilled to a disk-backed history, and incremental filters over it.
+"""
+
+from array import array
+from collections import deque
+import bisect
+import re
+import tempfile
+
+FLAG_DETECTED = 0x01
+FLAG_MARKER = 0x02
+
+
+class _Chunk(object):
+    """
+    Fixed number of lines packed in a single UTF-8 buffer.
+    The highlighted spans, only present on matched lines, are kept aside by position.
+    """
+    __slots__ = ('data', 'ends', 'flags', 'times', 'spans')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('I')
+        self.flags = array('B')
+        self.times = array('q')
+        self.spans = {}
+
+    def __len__(self):
+        return len(self.ends)
+
+    def append(self, raw, flags, spans=None, received=0):
+        if spans:
+            self.spans[len(self.ends)] = spans
+        self.data += raw
+        self.ends.append(len(self.data))
+        self.flags.append(flags)
+        self.times.append(received)
+
+    def get(self, pos):
+        start = self.ends[pos - 1] if pos else 0
+        return self.data[start:self.ends[pos]].decode('utf-8', 'replace'), self.flags[pos]
+
+
+class LineStore(object):
+    """
+    Store of the console lines.
+    The last `limit` lines are kept in memory, packed by chunks. Older chunks are
+    written to a temporary history file and read back only when displayed, without
+    their highlighted spans. The receive timestamps of all the lines stay in memory.
+    """
+    CHUNK_LINES = 1024
+
+    def __init__(self, limit=100000, history_dir=None):
+        self._limit = max(self.CHUNK_LINES, int(limit))
+        self._history_dir = history_dir
+        self._chunks = deque()
+        self._first = 0
+        self._count = 0
+        self._history = None
+        self._history_ends = array('Q')
+        self._history_flags = array('B')
+        self._history_times = array('q')
+        self._detected = array('Q')
+
+    def __len__(self):
+        return self._count
+
+    def append(self, line, flags=0, spans=None, received=0):
+        """
+        Appends a line at the end of the store.
+        :param line: The line to store, trailing end of line characters are removed.
+        :param flags: FLAG_* bits attached to the line.
+        :param spans: Highlighted parts of the line, tuple of (start, end, colour index).
+        :param received: Receive timestamp of the line (time.perf_counter_ns()), 0 if unknown.
+        """
+        if not self._chunks or len(self._chunks[-1]) >= self.CHUNK_LINES:
+            self._chunks.append(_Chunk())
+        if flags & FLAG_DETECTED:
+            self._detected.append(self._count)
+        self._chunks[-1].append(line.rstrip('\r\n').encode('utf-8', 'replace'), flags, spans, received)
+        self._count += 1
+        while self._count - self._first - len(self._chunks[0]) >= self._limit:
+            self._spill()
+
+    def _spill(self):
+        """
+        Moves the oldest in-memory chunk to the history file.
+        """
+        chunk = self._chunks.popleft()
+        if self._history is None:
+            self._history = tempfile.TemporaryFile(prefix='etsm-history-', dir=self._history_dir)
+        base = self._history_ends[-1] if self._history_ends else 0
+        self._history.seek(base)
+        self._history.write(chunk.data)
+        self._history_ends.extend(base + end for end in chunk.ends)
+        self._history_flags.extend(chunk.flags)
+        self._history_times.extend(chunk.times)
+        self._first += len(chunk)
+
+    def get(self, index):
+        """
+        Gets a line of the store.
+        :param index: Absolute index of the line.
+        :return: (line, flags)
+        """
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("line index out of range")
+        if index >= self._first:
+            pos = index - self._first
+            return self._chunks[pos // self.CHUNK_LINES].get(pos % self.CHUNK_LINES)
+        return self._read_history(index, index + 1)[0]
+
+    def get_range(self, start, stop):
+        """
+        Gets consecutive lines of the store, reading the history file once if needed.
+        :param start: Index of the first line.
+        :param stop: Index after the last line, clipped to the size of the store.
+        :return: List of (line, flags).
+        """
+        start = max(0, start)
+        stop = min(stop, self._count)
+        lines = []
+        if start < min(stop, self._first):
+            lines = self._read_history(start, min(stop, self._first))
+            start = self._first
+        for index in range(start, stop):
+            pos = index - self._first
+            lines.append(self._chunks[pos // self.CHUNK_LINES].get(pos % self.CHUNK_LINES))
+        return lines
+
+    def get_spans(self, start, stop):
+        """
+        Gets the highlighted spans of consecutive lines.
+        :param start: Index of the first line.
+        :param stop: Index after the last line.
+        :return: Dict {index: spans} of the lines having spans, the lines of the history have none.
+        """
+        spans = {}
+        first = self._first
+        for index in range(max(start, first), min(stop, self._count)):
+            pos = index - first
+            line_spans = self._chunks[pos // self.CHUNK_LINES].spans.get(pos % self.CHUNK_LINES)
+            if line_spans:
+                spans[index] = line_spans
+        return spans
+
+    def get_times(self, start, stop):
+        """
+        Gets the receive timestamps of consecutive lines.
+        :param start: Index of the first line.
+        :param stop: Index after the last line, clipped to the size of the store.
+        :return: List of time.perf_counter_ns() values, 0 for the lines without timestamp.
+        """
+        start = max(0, start)
+        stop = min(stop, self._count)
+        times = []
+        if start < min(stop, self._first):
+            times = self._history_times[start:min(stop, self._first)].tolist()
+            start = self._first
+        while start < stop:
+            pos = start - self._first
+            chunk_pos = pos % self.CHUNK_LINES
+            count = min(stop - start, self.CHUNK_LINES - chunk_pos)
+            times.extend(self._chunks[pos // self.CHUNK_LINES].times[chunk_pos:chunk_pos + count])
+            start += count
+        return times
+
+    def last_match_time(self, index):
+        """
+        Gets the receive timestamp of the last matched line before a line.
+        :param index: Index of the line.
+        :return: time.perf_counter_ns() value, None if no line matched before.
+        """
+        pos = bisect.bisect_left(self._detected, index) - 1
+        if pos < 0:
+            return None
+        return self.get_times(self._detected[pos], self._detected[pos] + 1)[0] or None
+
+    def iter_range(self, start=0, stop=None, step=4096):
+        """
+        Iterates over the lines of the store without loading them all at once.
+        :param start: Index of the first line.
+        :param stop: Index after the last line, None for the end of the store.
+        :param step: Number of lines fetched at once.
+        """
+        stop = self._count if stop is None else min(stop, self._count)
+        while start < stop:
+            for line in self.get_range(start, min(start + step, stop)):
+                yield line
+            start += step
+
+    def _read_history(self, start, stop):
+        """
+        Reads lines back from the history file.
+        :param start: Index of the first line.
+        :param stop: Index after the last line, at most the first in-memory line.
+        :return: List of (line, flags).
+        """
+        begin = self._history_ends[start - 1] if start else 0
+        self._history.seek(begin)
+        data = self._history.read(self._history_ends[stop - 1] - begin)
+        lines = []
+        prev = 0
+        for index in range(start, stop):
+            end = self._history_ends[index] - begin
+            lines.append((data[prev:end].decode('utf-8', 'replace'), self._history_flags[index]))
+            prev = end
+        return lines
+
+    def get_limit(self):
+        """
+        Gets the number of lines kept in memory.
+        :return: The scrollback limit.
+        """
+        return self._limit
+
+    def get_history_size(self):
+        """
+        Gets the number of lines spilled to the history file.
+        :return: Number of lines on disk.
+        """
+        return self._first
+
+    def close(self):
+        """
+        Closes and removes the history file.
+        """
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+
+
+class LineFilter(object):
+    """
+    Incremental index of the lines of a LineStore matching a pattern, usable as a store
+    by the console to show only these lines.
+    The lines are checked by update(), which only looks at the lines appended since the
+    previous call. A filter built from a base filter whose literal pattern is part of its
+    own only checks the lines matched by the base, as when a search is typed.
+    """
+    REGEX_PREFIX = 're:'
+
+    def __init__(self, store, pattern, base=None):
+        """
+        :param store: The LineStore to filter.
+        :param pattern: Literal pattern, or regular expression with the 're:' prefix.
+        :param base: Optional LineFilter of the same store narrowing the lines to check.
+        :raise re.error: If the regular expression is not valid.
+        """
+        self._store = store
+        self._pattern = pattern
+        if pattern.startswith(self.REGEX_PREFIX):
+            search = re.compile(pattern[len(self.REGEX_PREFIX):]).search
+            self._test = lambda line: search(line) is not None
+        else:
+            self._test = lambda line: pattern in line
+        self._matches = array('Q')
+        self._candidates = None
+        self._candidate_pos = 0
+        self._scanned = 0
+        # The lines of the base are only known once its own candidates are checked.
+        if base is not None and base._candidates is None and base.is_refined_by(pattern):
+            self._candidates = base._matches[:]
+            self._scanned = base._scanned
+
+    def __len__(self):
+        return len(self._matches)
+
+    def is_refined_by(self, pattern):
+        """
+        Tells if the lines matching a pattern are a subset of the lines matching this filter.
+        :param pattern: The other pattern.
+        :return: True if the other pattern is a literal containing this literal pattern.
+        """
+        return (not self._pattern.startswith(self.REGEX_PREFIX) and not pattern.startswith(self.REGEX_PREFIX)
+                and self._pattern in pattern)
+
+    def get_pattern(self):
+        """
+        Gets the pattern of the filter.
+        :return: The pattern.
+        """
+        return self._pattern
+
+    def update(self, max_lines=None):
+        """
+        Checks the lines not checked yet.
+        :param max_lines: Maximum number of lines checked, None for all of them.
+        :return: True if all the lines of the store have been checked.
+        """
+        budget = max_lines if max_lines is not None else len(self._store)
+        test = self._test
+        matches = self._matches
+        if self._candidates is not None:
+            candidates = self._candidates
+            stop = min(len(candidates), self._candidate_pos + budget)
+            for index in candidates[self._candidate_pos:stop]:
+                if test(self._store.get(index)[0]):
+                    matches.append(index)
+            budget -= stop - self._candidate_pos
+            self._candidate_pos = stop
+            if stop < len(candidates):
+                return False
+            self._candidates = None
+        stop = min(len(self._store), self._scanned + max(0, budget))
+        index = self._scanned
+        for line, flags in self._store.iter_range(self._scanned, stop):
+            if test(line):
+                matches.append(index)
+            index += 1
+        self._scanned = stop
+        return self.is_complete()
+
+    def is_complete(self):
+        """
+        Tells if all the lines of the store have been checked.
+        :return: True if the filter is up to date.
+        """
+        return self._candidates is None and self._scanned >= len(self._store)
+
+    def get_progress(self):
+        """
+        Gets the fraction of the store already checked.
+        :return: Number between 0 and 1.
+        """
+        if self._candidates is not None:
+            return self._candidate_pos / float(len(self._candidates) + len(self._store) - self._scanned or 1)
+        return self._scanned / float(len(self._store) or 1)
+
+    def get_line_index(self, row):
+        """
+        Gets the index in the store of a matching line.
+        :param row: Rank of the matching line.
+        :return: Index of the line in the store.
+        """
+        return self._matches[row]
+
+    def get_row(self, index):
+        """
+        Gets the rank of the first matching line at or after a line of the store.
+        :param index: Index of the line in the store.
+        :return: Rank of the matching line, len(self) if there is none.
+        """
+        return bisect.bisect_left(self._matches, index)
+
+    def next_match(self, index, backward=False):
+        """
+        Finds the next matching line after (or before) a line, among the lines already checked.
+        :param index: Index of the line in the store, -1 to search from the beginning.
+        :param backward: True to search towards the beginning of the store.
+        :return: Index of the matching line, None if there is none.
+        """
+        matches = self._matches
+        if backward:
+            pos = bisect.bisect_left(matches, index) - 1
+            return matches[pos] if pos >= 0 else None
+        pos = bisect.bisect_right(matches, index)
+        return matches[pos] if pos < len(matches) else None
+
+    def get_range(self, start, stop):
+        """
+        Gets consecutive matching lines.
+        :param start: Rank of the first matching line.
+        :param stop: Rank after the last matching line.
+        :return: List of (line, flags).
+        """
+        return [self._store.get(index) for index in self._matches[max(0, start):stop]]
+
+    def get_times(self, start, stop):
+        """
+        Gets the receive timestamps of consecutive matching lines.
+        :param start: Rank of the first matching line.
+        :param stop: Rank after the last matching line.
+        :return: List of time.perf_counter_ns() values.
+        """
+        return [self._store.get_times(index, index + 1)[0] for index in self._matches[max(0, start):stop]]
+
+    def last_match_time(self, row):
+        """
+        Gets the receive timestamp of the last line detected by the rules before a matching line.
+        :param row: Rank of the matching line.
+        :return: time.perf_counter_ns() value, None if no line was detected before.
+        """
+        if row >= len(self._matches):
+            return self._store.last_match_time(len(self._store))
+        return self._store.last_match_time(self._matches[row])
+
+    def get_spans(self, start, stop):
+        """
+        Gets the highlighted spans of consecutive matching lines.
+        :param start: Rank of the first matching line.
+        :param stop: Rank after the last matching line.
+        :return: Dict {rank: spans} of the lines having spans.
+        """
+        spans = {}
+        for row, index in enumerate(self._matches[max(0, start):stop], max(0, start)):
+            line_spans = self._store.get_spans(index, index + 1).get(index)
+            if line_spans:
+                spans[row] = line_spans
+        return spans
@@ -0,0 +1,555 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Statistics of the ETSM: low-overhead latency histograms of the trigger path, the receive
+timestamps of the lines, the hit counters of the rules and the metrics endpoint.
+"""
+
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+# Offset between the monotonic receive clock (time.perf_counter_ns()) and the wall clock,
+# taken once so that the lines keep their exact spacing whatever the wall clock does.
+_WALL_OFFSET_NS = time.time_ns() - time.perf_counter_ns()
+
+
+class LatencyHistogram(object):
+    """
+    Log-linear histogram of durations in microseconds, precise to about 3%.
+    Recording a value is a few integer operations, without allocation.
+    """
+    SUB_BITS = 5
+    SUB_COUNT = 1 << SUB_BITS
+
+    def __init__(self):
+        self._counts = [0] * (self.SUB_COUNT * 40)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """
+        Records a duration.
+        :param value: Duration in microseconds.
+        """
+        value = int(value)
+        if value < 0:
+            value = 0
+        if value < self.SUB_COUNT:
+            index = value
+        else:
+            shift = value.bit_length() - self.SUB_BITS - 1
+            index = (shift + 1) * self.SUB_COUNT + (value >> shift) - self.SUB_COUNT
+        if index >= len(self._counts):
+            index = len(self._counts) - 1
+        self._counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def _bucket_value(self, index):
+        if index < self.SUB_COUNT:
+            return index
+        shift = index // self.SUB_COUNT - 1
+        return (index % self.SUB_COUNT + self.SUB_COUNT) << shift
+
+    def percentile(self, p):
+        """
+        Gets a percentile of the recorded durations.
+        :param p: The percentile, between 0 and 100.
+        :return: The lower bound of the bucket holding the percentile, in microseconds.
+        """
+        if not self.count:
+            return 0
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Gets the main figures of the histogram.
+        :return: Dict with count, mean, p50, p99 and max, durations in microseconds.
+        """
+        return {'count': self.count,
+                'mean': self.total // self.count if self.count else 0,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+    def reset(self):
+        """
+        Forgets all the recorded durations.
+        """
+        self._counts = [0] * len(self._counts)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+def format_duration(us):
+    """
+    Formats a duration for display.
+    :param us: Duration in microseconds.
+    :return: The duration with its unit.
+    """
+    if us < 1000:
+        return str(us) + "us"
+    if us < 1000000:
+        return "%.1fms" % (us / 1000.0)
+    return "%.2fs" % (us / 1000000.0)
+
+
+def wall_offset_ns():
+    """
+    Gets the offset between the receive timestamps and the wall clock.
+    :return: Nanoseconds to add to a time.perf_counter_ns() value to get a time.time_ns() value.
+    """
+    return _WALL_OFFSET_NS
+
+
+def wall_time(t_ns):
+    """
+    Converts a receive timestamp into a wall clock time.
+    :param t_ns: time.perf_counter_ns() value.
+    :return: Seconds since the epoch, as time.time().
+    """
+    return (t_ns + _WALL_OFFSET_NS) / 1e9
+
+
+def format_timestamp(t_ns):
+    """
+    Formats a receive timestamp as a local time of day.
+    :param t_ns: time.perf_counter_ns() value.
+    :return: HH:MM:SS.ffffff
+    """
+    return datetime.datetime.fromtimestamp(wall_time(t_ns)).strftime('%H:%M:%S.%f')
+
+
+def format_interval(ns):
+    """
+    Formats the interval between two receive timestamps.
+    :param ns: Interval in nanoseconds.
+    :return: +S.ffffff, in seconds.
+    """
+    return "+%.6f" % (ns / 1e9)
+
+
+class LatencyStats(object):
+    """
+    Latencies of the trigger path of a port, all measured from the time the bytes were read:
+    decode (line framed), detect (rules evaluated), dispatch (action about to be triggered)
+    and complete (command written by the write queue of the port, or event emitted).
+    The line stages are kept for the whole port, the action stages for each condition too.
+    """
+    LINE_STAGES = ('decode', 'detect')
+    ACTION_STAGES = ('dispatch', 'complete')
+
+    def __init__(self):
+        self.stages = dict((stage, LatencyHistogram()) for stage in self.LINE_STAGES + self.ACTION_STAGES)
+        self.conditions = {}
+
+    def record_line(self, t_read, t_decode, t_detect):
+        """
+        Records the line stages, times are time.perf_counter_ns() values.
+        """
+        self.stages['decode'].record((t_decode - t_read) // 1000)
+        self.stages['detect'].record((t_detect - t_read) // 1000)
+
+    def record_action(self, cond_id, t_read, t_dispatch, t_complete):
+        """
+        Records the action stages of a triggered condition, times are time.perf_counter_ns() values.
+        """
+        hists = self.conditions.get(cond_id)
+        if hists is None:
+            hists = self.conditions[cond_id] = dict((stage, LatencyHistogram()) for stage in self.ACTION_STAGES)
+        dispatch = (t_dispatch - t_read) // 1000
+        complete = (t_complete - t_read) // 1000
+        hists['dispatch'].record(dispatch)
+        hists['complete'].record(complete)
+        self.stages['dispatch'].record(dispatch)
+        self.stages['complete'].record(complete)
+
+    def summary(self):
+        """
+        Gets the figures of all the histograms.
+        :return: Dict {'stages': {stage: summary}, 'conditions': {cond_id: {stage: summary}}}.
+        """
+        return {'stages': dict((stage, h.summary()) for stage, h in self.stages.items()),
+                'conditions': dict((str(cond_id), dict((stage, h.summary()) for stage, h in hists.items()))
+                                   for cond_id, hists in list(self.conditions.items()))}
+
+    def short_summary(self):
+        """
+        Gets a one line summary of the trigger latency, for a status bar.
+        :return: The summary, '' if no condition was triggered yet.
+        """
+        complete = self.stages['complete']
+        if not complete.count:
+            return ''
+        return ("Trigger p50 " + format_duration(complete.percentile(50)) +
+                " p99 " + format_duration(complete.percentile(99)) +
+                " max " + format_duration(complete.max) + " (" + str(complete.count) + ")")
+
+    def reset(self):
+        """
+        Forgets all the recorded latencies.
+        """
+        for h in self.stages.values():
+            h.reset()
+        self.conditions = {}
+
+
+class RateCounter(object):
+    """
+    Events per second over a sliding window, counted in one bucket per second.
+    """
+    WINDOW = 10
+
+    def __init__(self):
+        self._counts = [0] * self.WINDOW
+        self._seconds = [-1] * self.WINDOW
+        self._first = None
+
+    def add(self, n, now):
+        """
+        Counts events.
+        :param n: Number of events.
+        :param now: Current time.monotonic().
+        """
+        second = int(now)
+        index = second % self.WINDOW
+        if self._seconds[index] != second:
+            if self._first is None:
+                self._first = second
+            self._seconds[index] = second
+            self._counts[index] = 0
+        self._counts[index] += n
+
+    def rate(self, now):
+        """
+        Gets the rate over the complete seconds of the window.
+        :param now: Current time.monotonic().
+        :return: Events per second.
+        """
+        second = int(now)
+        if self._first is None or second <= self._first:
+            return 0.0
+        span = min(self.WINDOW - 1, second - self._first)
+        total = sum(count for count, s in zip(self._counts, self._seconds) if second - span <= s < second)
+        return total / float(span)
+
+
+class RuleStats(object):
+    """
+    Hit counters of a pattern or a condition.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.rate = RateCounter()
+        self.last_time = 0
+        self.last_line = None
+
+
+class PortStats(object):
+    """
+    Counters of a port: received lines and bytes, decode errors, written commands and bytes,
+    and the hits of each pattern and condition, a rule counting once per matching line.
+    The counters are updated by the reader thread and read from any thread.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+        self.decode_errors = 0
+        self.written_commands = 0
+        self.queued_bytes = 0
+        self.written_bytes = 0
+        self.write_calls = 0
+        self.dropped_bytes = 0
+        self.rules = {}
+        self._line_rate = RateCounter()
+        self._byte_rate = RateCounter()
+
+    def record_read(self, size, lines, now):
+        """
+        Records a read from the port.
+        :param size: Number of bytes read.
+        :param lines: Number of lines completed.
+        :param now: Current time.monotonic().
+        """
+        self.bytes += size
+        self._byte_rate.add(size, now)
+        if lines:
+            self.lines += lines
+            self._line_rate.add(lines, now)
+
+    def record_matches(self, matches, line, received, now):
+        """
+        Records the rules matching a line.
+        :param matches: List of (key, start, end) returned by Port.detect.
+        :param line: The matched line.
+        :param received: Receive timestamp of the line, time.perf_counter_ns().
+        :param now: Current time.monotonic().
+        """
+        seen = None
+        for key, start, end in matches:
+            if key[0] != 'pattern' and key[0] != 'condition':
+                continue
+            if seen is None:
+                seen = set()
+            elif key in seen:
+                continue
+            seen.add(key)
+            rule = self.rules.get(key)
+            if rule is None:
+                rule = self.rules[key] = RuleStats()
+            rule.hits += 1
+            rule.rate.add(1, now)
+            rule.last_time = received
+            rule.last_line = line
+
+    def record_queued(self, size):
+        """
+        Records a command queued to be written to the port.
+        :param size: Number of bytes of the command.
+        """
+        self.written_commands += 1
+        self.queued_bytes += size
+
+    def record_write(self, size):
+        """
+        Records a write to the port.
+        :param size: Number of bytes written.
+        """
+        self.write_calls += 1
+        self.written_bytes += size
+
+    def record_drop(self, size):
+        """
+        Records queued bytes which could not be written.
+        :param size: Number of bytes dropped.
+        """
+        self.dropped_bytes += size
+
+    def set_rules(self, keys):
+        """
+        Updates the rules counted: the counters of the unchanged rules are kept, the ones of
+        the removed rules are forgotten.
+        :param keys: The keys of the current rules, ('pattern', pattern) or ('condition', cond_id).
+        """
+        rules = self.rules
+        self.rules = dict((key, rules.get(key) or RuleStats()) for key in keys)
+
+    def summary(self, now=None):
+        """
+        Gets the counters and the rates.
+        :param now: Current time.monotonic(), read if None.
+        :return: Dict with the port counters and 'rules', the list of the rules with their type
+                 ('pattern' or 'condition'), name, id (the pattern or the condition id as stored),
+                 hits, hits per second, last match time (seconds since the epoch, None if it never
+                 matched) and last matched line.
+        """
+        if now is None:
+            now = time.monotonic()
+        rules = []
+        for key, rule in list(self.rules.items()):
+            rules.append({'type': key[0], 'rule': str(key[1]), 'id': key[1], 'hits': rule.hits,
+                          'hits_per_s': round(rule.rate.rate(now), 3),
+                          'last_match': wall_time(rule.last_time) if rule.hits else None,
+                          'last_line': rule.last_line})
+        return {'lines': self.lines, 'lines_per_s': round(self._line_rate.rate(now), 3),
+                'bytes': self.bytes, 'bytes_per_s': round(self._byte_rate.rate(now), 3),
+                'decode_errors': self.decode_errors, 'written_commands': self.written_commands,
+                'queued_bytes': self.queued_bytes, 'written_bytes': self.written_bytes,
+                'write_calls': self.write_calls, 'dropped_bytes': self.dropped_bytes,
+                'pending_bytes': self.queued_bytes - self.written_bytes - self.dropped_bytes, 'rules': rules}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Name, type, help and key in PortStats.summary() of the port metrics.
+_PORT_METRICS = (
+    ('etsm_lines_total', 'counter', 'Lines received.', 'lines'),
+    ('etsm_lines_per_second', 'gauge', 'Lines received per second over the last seconds.', 'lines_per_s'),
+    ('etsm_bytes_total', 'counter', 'Bytes received.', 'bytes'),
+    ('etsm_bytes_per_second', 'gauge', 'Bytes received per second over the last seconds.', 'bytes_per_s'),
+    ('etsm_decode_errors_total', 'counter', 'Bytes which could not be decoded.', 'decode_errors'),
+    ('etsm_written_commands_total', 'counter', 'Commands sent to the port.', 'written_commands'),
+    ('etsm_queued_bytes_total', 'counter', 'Bytes queued to be written to the port.', 'queued_bytes'),
+    ('etsm_written_bytes_total', 'counter', 'Bytes written to the port.', 'written_bytes'),
+    ('etsm_write_calls_total', 'counter', 'Writes to the port.', 'write_calls'),
+    ('etsm_dropped_bytes_total', 'counter', 'Queued bytes which could not be written.', 'dropped_bytes'),
+    ('etsm_pending_bytes', 'gauge', 'Bytes queued and not written yet.', 'pending_bytes'),
+)
+_RULE_METRICS = (
+    ('etsm_rule_hits_total', 'counter', 'Lines matching the rule.', 'hits'),
+    ('etsm_rule_hits_per_second', 'gauge', 'Lines matching the rule per second over the last seconds.',
+     'hits_per_s'),
+    ('etsm_rule_last_match_timestamp_seconds', 'gauge', 'Time of the last line matching the rule.', 'last_match'),
+)
+
+
+def format_metrics(stats):
+    """
+    Formats the counters of the ports in the Prometheus text exposition format.
+    :param stats: Dict {port name: PortStats}.
+    :return: The metrics text.
+    """
+    now = time.monotonic()
+    summaries = [(_label(port_name), port_stats.summary(now)) for port_name, port_stats in stats.items()]
+    lines = []
+    for name, kind, text, field in _PORT_METRICS:
+        lines.append('# HELP ' + name + ' ' + text)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for port_name, summary in summaries:
+            lines.append('%s{port="%s"} %s' % (name, port_name, summary[field]))
+    for name, kind, text, field in _RULE_METRICS:
+        lines.append('# HELP ' + name + ' ' + text)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for port_name, summary in summaries:
+            for rule in summary['rules']:
+                if rule[field] is None:
+                    continue
+                lines.append('%s{port="%s",type="%s",rule="%s"} %s' % (name, port_name, rule['type'],
+                                                                     _label(rule['rule']), rule[field]))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """
+    HTTP server exposing the counters of the ports on /metrics, for Prometheus.
+    Served by a daemon thread, it only listens on the loopback interface by default.
+    """
+
+    def __init__(self, port, source, host='127.0.0.1'):
+        """
+        :param port: TCP port to listen on.
+        :param source: Callable returning the dict {port name: PortStats} to expose.
+        :param host: Address to listen on.
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = format_metrics(source()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='etsm-metrics', daemon=True)
+        self._thread.start()
+
+    def get_address(self):
+        """
+        :return: (host, port) the server listens on.
+        """
+        return self._server.server_address[:2]
+
+    def close(self):
+        """
+        Stops the server.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StartupTimer(object):
+    """
+    Timestamps of the startup steps, relative to the creation of the timer.
+    """
+
+    def __init__(self, start=None):
+        self._start = time.perf_counter() if start is None else start
+        self._marks = []
+        self._reported = 0
+
+    def mark(self, step):
+        """
+        Records the end of a startup step.
+        :param step: Description of the step.
+        """
+        self._marks.append((step, time.perf_counter()))
+
+    def report(self):
+        """
+        Formats the steps recorded since the previous report.
+        :return: One line per step, with the time since the start and since the previous step.
+        """
+        lines = []
+        prev = self._marks[self._reported - 1][1] if self._reported else self._start
+        for step, t in self._marks[self._reported:]:
+            lines.append("%9.1f ms %+9.1f ms  %s" % ((t - self._start) * 1000, (t - prev) * 1000, step))
+            prev = t
+        self._reported = len(self._marks)
+        return "\n".join(lines)
+
+
+def export_latency(filename, stats):
+    """
+    Exports latency summaries, as CSV if the file name ends with .csv, else as JSON.
+    :param filename: The file to write.
+    :param stats: Dict {port name: LatencyStats}.
+    """
+    import csv
+    import json
+    if filename.lower().endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['port', 'condition', 'stage', 'count', 'mean_us', 'p50_us', 'p99_us', 'max_us'])
+            for port_name, latency in stats.items():
+                summary = latency.summary()
+                for stage, s in summary['stages'].items():
+                    writer.writerow([port_name, '', stage, s['count'], s['mean'], s['p50'], s['p99'], s['max']])
+                for cond_id, stages in summary['conditions'].items():
+                    for stage, s in stages.items():
+                        writer.writerow([port_name, cond_id, stage, s['count'], s['mean'], s['p50'], s['p99'],
+                                         s['max']])
+    else:
+        with open(filename, 'w') as f:
+            json.dump(dict((port_name, latency.summary()) for port_name, latency in stats.items()), f, indent=2)
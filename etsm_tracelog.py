@@ -0,0 +1,205 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Continuous trace log of the ETSM, written by a background thread and rotated
+by size and/or age.
+"""
+
+import datetime
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+
+
+def compress_file(path, compress):
+    """
+    Compresses a file next to itself and removes the original.
+    :param path: The file to compress.
+    :param compress: 'gzip' or 'zstd'.
+    :return: The path of the compressed file.
+    """
+    if compress == 'gzip':
+        target = path + '.gz'
+        with open(path, 'rb') as src, gzip.open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    else:
+        import zstandard
+        target = path + '.zst'
+        with open(path, 'rb') as src, open(target, 'wb') as dst:
+            zstandard.ZstdCompressor().copy_stream(src, dst)
+    os.remove(path)
+    return target
+
+
+class TraceLog(object):
+    """
+    Append-only log of the received traces.
+    The reader only queues the lines, the formatting and the buffered writes are done
+    by a background thread which flushes the file as soon as it has nothing left to write.
+    Each record is "<timestamp>\\t<flag>\\t<line>", the flag is 'M' for a matched line,
+    '-' for a plain one and '#' for an event of the ETSM itself.
+    """
+    FLAG_LINE = '-'
+    FLAG_MATCH = 'M'
+    FLAG_EVENT = '#'
+
+    def __init__(self, path, max_bytes=0, rotate_seconds=0, compress='none', keep=0, buffer_size=1 << 16):
+        if compress not in COMPRESSIONS:
+            raise ValueError("Unknown compression " + str(compress) + ".")
+        if compress == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ValueError("zstd compression requires the zstandard package.")
+        self._path = path
+        self._max_bytes = max_bytes
+        self._rotate_seconds = rotate_seconds
+        self._compress = compress
+        self._keep = keep
+        self._buffer_size = buffer_size
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._opened_at = 0
+        self._size = 0
+        self._segments = []
+        self._compressors = []
+        self.lines = 0
+        self.bytes = 0
+        self._open()
+        self._thread = threading.Thread(target=self._run, name='etsm-tracelog', daemon=True)
+        self._thread.start()
+
+    def write(self, line, matched=False, timestamp=None):
+        """
+        Queues a received line, never blocks the caller.
+        :param line: The line received.
+        :param matched: True if the line matched a pattern or a condition.
+        :param timestamp: Reception time (time.time()), now if None.
+        """
+        self._queue.put((timestamp or time.time(), self.FLAG_MATCH if matched else self.FLAG_LINE, line))
+
+    def write_event(self, text, timestamp=None):
+        """
+        Queues a record describing an event of the ETSM itself (reconnection, ...).
+        :param text: Description of the event.
+        :param timestamp: Time of the event, now if None.
+        """
+        self._queue.put((timestamp or time.time(), self.FLAG_EVENT, text))
+
+    def close(self):
+        """
+        Writes the remaining records and closes the log.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        for t in self._compressors:
+            t.join()
+
+    def get_path(self):
+        """
+        Gets the path of the current log file.
+        :return: Path of the log.
+        """
+        return self._path
+
+    def _open(self):
+        self._file = open(self._path, 'ab', buffering=self._buffer_size)
+        self._opened_at = time.time()
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        """
+        Closes the current segment, renames it with its opening date and starts a new one.
+        """
+        self._file.close()
+        stamp = datetime.datetime.fromtimestamp(self._opened_at).strftime('%Y%m%d-%H%M%S')
+        segment = self._path + '.' + stamp
+        n = 1
+        while os.path.exists(segment) or os.path.exists(segment + '.gz') or os.path.exists(segment + '.zst'):
+            segment = self._path + '.' + stamp + '-' + str(n)
+            n += 1
+        os.replace(self._path, segment)
+        self._open()
+        if self._compress != 'none':
+            t = threading.Thread(target=self._finish_segment, args=(segment,), daemon=True)
+            self._compressors = [c for c in self._compressors if c.is_alive()] + [t]
+            t.start()
+        else:
+            self._finish_segment(segment)
+
+    def _finish_segment(self, segment):
+        if self._compress != 'none':
+            segment = compress_file(segment, self._compress)
+        self._segments.append(segment)
+        if self._keep:
+            while len(self._segments) > self._keep:
+                try:
+                    os.remove(self._segments.pop(0))
+                except OSError:
+                    pass
+
+    def _format(self, record):
+        timestamp, flag, text = record
+        stamp = datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='microseconds')
+        return (stamp + '\t' + flag + '\t' + text.rstrip('\r\n') + '\n').encode('utf-8', 'replace')
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                records = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                records = []
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in records:
+                if record is None:
+                    running = False
+                    continue
+                data = self._format(record)
+                self._file.write(data)
+                self._size += len(data)
+                self.lines += 1
+                self.bytes += len(data)
+                if self._max_bytes and self._size >= self._max_bytes:
+                    self._rotate()
+            if self._rotate_seconds and time.time() - self._opened_at >= self._rotate_seconds and self._size:
+                self._rotate()
+            self._file.flush()
+        self._file.close()
@@ -0,0 +1,433 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Detection pool of the ETSM: the rules of the ports are searched in worker processes, so
+heavy rule sets scale over the cores instead of being bound by the GIL of the reader thread.
+
+The reader thread submits the lines of a port as a batch and goes on reading, the batch is
+split into chunks queued for all the workers, so the batches of several ports are searched
+at the same time. Each worker is driven by a thread of the pool, which copies the lines of a
+chunk into the shared memory segment of the worker (uint32 end offsets followed by the UTF-8
+lines), only the matches come back through the pipe. The reader thread of the port fires the
+conditions of its batches in their order once searched, so the state of the sequences and of
+the limits and the order of the actions are kept per port.
+"""
+
+from array import array
+from collections import deque
+from multiprocessing import get_context, shared_memory
+import threading
+import time
+
+from etsm_engine import Hook, PatternMatcher, RegexMatcher, search_rules
+
+SEGMENT_SIZE = 1 << 20
+MIN_CHUNK = 64
+UTILISATION_PERIOD = 1.0
+CLOSE_TIMEOUT = 5.0
+
+
+def _worker(conn, segment_name):
+    """
+    Main loop of a worker process: searches the chunks of lines until it receives None.
+    A task without key only forgets the rule sets of closed ports, nothing is sent back.
+    :param conn: Pipe connection to the pool.
+    :param segment_name: Name of the shared memory segment of the worker.
+    """
+    segment = shared_memory.SharedMemory(segment_name)
+    rule_sets = {}
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            key, version, rules, count, size, lines, discarded = task
+            for old in discarded:
+                rule_sets.pop(old, None)
+            if key is None:
+                continue
+            if rules is not None:
+                rule_sets[key] = (version, PatternMatcher(rules[0]), RegexMatcher(rules[1]))
+            start = time.perf_counter_ns()
+            if lines is None:
+                ends = array('I')
+                ends.frombytes(segment.buf[:4 * count])
+                data = bytes(segment.buf[4 * count:4 * count + size])
+                lines = []
+                pos = 0
+                for end in ends:
+                    lines.append(data[pos:end].decode('utf-8', 'surrogatepass'))
+                    pos = end
+            version, matcher, regex_matcher = rule_sets[key]
+            results = []
+            for line in lines:
+                found = search_rules(matcher, regex_matcher, line)
+                results.append(found if found[0] else None)
+            conn.send((results, time.perf_counter_ns() - start))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        segment.close()
+
+
+class DetectionBatch(object):
+    """
+    Lines of a port submitted to the pool, searched in the background.
+    """
+
+    def __init__(self, chunks):
+        self._found = [None] * chunks
+        self._remaining = chunks
+        self._failed = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def _complete(self, chunk, found):
+        """
+        Stores the matches of a chunk, None if it could not be searched.
+        :return: True if it was the last chunk of the batch.
+        """
+        with self._lock:
+            if found is None:
+                self._failed = True
+            else:
+                self._found[chunk] = found
+            self._remaining -= 1
+            if self._remaining:
+                return False
+        self._done.set()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Waits for the batch to be searched.
+        :param timeout: Maximum time to wait in seconds, None to wait until searched.
+        :return: True if the batch is searched.
+        """
+        return self._done.wait(timeout)
+
+    def is_done(self):
+        """
+        :return: True if the batch is searched.
+        """
+        return self._done.is_set()
+
+    def get_results(self):
+        """
+        Gets the matches of the searched batch.
+        :return: List of (matches, captures) in the order of the lines, None for a line which
+                 did not match. None if the batch could not be searched, the pool being stopped.
+        """
+        if self._failed:
+            return None
+        results = []
+        for found in self._found:
+            results.extend(found)
+        return results
+
+
+class DetectionPool(object):
+    """
+    Pool of worker processes searching the rules of several ports.
+    Thread safe: the reader threads of the ports share the pool.
+    sig_done is emitted, from a thread of the pool, each time a batch is searched or failed,
+    and sig_stopped with the reason when the pool stops after a failure of a worker.
+    """
+
+    def __init__(self, workers, min_batch=8):
+        """
+        :param workers: Number of worker processes.
+        :param min_batch: Smaller batches are searched by the reader thread when nothing of its
+                          port is being searched, the round trip to the workers costing more
+                          than the search.
+        """
+        if workers < 1:
+            raise ValueError("at least one worker is required")
+        self.min_batch = min_batch
+        self.sig_done = Hook()
+        self.sig_stopped = Hook()
+        context = get_context('spawn')
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._jobs = deque()
+        self._closing = False
+        self._rules = {}
+        self._version = 0
+        self._segments = []
+        self._conns = []
+        self._processes = []
+        self._threads = []
+        self._loaded = []
+        self._discarded = []
+        self._busy_ns = [0] * workers
+        self._lines = [0] * workers
+        self._batches = [0] * workers
+        self._failed = False
+        self._error = None
+        self._started = time.monotonic()
+        self._sample = (self._started, list(self._busy_ns))
+        self._utilisation = [0.0] * workers
+        for index in range(workers):
+            segment = shared_memory.SharedMemory(create=True, size=SEGMENT_SIZE)
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, args=(child_conn, segment.name),
+                                      name='etsm-detect-' + str(index), daemon=True)
+            process.start()
+            child_conn.close()
+            self._segments.append(segment)
+            self._conns.append(conn)
+            self._processes.append(process)
+            self._loaded.append({})
+            self._discarded.append(set())
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, args=(index,), name='etsm-detect-io-' + str(index),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def __len__(self):
+        return len(self._processes)
+
+    def set_rules(self, key, keywords, regex):
+        """
+        Registers or replaces a rule set, the workers load it with their next chunk.
+        :param key: Identifier of the rule set, one per port.
+        :param keywords: List of (key, needle) of the PatternMatcher.
+        :param regex: List of (key, pattern) of the RegexMatcher, all valid.
+        """
+        with self._lock:
+            self._version += 1
+            self._rules[key] = (self._version, (keywords, regex))
+
+    def discard_rules(self, key):
+        """
+        Forgets a rule set, in the pool and in the workers.
+        :param key: Identifier of the rule set.
+        """
+        with self._cond:
+            if self._rules.pop(key, None) is None:
+                return
+            for discarded in self._discarded:
+                discarded.add(key)
+            self._cond.notify_all()
+
+    def submit(self, key, lines):
+        """
+        Submits a batch of lines to search, the call does not wait for the workers.
+        The batch is split into chunks of at least MIN_CHUNK lines, searched by all the workers.
+        :param key: Identifier of the rule set.
+        :param lines: List of lines.
+        :return: The DetectionBatch, None if the batch must be searched by the caller: unknown
+                 rule set or pool stopped.
+        """
+        if self._failed or not lines:
+            return None
+        with self._lock:
+            rules = self._rules.get(key)
+        if rules is None:
+            return None
+        step = max(MIN_CHUNK, -(-len(lines) // len(self._threads)))
+        chunks = [lines[i:i + step] for i in range(0, len(lines), step)]
+        batch = DetectionBatch(len(chunks))
+        with self._cond:
+            # Checked again under the lock: once closing, no thread would take the chunks.
+            if self._closing:
+                return None
+            for chunk, chunk_lines in enumerate(chunks):
+                self._jobs.append((batch, chunk, key, rules, chunk_lines))
+            self._cond.notify_all()
+        return batch
+
+    def search(self, key, lines):
+        """
+        Searches a batch of lines in the workers and waits for the matches.
+        :param key: Identifier of the rule set.
+        :param lines: List of lines.
+        :return: List of (matches, captures) in the order of the lines, None for a line which
+                 did not match. None if the batch must be searched by the caller: batch too
+                 small, unknown rule set or pool stopped.
+        """
+        if len(lines) < self.min_batch:
+            return None
+        batch = self.submit(key, lines)
+        if batch is None:
+            return None
+        batch.wait()
+        return batch.get_results()
+
+    def get_error(self):
+        """
+        Gets the reason why the pool stopped.
+        :return: The error, None if the pool runs or was closed.
+        """
+        return self._error
+
+    def _fail(self, error):
+        with self._lock:
+            if self._failed:
+                return
+            self._failed = True
+            self._error = str(error)
+        self.sig_stopped.emit(self._error)
+
+    def _run(self, index):
+        """
+        Drives a worker: sends it the queued chunks one by one and completes their batches,
+        and makes it forget the discarded rule sets.
+        """
+        conn = self._conns[index]
+        while True:
+            with self._cond:
+                while not self._jobs and not self._discarded[index] and not self._closing:
+                    self._cond.wait()
+                if not self._jobs and self._closing:
+                    return
+                job = self._jobs.popleft() if self._jobs else None
+                discarded = list(self._discarded[index])
+                self._discarded[index].clear()
+            for key in discarded:
+                self._loaded[index].pop(key, None)
+            if job is None:
+                if not self._failed:
+                    try:
+                        conn.send((None, 0, None, 0, 0, None, discarded))
+                    except (OSError, ValueError) as e:
+                        self._fail(e)
+                continue
+            batch, chunk, key, rules, lines = job
+            found = None
+            if not self._failed:
+                try:
+                    self._send(index, key, rules, lines, discarded)
+                    found, busy_ns = conn.recv()
+                    self._busy_ns[index] += busy_ns
+                    self._lines[index] += len(lines)
+                    self._batches[index] += 1
+                except (EOFError, OSError, ValueError, BufferError) as e:
+                    self._fail(e)
+            if batch._complete(chunk, found):
+                self.sig_done.emit()
+
+    def _send(self, index, key, rules, lines, discarded):
+        """
+        Sends a chunk to a worker, through its shared memory segment when it fits.
+        """
+        version, rule_set = rules
+        loaded = self._loaded[index]
+        if loaded.get(key) == version:
+            rule_set = None
+        else:
+            loaded[key] = version
+        encoded = [line.encode('utf-8', 'surrogatepass') for line in lines]
+        ends = array('I')
+        pos = 0
+        for data in encoded:
+            pos += len(data)
+            ends.append(pos)
+        header = 4 * len(ends)
+        if header + pos <= SEGMENT_SIZE:
+            buf = self._segments[index].buf
+            buf[:header] = ends.tobytes()
+            buf[header:header + pos] = b''.join(encoded)
+            self._conns[index].send((key, version, rule_set, len(ends), pos, None, discarded))
+        else:
+            self._conns[index].send((key, version, rule_set, len(ends), pos, lines, discarded))
+
+    def get_utilisation(self):
+        """
+        Busy fraction of each worker, averaged over the last UTILISATION_PERIOD seconds.
+        :return: List of floats between 0 and 1, one per worker.
+        """
+        now = time.monotonic()
+        last, busy = self._sample
+        if now - last >= UTILISATION_PERIOD:
+            elapsed_ns = (now - last) * 1e9
+            self._utilisation = [min(1.0, (b - p) / elapsed_ns) for b, p in zip(self._busy_ns, busy)]
+            self._sample = (now, list(self._busy_ns))
+        return list(self._utilisation)
+
+    def stats(self):
+        """
+        Counters of each worker since the start of the pool.
+        :return: List of dict with the lines and chunks searched, the busy time in seconds
+                 and the busy fraction.
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return [{'worker': index, 'lines': self._lines[index], 'chunks': self._batches[index],
+                 'busy': round(self._busy_ns[index] / 1e9, 6),
+                 'utilisation': round(min(1.0, self._busy_ns[index] / 1e9 / elapsed), 4)}
+                for index in range(len(self._processes))]
+
+    def short_summary(self):
+        """
+        :return: Short text with the utilisation of each worker, or why the pool stopped, for the status bar.
+        """
+        if self._error is not None:
+            return "Workers stopped: " + self._error
+        return "Workers " + " ".join("%d%%" % round(u * 100) for u in self.get_utilisation())
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory.
+        The chunks being searched are completed first, the queued ones are failed and searched
+        by the reader threads. A worker not back within CLOSE_TIMEOUT is terminated.
+        """
+        if not self._processes:
+            return
+        with self._cond:
+            self._failed = True
+            self._closing = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        # The threads still waiting for a terminated worker get EOFError.
+        for thread in self._threads:
+            thread.join(1)
+        for conn in self._conns:
+            conn.close()
+        for segment in self._segments:
+            try:
+                segment.close()
+            except BufferError:
+                pass
+            segment.unlink()
+        self._processes = []
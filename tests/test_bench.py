@@ -0,0 +1,77 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import pytest
+
+from etsm_bench import KEYWORD, bench_detect, bench_reaction, bench_throughput, generate_lines
+
+
+def test_generate_lines_is_reproducible():
+    lines = generate_lines(500, 40, 0.1, seed=3)
+    assert lines == generate_lines(500, 40, 0.1, seed=3)
+    assert lines != generate_lines(500, 40, 0.1, seed=4)
+    assert all(len(line) == 40 for line in lines)
+    matching = sum(KEYWORD in line for line in lines)
+    assert 20 < matching < 80
+
+
+def test_generate_lines_without_matches():
+    lines = generate_lines(2000, 80)
+    assert len(lines) == 2000
+    assert not any(KEYWORD in line for line in lines)
+
+
+def test_bench_detect_covers_every_combination():
+    results = bench_detect([0, 4], [0, 2], 200, 40, 0.1, 0)
+    assert [(r['patterns'], r['conditions']) for r in results] == [(0, 0), (0, 2), (4, 0), (4, 2)]
+    assert all(r['lines'] == 200 and r['lines_per_s'] > 0 for r in results)
+
+
+def test_bench_throughput_receives_every_line():
+    result = bench_throughput('loop', generate_lines(2000, 60, 0.01), 0)
+    assert result['lines'] == 2000 and result['lost'] == 0
+    assert result['bytes'] == 2000 * 61
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='needs a pseudo terminal')
+def test_bench_reaction_through_pty():
+    result = bench_reaction(20)
+    assert result['count'] == 20 and result['lost'] == 0
+    assert 0 < result['p50_us'] <= result['max_us']
+    assert result['internal']['count'] == 20
+
+
+def test_bench_gui_displays_every_line():
+    pytest.importorskip('PyQt5')
+    from etsm_bench import bench_gui
+    result = bench_gui(generate_lines(3000, 60, 0.05), 1000)
+    assert result['lines'] == 3000 and result['lines_per_s'] > 0
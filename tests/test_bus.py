@@ -0,0 +1,135 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from etsm_bus import EventBus, EventSubscriber, decode_frames, encode_frame
+from etsm_port import Port
+
+
+@pytest.fixture
+def socket_path():
+    # Short directory, the path of a Unix domain socket is limited to about 100 bytes.
+    directory = tempfile.mkdtemp(prefix='etsm-')
+    yield os.path.join(directory, 'bus.sock')
+    shutil.rmtree(directory)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_frames_decode_as_they_are_completed():
+    data = encode_frame('reboot', 'COM1', 'panic: µs', 12.5) + encode_frame('', '', '', 13.0)
+    buffer = bytearray()
+    messages = []
+    for pos in range(len(data)):
+        buffer.append(data[pos])
+        messages += decode_frames(buffer)
+    assert messages == [(12.5, 'reboot', 'COM1', 'panic: µs'), (13.0, '', '', '')]
+    assert buffer == bytearray()
+
+
+def test_subscribers_receive_published_events(socket_path):
+    bus = EventBus(socket_path)
+    subscribers = [EventSubscriber(socket_path), EventSubscriber(socket_path)]
+    try:
+        assert wait_for(lambda: len(bus.stats()) == 2)
+        for n in range(100):
+            bus.publish('event', 'COM1', 'line %d' % n, 1000.0 + n)
+        for subscriber in subscribers:
+            messages = []
+            while len(messages) < 100:
+                received = subscriber.receive(5)
+                assert received
+                messages += received
+            assert messages == [(1000.0 + n, 'event', 'COM1', 'line %d' % n) for n in range(100)]
+        assert bus.published == 100
+        assert all(stats['queued'] == 100 and stats['dropped'] == 0 for stats in bus.stats())
+    finally:
+        for subscriber in subscribers:
+            subscriber.close()
+        bus.close()
+    assert not os.path.exists(socket_path)
+
+
+def test_slow_subscriber_does_not_block_publisher(socket_path):
+    bus = EventBus(socket_path, max_pending=4096)
+    slow = EventSubscriber(socket_path)
+    try:
+        assert wait_for(lambda: len(bus.stats()) == 1)
+        start = time.monotonic()
+        for n in range(20000):
+            bus.publish('event', 'COM1', 'x' * 200)
+        assert time.monotonic() - start < 5
+        stats = bus.stats()[0]
+        assert stats['dropped'] > 0
+        assert stats['queued'] + stats['dropped'] == 20000
+        assert stats['high_water'] <= 4096
+    finally:
+        slow.close()
+        bus.close()
+
+
+def test_subscriber_sees_bus_closed(socket_path):
+    bus = EventBus(socket_path)
+    subscriber = EventSubscriber(socket_path)
+    assert wait_for(lambda: len(bus.stats()) == 1)
+    bus.close()
+    with pytest.raises(ConnectionError):
+        subscriber.receive(5)
+    subscriber.close()
+
+
+def test_port_publishes_event_conditions(socket_path):
+    bus = EventBus(socket_path)
+    subscriber = EventSubscriber(socket_path)
+    port = Port('loop://', 115200, [], [])
+    port.set_event_bus(bus)
+    port.add_condition(1, 'panic', 'reboot', 'Event')
+    port.add_condition(2, 'login', 'root', 'Command')
+    try:
+        assert wait_for(lambda: len(bus.stats()) == 1)
+        port.detect('login: kernel panic')
+        messages = subscriber.receive(5)
+        assert [message[1:] for message in messages] == [('reboot', 'loop://', 'login: kernel panic')]
+        assert abs(messages[0][0] - time.time()) < 5
+    finally:
+        port.close_port()
+        subscriber.close()
+        bus.close()
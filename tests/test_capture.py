@@ -0,0 +1,162 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from etsm_capture import (FILE_HEADER, FLAG_CONDITION, FLAG_EVENT, FLAG_MATCH, FLAG_PORT, MAGIC, CaptureWriter,
+                          encode_record, read_capture, to_html, to_ndjson, to_text, write_capture)
+from etsm_engine import LineFramer
+from etsm_port import Port
+from etsm_stats import wall_offset_ns
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_framer_keeps_raw_lines():
+    framer = LineFramer('\n', 'utf-8')
+    framer.keep_raw = True
+    assert framer.feed(b'caf\xc3') == []
+    assert framer.feed(b'\xa9 \xff\r\nnext\n') == ['café �', 'next']
+    assert framer.raw_lines == [b'caf\xc3\xa9 \xff', b'next']
+    framer.feed(b'partial\r')
+    assert framer.flush() == 'partial'
+    assert framer.raw_lines == [b'partial']
+
+
+def test_framer_encodes_line_partially_received_before_keep_raw():
+    framer = LineFramer('\n', 'latin-1')
+    framer.feed(b'first \xe9')
+    framer.keep_raw = True
+    assert framer.feed(b'half\nsecond\n') == ['first éhalf', 'second']
+    assert framer.raw_lines == [b'first \xe9half', b'second']
+
+
+def test_capture_keeps_bytes_and_decodes_with_port_encoding(tmp_path):
+    path = str(tmp_path / 'raw.etsmcap')
+    writer = CaptureWriter(path)
+    writer.write_event('COM1', 'Port COM1 reconnected ✓', 1, 'latin-1')
+    writer.write('COM1', b'temp 25\xb0C', FLAG_MATCH, 2, 'latin-1')
+    writer.write('COM2', b'bad \xff byte', 0, 3, 'utf-8')
+    writer.close()
+    records = list(read_capture(path))
+    assert [(r.port, r.flags, r.line, r.data) for r in records] == [
+        ('COM1', FLAG_EVENT, 'Port COM1 reconnected ✓', 'Port COM1 reconnected ✓'.encode('utf-8')),
+        ('COM1', FLAG_MATCH, 'temp 25°C', b'temp 25\xb0C'),
+        ('COM2', 0, 'bad � byte', b'bad \xff byte')]
+
+
+def test_write_capture_stores_text_as_utf8(tmp_path):
+    path = str(tmp_path / 'console.etsmcap')
+    write_capture(path, [('COM1', 'temp 25°C', 0, 1)])
+    records = list(read_capture(path))
+    assert [(r.line, r.data) for r in records] == [('temp 25°C', b'temp 25\xc2\xb0C')]
+
+
+def test_read_skips_record_cut_by_end_of_file(tmp_path):
+    path = tmp_path / 'cut.etsmcap'
+    path.write_bytes(FILE_HEADER.pack(MAGIC, 0) + encode_record(0, 0, FLAG_PORT, b'COM1\0latin-1') +
+                     encode_record(5, 0, 0, b'caf\xe9') + encode_record(6, 0, 0, b'cut line')[:-3])
+    records = list(read_capture(str(path)))
+    assert [(r.port, r.received, r.line) for r in records] == [('COM1', 5, 'café')]
+
+
+def test_read_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.etsmcap'
+    path.write_bytes(b'not a capture at all')
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
+
+
+def sample_capture(tmp_path):
+    path = str(tmp_path / 'sample.etsmcap')
+    write_capture(path, [('COM1', 'boot <ok>', 0, 1000), ('COM1', 'ERR 5', FLAG_MATCH | FLAG_CONDITION, 2000),
+                         ('COM2', 'reconnected', FLAG_EVENT, 3000), ('COM2', 'ERR & more', FLAG_MATCH, 4000)])
+    return path
+
+
+def test_read_by_small_blocks(tmp_path):
+    path = sample_capture(tmp_path)
+    records = list(read_capture(path))
+    assert list(read_capture(path, block_size=7)) == records
+    assert [r.received for r in records] == [1000, 2000, 3000, 4000]
+    assert records[0].timestamp == (1000 + wall_offset_ns()) / 1e9
+
+
+def test_converters(tmp_path):
+    records = list(read_capture(sample_capture(tmp_path)))
+    out = io.StringIO()
+    to_text(records, out)
+    assert [line.split('\t')[1:] for line in out.getvalue().splitlines()] == [
+        ['-', 'COM1', 'boot <ok>'], ['M', 'COM1', 'ERR 5'], ['#', 'COM2', 'reconnected'], ['M', 'COM2', 'ERR & more']]
+    out = io.StringIO()
+    to_ndjson(records, out)
+    converted = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [dict((k, v) for k, v in record.items() if k != 'ts') for record in converted] == [
+        {'type': 'line', 'port': 'COM1', 'line': 'boot <ok>'},
+        {'type': 'match', 'port': 'COM1', 'line': 'ERR 5', 'condition': True},
+        {'type': 'etsm', 'port': 'COM2', 'text': 'reconnected'},
+        {'type': 'match', 'port': 'COM2', 'line': 'ERR & more'}]
+    assert converted[0]['ts'] == records[0].timestamp
+    out = io.StringIO()
+    to_html(records, out)
+    assert 'boot &lt;ok&gt;<br>' in out.getvalue() and 'ERR &amp; more' in out.getvalue()
+
+
+def test_command_line_filters_records(tmp_path):
+    path = sample_capture(tmp_path)
+    output = subprocess.check_output([sys.executable, 'etsm_capture.py', path, '--port', 'COM2', '--matched'],
+                                     cwd=ROOT)
+    assert [line.split(b'\t')[1:] for line in output.splitlines()] == [[b'M', b'COM2', b'ERR & more']]
+
+
+def test_port_captures_received_bytes(tmp_path):
+    path = str(tmp_path / 'port.etsmcap')
+    capture = CaptureWriter(path)
+    port = Port('loop://', 115200, ['ERR'], [], encoding='latin-1')
+    port.set_capture(capture)
+    try:
+        port.get_port().write(b'temp 25\xb0C\nERR\n')
+        deadline = time.monotonic() + 5
+        while port.get_port().in_waiting < 13 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        port.read_available()
+    finally:
+        port.close_port()
+        capture.close()
+    records = [r for r in read_capture(path) if not r.flags & FLAG_EVENT]
+    assert [(r.port, r.line, r.data, bool(r.flags & FLAG_MATCH)) for r in records] == [
+        ('loop://', 'temp 25°C', b'temp 25\xb0C', False), ('loop://', 'ERR', b'ERR', True)]
@@ -0,0 +1,129 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import pytest
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from etsm import HIGHLIGHT_COLOURS, PortTab, condition_colour, highlight_html, match_spans  # noqa: E402
+from etsm_engine import LineBuffer  # noqa: E402
+from etsm_scrollback import FLAG_DETECTED, LineStore  # noqa: E402
+from etsm_stats import format_timestamp  # noqa: E402
+
+
+@pytest.fixture
+def tab():
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    tab = PortTab(None, LineBuffer(1000), LineStore())
+    tab.resize(600, 400)
+    tab.show()
+    app.processEvents()
+    yield tab
+    tab.console_store.close()
+    tab.close()
+
+
+def test_condition_colours_skip_the_pattern_colour():
+    colours = [condition_colour(cond_id) for cond_id in range(1, 2 * len(HIGHLIGHT_COLOURS))]
+    assert set(colours) == set(range(1, len(HIGHLIGHT_COLOURS)))
+    assert condition_colour('boot') == condition_colour('boot')
+    assert 1 <= condition_colour('boot') < len(HIGHLIGHT_COLOURS)
+
+
+def test_match_spans_put_conditions_over_patterns():
+    spans = match_spans([(('condition', 2), 0, 4), (('pattern', 'ERR'), 5, 8), (('rearm', 3), 0, 8),
+                         (('step', 4, 1), 2, 2), (('step', 5, 1), 9, 12)])
+    assert spans == ((5, 8, 0), (0, 4, condition_colour(2)), (9, 12, condition_colour(5)))
+
+
+def test_highlight_html_escapes_device_output():
+    html = highlight_html('a<b & c>', ((0, 3, 0), (2, 5, 1)))
+    assert html == ("<span style='background-color: %s;'>a&lt;</span>"
+                    "<span style='background-color: %s;'>b &amp;</span> c&gt;" % HIGHLIGHT_COLOURS[:2])
+    assert highlight_html('<plain>', ()) == '&lt;plain&gt;'
+
+
+def test_console_keeps_lines_as_plain_text_with_spans(tab):
+    tab.display_buffer.push(('x < y & ERR', [(('pattern', 'ERR'), 8, 11)], 1))
+    tab.display_buffer.push(('<b>not html</b>', None, 2))
+    assert tab.drain_display_buffer(100) == 2
+    store = tab.console_store
+    assert store.get_range(0, 2) == [('x < y & ERR', FLAG_DETECTED), ('<b>not html</b>', 0)]
+    assert store.get_spans(0, 2) == {0: ((8, 11, 0),)}
+    html = ''.join(tab.console_html())
+    assert 'x &lt; y &amp; ' in html and '&lt;b&gt;not html&lt;/b&gt;' in html
+    # Only the visible lines are rendered.
+    tab.zone_console.grab()
+
+
+def test_search_follows_new_lines_and_filters_the_console(tab):
+    for n in range(50):
+        tab.display_port('line %d %s' % (n, 'ERR' if n % 10 == 0 else 'ok'), None)
+    tab.set_search('ERR')
+    assert tab.find() and tab.zone_console.get_current() == 0
+    assert tab.find() and tab.zone_console.get_current() == 10
+    assert tab.find(backward=True) and tab.zone_console.get_current() == 0
+    tab.display_buffer.push(('late ERR', None, 0))
+    tab.drain_display_buffer(100)
+    tab.search.update()
+    assert tab.search.next_match(40) == 50
+    tab.show_filtered(True)
+    tab.zone_console.set_current(None)
+    assert tab.zone_console._store is tab.search
+    assert [tab.find() for _ in range(6)] == [True] * 6
+    assert not tab.find()
+    assert tab.zone_console.get_current() == 5
+    tab.set_search('')
+    assert tab.zone_console._store is tab.console_store
+    assert not tab.find()
+
+
+def test_time_prefixes_of_each_mode(tab):
+    view = tab.zone_console
+    tab.display_port('boot', None, 1000000000)
+    tab.display_port('ERR', [(('pattern', 'ERR'), 0, 3)], 1250000000)
+    tab.display_port('ok', None, 2000000000)
+    tab.display_port('no time', None, 0)
+    lines = tab.console_store.get_range(1, 4)
+    assert view.time_prefixes(1, lines) is None
+    with pytest.raises(ValueError):
+        view.set_time_mode('relative')
+    view.set_time_mode('delta')
+    assert [prefix.strip() for prefix in view.time_prefixes(1, lines)] == ['+0.250000', '+0.750000', '']
+    assert all(len(prefix) == view.TIME_WIDTH for prefix in view.time_prefixes(1, lines))
+    view.set_time_mode('match')
+    assert [prefix.strip() for prefix in view.time_prefixes(0, tab.console_store.get_range(0, 3))] == [
+        '', '', '+0.750000']
+    view.set_time_mode('absolute')
+    assert view.time_prefixes(0, lines[:1])[0].strip() == format_timestamp(1000000000)
+    view.grab()
@@ -0,0 +1,307 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import random
+import re
+import threading
+
+import pytest
+
+from etsm_engine import (CountTracker, LineBuffer, LineFramer, PatternMatcher, RegexMatcher, SequenceTracker,
+                         TriggerLimiter, expand_groups, make_limiter, make_tracker, search_rules)
+
+
+def test_framer_splits_lines_over_reads():
+    framer = LineFramer('\n', 'utf-8')
+    assert framer.feed(b'first\r\nsec') == ['first']
+    assert framer.has_pending()
+    assert framer.feed(b'ond\nthird\n') == ['second', 'third']
+    assert not framer.has_pending()
+
+
+def test_framer_keeps_character_split_over_reads():
+    framer = LineFramer('\n', 'utf-8')
+    assert framer.feed(b'caf\xc3') == []
+    assert framer.feed(b'\xa9\n') == ['café']
+    assert framer.decode_errors == 0
+
+
+def test_framer_replaces_invalid_bytes():
+    framer = LineFramer('\n', 'utf-8')
+    assert framer.feed(b'bad \xff byte\n') == ['bad � byte']
+    assert framer.decode_errors == 1
+
+
+def test_framer_terminators():
+    assert LineFramer('\r', 'utf-8').feed(b'a\rb\r') == ['a', 'b']
+    assert LineFramer('\r\n', 'utf-8').feed(b'a\r\nb\nc\r\n') == ['a', 'b\nc']
+
+
+def test_flush_returns_partial_line():
+    framer = LineFramer('\n', 'utf-8')
+    framer.feed(b'prompt> \r')
+    assert framer.flush() == 'prompt> '
+    assert not framer.has_pending()
+    assert framer.flush() == ''
+
+
+def test_flush_does_not_carry_partial_character_to_next_line():
+    framer = LineFramer('\n', 'utf-8')
+    assert framer.feed(b'abc\xc3') == []
+    assert framer.has_pending()
+    assert framer.flush() == 'abc�'
+    assert framer.feed(b'next\n') == ['next']
+
+
+def test_reset_drops_partial_line():
+    framer = LineFramer('\n', 'utf-8')
+    framer.feed(b'lost \xc3')
+    framer.reset()
+    assert not framer.has_pending()
+    assert framer.feed(b'kept\n') == ['kept']
+
+
+def naive_search(keywords, text):
+    matches = []
+    for key, needle in keywords:
+        start = text.find(needle)
+        while start >= 0:
+            matches.append((key, start, start + len(needle)))
+            start = text.find(needle, start + 1)
+    return sorted(matches, key=lambda m: (m[2], -m[1]))
+
+
+def test_matcher_finds_overlapping_keywords():
+    keywords = [('he', 'he'), ('she', 'she'), ('his', 'his'), ('hers', 'hers')]
+    matcher = PatternMatcher(keywords)
+    assert len(matcher) == 4
+    assert sorted(matcher.search('ushers')) == [('he', 2, 4), ('hers', 2, 6), ('she', 1, 4)]
+
+
+def test_matcher_agrees_with_naive_search():
+    rng = random.Random(1)
+    keywords = [(n, ''.join(rng.choice('abc') for _ in range(rng.randint(1, 4)))) for n in range(50)]
+    matcher = PatternMatcher(keywords)
+    for _ in range(200):
+        text = ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 30)))
+        assert sorted(matcher.search(text)) == sorted(naive_search(keywords, text))
+
+
+def test_matcher_reports_every_key_of_a_needle():
+    matcher = PatternMatcher([(('pattern', 'ERR'), 'ERR'), (('condition', 1), 'ERR'), (('condition', 2), '')])
+    assert sorted(matcher.search('an ERR')) == [(('condition', 1), 3, 6), (('pattern', 'ERR'), 3, 6)]
+
+
+def test_matcher_build_replaces_keywords():
+    matcher = PatternMatcher([('a', 'foo')])
+    matcher.build([('b', 'bar')])
+    assert matcher.search('foo bar') == [('b', 4, 7)]
+    assert PatternMatcher().search('foo') == []
+
+
+def test_line_buffer_drains_in_order_by_batches():
+    buffer = LineBuffer(10)
+    for n in range(5):
+        buffer.push(n)
+    assert buffer.drain(3) == ([0, 1, 2], 0)
+    assert buffer.drain() == ([3, 4], 0)
+    assert buffer.drain() == ([], 0)
+    assert buffer.pushed == 5 and buffer.high_water == 5
+
+
+def test_line_buffer_drops_oldest_when_full():
+    buffer = LineBuffer(3)
+    for n in range(5):
+        buffer.push(n)
+    assert len(buffer) == 3
+    assert buffer.dropped == 2
+    assert buffer.drain() == ([2, 3, 4], 0)
+
+
+def test_line_buffer_summarise_reports_skipped_lines():
+    buffer = LineBuffer(2, LineBuffer.SUMMARISE)
+    for n in range(5):
+        buffer.push(n)
+    assert buffer.drain() == ([3, 4], 3)
+    buffer.push(5)
+    assert buffer.drain() == ([5], 0)
+
+
+def test_line_buffer_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        LineBuffer(10, 'block')
+
+
+def test_line_buffer_is_thread_safe():
+    buffer = LineBuffer(100000)
+    threads = [threading.Thread(target=lambda: [buffer.push(n) for n in range(10000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    drained = 0
+    while any(thread.is_alive() for thread in threads):
+        drained += len(buffer.drain(1000)[0])
+    drained += len(buffer.drain()[0])
+    assert drained == buffer.pushed == 40000
+
+
+def naive_regex_search(rules, text):
+    matches = []
+    for key, pattern in rules:
+        m = re.search(pattern, text)
+        if m:
+            matches.append((key, m.start(), m.end(), m.groups()))
+    return sorted(matches)
+
+
+def test_regex_matcher_agrees_with_each_rule_searched_apart():
+    rules = [(1, r'ERR code=(\d+)'), (2, r'(a|ab)(c|bcd)'), (3, r'x*'), (4, r'o(k)?'), (5, r'^boot'), (6, r'\d$')]
+    matcher = RegexMatcher(rules)
+    for text in ['boot ok', 'ERR code=42 abcd', 'xx ERR code=7', 'nothing', '', 'abcd 12', 'ko ok 9']:
+        found = sorted((key, start, end, groups) for key, start, end, groups, named in matcher.search(text))
+        assert found == naive_regex_search(rules, text), text
+
+
+def test_regex_matcher_keeps_apart_rules_that_cannot_be_combined():
+    matcher = RegexMatcher([(1, r'(\w)\1'), (2, r'id=(?P<id>\d+)'), (3, r'(?i)warn'), (4, 'done')])
+    assert len(matcher) == 4
+    found = dict((key, (start, end, groups, named)) for key, start, end, groups, named in matcher.search(
+        'WARN id=12 aa done'))
+    assert found[1] == (11, 13, ('a',), {})
+    assert found[2] == (5, 10, ('12',), {'id': '12'})
+    assert found[3][:2] == (0, 4)
+    assert found[4][:2] == (14, 18)
+
+
+def test_regex_matcher_rejects_invalid_pattern():
+    with pytest.raises(re.error):
+        RegexMatcher([(1, 'ERR (')])
+
+
+def test_search_rules_merges_keywords_and_regexes():
+    matcher = PatternMatcher([(('pattern', 'ERR'), 'ERR')])
+    regex_matcher = RegexMatcher([(('condition', 1), r'code=(\d+)')])
+    matches, captures = search_rules(matcher, regex_matcher, 'code=5 ERR')
+    assert matches == [(('condition', 1), 0, 6), (('pattern', 'ERR'), 7, 10)]
+    assert captures == {('condition', 1): (('5',), {})}
+    assert search_rules(matcher, regex_matcher, 'ERR') == ([(('pattern', 'ERR'), 0, 3)], None)
+
+
+def test_expand_groups():
+    assert expand_groups(r'dump \1', ('42',)) == 'dump 42'
+    assert expand_groups(r'dump \g<1> \g<id>', ('42',), {'id': '7'}) == 'dump 42 7'
+    assert expand_groups(r'dump \1\2', ('42', None)) == 'dump 42'
+    assert expand_groups(r'dump \3 \g<other>', ('42',), {}) == r'dump \3 \g<other>'
+    assert expand_groups(r'dump \1', ()) == r'dump \1'
+
+
+def test_sequence_fires_when_steps_are_seen_in_order():
+    tracker = SequenceTracker(3, 0.5)
+    assert not tracker.feed(1, 0.0)
+    assert not tracker.feed(0, 0.1)
+    assert not tracker.feed(2, 0.2)
+    assert not tracker.feed(1, 0.3)
+    assert tracker.feed(2, 0.4)
+    # Starts over once complete.
+    assert not tracker.feed(2, 0.45)
+
+
+def test_sequence_window_counts_from_the_latest_start():
+    tracker = SequenceTracker(2, 0.5)
+    tracker.feed(0, 0.0)
+    assert not tracker.feed(1, 0.6)
+    tracker.feed(0, 1.0)
+    tracker.feed(0, 1.4)
+    assert tracker.feed(1, 1.8)
+
+
+def test_sequence_without_window_and_reset():
+    tracker = SequenceTracker(2)
+    tracker.feed(0, 0.0)
+    assert tracker.feed(1, 1000.0)
+    tracker.feed(0, 1001.0)
+    tracker.reset()
+    assert not tracker.feed(1, 1002.0)
+
+
+def test_count_fires_on_occurrences_within_window():
+    tracker = CountTracker(3, 1.0)
+    assert [tracker.feed(0, now) for now in (0.0, 0.5, 1.2, 1.4)] == [False, False, False, True]
+    assert not tracker.feed(0, 1.5)
+    tracker.reset()
+    assert [tracker.feed(0, now) for now in (2.0, 2.1, 2.2)] == [False, False, True]
+
+
+def test_make_tracker():
+    assert isinstance(make_tracker(('sequence', ('B', 'C'), 500)), SequenceTracker)
+    tracker = make_tracker(('count', 2, 0))
+    assert not tracker.feed(0, 0.0) and tracker.feed(0, 100.0)
+    with pytest.raises(ValueError):
+        make_tracker(('window', 2, 0))
+
+
+def allowed(limiter, times):
+    return [now for now in times if limiter.allow(now)]
+
+
+def test_debounce_fires_again_after_quiet_period():
+    limiter = TriggerLimiter(debounce=100)
+    assert allowed(limiter, [0.0, 0.05, 0.1, 0.15, 0.3, 0.35]) == [0.0, 0.3]
+    assert limiter.suppressed['debounce'] == 4 and limiter.fired == 2
+
+
+def test_cooldown_counts_from_last_fired_trigger():
+    limiter = TriggerLimiter(cooldown=100)
+    assert allowed(limiter, [0.0, 0.05, 0.1, 0.15, 0.21]) == [0.0, 0.1, 0.21]
+    assert limiter.suppressed['cooldown'] == 2
+
+
+def test_rate_allows_burst_then_average_rate():
+    limiter = TriggerLimiter(rate=10, burst=3)
+    assert allowed(limiter, [0.0] * 5) == [0.0] * 3
+    assert allowed(limiter, [0.05, 0.1, 0.15, 0.2]) == [0.1, 0.2]
+    assert limiter.suppressed['rate'] == 4
+
+
+def test_once_until_rearmed():
+    limiter = TriggerLimiter(once=True)
+    assert allowed(limiter, [0.0, 1.0, 2.0]) == [0.0]
+    assert not limiter.is_armed()
+    limiter.rearm()
+    assert limiter.is_armed()
+    assert allowed(limiter, [3.0, 4.0]) == [3.0]
+    assert limiter.get_suppressed() == 3
+
+
+def test_make_limiter():
+    assert make_limiter(None) is None and make_limiter({}) is None
+    limiter = make_limiter({'once': True, 'rearm': 'login:'})
+    assert limiter.allow(0.0) and not limiter.allow(1.0)
+    with pytest.raises(ValueError):
+        make_limiter({'delay': 5})
@@ -0,0 +1,80 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import etsm_headless
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_headless(tmp_path, config, *options):
+    config_path = tmp_path / 'board.json'
+    config_path.write_text(json.dumps(config))
+    output = tmp_path / 'events.ndjson'
+    # main() installs its own SIGINT/SIGTERM handlers.
+    handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    try:
+        assert etsm_headless.main(['-p', 'loop://', '-c', str(config_path), '-o', str(output)] + list(options)) == 0
+    finally:
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
+    return [json.loads(line) for line in output.read_text().splitlines()]
+
+
+def test_streams_matches_and_events(tmp_path):
+    records = run_headless(tmp_path, {'patterns': ['pong'], 'commands': ['ping'],
+                                      'conditions': [{'pattern': 'ping', 'action': 'pong'},
+                                                     {'pattern': 'pong', 'action': 'got pong', 'type': 'Event'}]},
+                           '--duration', '1.5')
+    types = [record['type'] for record in records]
+    assert types[0] == 'start' and types[-1] == 'stop'
+    assert all('ts' in record for record in records)
+    matches = [record for record in records if record['type'] == 'match']
+    assert [record['line'] for record in matches] == ['ping', 'pong']
+    assert matches[0]['port'] == 'loop://'
+    assert matches[0]['matches'] == [{'rule': 'condition', 'id': 1, 'start': 0, 'end': 4}]
+    assert {'rule': 'pattern', 'id': 'pong', 'start': 0, 'end': 4} in matches[1]['matches']
+    assert [record['event'] for record in records if record['type'] == 'event'] == ['got pong']
+
+
+def test_all_lines_outputs_plain_lines(tmp_path):
+    records = run_headless(tmp_path, {'commands': ['hello']}, '--duration', '1', '--all-lines')
+    assert [record['line'] for record in records if record['type'] == 'line'] == ['hello']
+
+
+def test_does_not_import_qt():
+    code = 'import sys, etsm_headless; print(sorted(m for m in sys.modules if m.startswith(("PyQt", "pyqtgraph"))))'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    assert output.strip() == b'[]'
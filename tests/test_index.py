@@ -0,0 +1,155 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+from etsm_index import TraceIndex
+from etsm_scrollback import FLAG_DETECTED, LineFilter, LineStore
+
+LINES = ['boot ok', 'ERR timeout', 'retry ok', '  ERR', 'done ERR']
+
+
+def open_index(tmp_path, lines):
+    trace = tmp_path / 'trace.log'
+    trace.write_bytes(('\n'.join(lines) + '\n').encode('utf-8'))
+    return TraceIndex(str(trace))
+
+
+def filter_lines(lines, pattern):
+    store = LineStore()
+    for line in lines:
+        store.append(line)
+    line_filter = LineFilter(store, pattern)
+    line_filter.update()
+    return [line_filter.get_line_index(row) for row in range(len(line_filter))]
+
+
+def test_anchors_match_each_line(tmp_path):
+    index = open_index(tmp_path, LINES)
+    try:
+        assert list(index.matches('re:^ERR')) == [1]
+        assert list(index.matches('re:ERR$')) == [3, 4]
+    finally:
+        index.close()
+
+
+def test_match_does_not_span_lines(tmp_path):
+    index = open_index(tmp_path, LINES)
+    try:
+        assert list(index.matches(r're:ok\s+ERR')) == []
+        assert list(index.matches(r're:ok\s*')) == [0, 2]
+    finally:
+        index.close()
+
+
+def test_matches_agree_with_line_filter(tmp_path):
+    index = open_index(tmp_path, LINES)
+    try:
+        for pattern in ['ERR', 're:^ERR', 're:ERR$', r're:ok\s+ERR', r're:^\s+ERR$', 're:o.*E']:
+            assert list(index.matches(pattern)) == filter_lines(LINES, pattern), pattern
+    finally:
+        index.close()
+
+
+def record_builds(monkeypatch):
+    offsets = []
+    build_lines = TraceIndex._build_lines
+
+    def build(self, starts, offset):
+        offsets.append(offset)
+        return build_lines(self, starts, offset)
+    monkeypatch.setattr(TraceIndex, '_build_lines', build)
+    return offsets
+
+
+def test_sidecar_is_reused_and_extended(tmp_path, monkeypatch):
+    # Larger than the head of the trace checked to tell an appended trace from a replaced one.
+    lines = LINES * 200
+    expected = [n for n, line in enumerate(lines) if 'ERR' in line]
+    offsets = record_builds(monkeypatch)
+    index = open_index(tmp_path, lines)
+    assert list(index.matches('ERR')) == expected
+    index.close()
+    assert 'lines' in os.listdir(str(tmp_path / 'trace.log.etsmidx'))
+    assert offsets == [0]
+    trace = tmp_path / 'trace.log'
+    size = trace.stat().st_size
+    index = TraceIndex(str(trace))
+    assert offsets == [0]
+    assert len(index) == len(lines)
+    index.close()
+    with open(str(trace), 'ab') as f:
+        f.write(b'late ERR\nok\n')
+    index = TraceIndex(str(trace))
+    try:
+        assert offsets == [0, size]
+        assert len(index) == len(lines) + 2
+        assert list(index.matches('ERR')) == expected + [len(lines)]
+    finally:
+        index.close()
+
+
+def test_replaced_trace_is_indexed_again(tmp_path):
+    open_index(tmp_path, LINES).close()
+    index = open_index(tmp_path, ['other ERR'] + LINES)
+    try:
+        assert len(index) == len(LINES) + 1
+        assert list(index.matches('ERR')) == [0, 2, 4, 5]
+    finally:
+        index.close()
+
+
+def test_refresh_follows_a_growing_trace(tmp_path):
+    index = open_index(tmp_path, LINES)
+    trace = str(tmp_path / 'trace.log')
+    try:
+        assert list(index.matches('ERR')) == [1, 3, 4]
+        with open(trace, 'ab') as f:
+            f.write(b'partial ER')
+        assert index.refresh() == len(LINES) + 1
+        assert index.get(-1) == ('partial ER', 0)
+        assert list(index.matches('ERR')) == [1, 3, 4]
+        with open(trace, 'ab') as f:
+            f.write(b'R\n')
+        assert index.refresh() == len(LINES) + 1
+        assert list(index.matches('ERR')) == [1, 3, 4, 5]
+        assert index.next_match('ERR', 4) == 5
+        assert index.next_match('ERR', 1, backward=True) is None
+    finally:
+        index.close()
+
+
+def test_trace_log_records_keep_their_match_flag(tmp_path):
+    index = open_index(tmp_path, ['2026-01-01T00:00:00.000000\tM\tERR', '2026-01-01T00:00:00.000001\t-\tok'])
+    try:
+        assert index.get(0)[1] == FLAG_DETECTED
+        assert index.get(1)[1] == 0
+    finally:
+        index.close()
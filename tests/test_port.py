@@ -0,0 +1,318 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+
+from etsm_port import Port, PortGroup
+from etsm_workers import DetectionPool
+
+
+def make_port(patterns=(), **kwargs):
+    return Port('loop://', 115200, list(patterns), [], **kwargs)
+
+
+def test_detect_fires_each_condition_once_in_order():
+    port = make_port(['boot'])
+    port.add_condition(1, 'ready', 'second', 'Event')
+    port.add_condition(2, 'login', 'first', 'Event')
+    fired = []
+    port.sig_pattern_detected.connect(fired.append)
+    try:
+        matches = port.detect('boot: login, ready, login')
+        assert fired == ['first', 'second']
+        assert sorted(key for key, start, end in matches) == [('condition', 1), ('condition', 2), ('condition', 2),
+                                                              ('pattern', 'boot')]
+        assert port.detect('nothing') == []
+    finally:
+        port.close_port()
+
+
+def test_regex_condition_substitutes_groups_into_actions():
+    port = make_port()
+    port.add_condition(1, r'ERR code=(\d+)', r'dump \1', 'Command', regex=True)
+    port.add_condition(2, r'state=(?P<state>\w+)', r'state \g<state>', 'Event', regex=True)
+    fired = []
+    port.sig_pattern_detected.connect(fired.append)
+    try:
+        matches = port.detect('ERR code=42 state=idle')
+        assert sorted(key for key, start, end in matches) == [('condition', 1), ('condition', 2)]
+        assert fired == ['state idle']
+        assert wait_for(lambda: port.get_port().in_waiting == 8)
+        assert port.get_port().read(8) == b'dump 42\r'
+    finally:
+        port.close_port()
+
+
+def test_triggered_conditions_record_their_latency():
+    port = make_port()
+    port.add_condition(1, 'ping', 'pong', 'Command')
+    port.add_condition(2, 'ping', 'seen', 'Event')
+    try:
+        port.get_port().write(b'ping\n')
+        assert wait_for(lambda: port.get_port().in_waiting)
+        port.read_available()
+        # The command is complete once written by the write queue.
+        assert wait_for(lambda: port.get_latency().stages['complete'].count == 2)
+        conditions = port.get_latency().summary()['conditions']
+        assert sorted(conditions) == ['1', '2']
+        for stages in conditions.values():
+            assert stages['dispatch']['count'] == stages['complete']['count'] == 1
+            assert stages['dispatch']['max'] <= stages['complete']['max']
+        assert port.get_latency().summary()['stages']['detect']['count'] == 1
+    finally:
+        port.close_port()
+
+
+def detect_at(port, line, now):
+    # The rules are timed by the receive time of the line.
+    port._last_rx = now
+    return port.detect(line)
+
+
+def test_sequence_and_count_conditions_fire_when_complete():
+    port = make_port()
+    port.add_condition(1, 'watchdog armed', 'reset', 'Event', rule=('sequence', ('stalled',), 500))
+    port.add_condition(2, 'ERR', 'storm', 'Event', rule=('count', 3, 1000))
+    fired = []
+    port.sig_pattern_detected.connect(fired.append)
+    try:
+        detect_at(port, 'watchdog armed', 10.0)
+        matches = detect_at(port, 'task 3 stalled', 10.3)
+        assert [key for key, start, end in matches] == [('step', 1, 1)]
+        assert fired == ['reset']
+        detect_at(port, 'watchdog armed', 20.0)
+        detect_at(port, 'task 3 stalled', 21.0)
+        assert fired == ['reset']
+        # Each rule counts once per line.
+        detect_at(port, 'ERR ERR', 30.0)
+        detect_at(port, 'ERR', 30.5)
+        assert fired == ['reset']
+        detect_at(port, 'ERR', 30.9)
+        assert fired == ['reset', 'storm']
+    finally:
+        port.close_port()
+
+
+def test_limited_conditions_do_not_storm():
+    port = make_port()
+    port.add_condition(1, 'ERR loop', 'reset', 'Command', limit={'cooldown': 1000})
+    port.add_condition(2, 'panic', 'dump', 'Event', limit={'once': True, 'rearm': 'login:'})
+    fired = []
+    port.sig_pattern_detected.connect(fired.append)
+    try:
+        for n in range(50):
+            detect_at(port, 'ERR loop panic', 10.0 + n * 0.01)
+        assert wait_for(lambda: port.get_port().in_waiting == 6)
+        assert fired == ['dump']
+        detect_at(port, 'login:', 11.0)
+        detect_at(port, 'panic', 11.1)
+        assert fired == ['dump', 'dump']
+        counters = port.get_trigger_counters()
+        assert counters[1] == {'fired': 1, 'suppressed': {'debounce': 0, 'cooldown': 49, 'rate': 0, 'once': 0},
+                               'armed': True}
+        assert counters[2]['fired'] == 2 and counters[2]['suppressed']['once'] == 49
+        assert not counters[2]['armed']
+    finally:
+        port.close_port()
+
+
+def test_lines_carry_their_receive_time():
+    port = make_port()
+    received = []
+    port.sig_line_received.connect(lambda line, matches, t: received.append((line, t)))
+    try:
+        port.get_port().write(b'first\nsecond\n')
+        assert wait_for(lambda: port.get_port().in_waiting == 13)
+        before = time.perf_counter_ns()
+        port.read_available()
+        after = time.perf_counter_ns()
+        assert [line for line, t in received] == ['first', 'second']
+        # The lines read at once share the time of the read.
+        assert before <= received[0][1] == received[1][1] <= after
+    finally:
+        port.close_port()
+
+
+def test_send_command_writes_to_port():
+    port = make_port()
+    try:
+        assert port.send_command('reboot')
+        assert port.get_port().read(7) == b'reboot\r'
+    finally:
+        port.close_port()
+
+
+def test_send_command_on_closed_port_returns_false():
+    port = make_port()
+    port.close_port()
+    assert not port.send_command('reboot')
+    assert port.get_stats().written_commands == 0
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_group_reads_ports_and_routes_commands():
+    group = PortGroup()
+    first = make_port()
+    second = make_port()
+    first.add_condition(1, 'ping', 'pong', 'Command', 'second')
+    second._port_name = 'second'
+    received = []
+    second.sig_line_received.connect(lambda line, matches, t: received.append(line))
+    group.add(first)
+    group.add(second)
+    group.start()
+    try:
+        first.get_port().write(b'ping\n')
+        # The command is written to the loop of the second port, which reads it back as a
+        # partial line, flushed once idle.
+        assert wait_for(lambda: received == ['pong'])
+    finally:
+        group.close()
+        first.close_port()
+        second.close_port()
+
+
+def test_group_reads_many_ports_in_one_thread():
+    group = PortGroup()
+    ports = [make_port(['ERR%d' % index]) for index in range(8)]
+    received = [[] for port in ports]
+    for index, port in enumerate(ports):
+        port._port_name = 'port' + str(index)
+        port.sig_line_received.connect(
+            lambda line, matches, t, index=index: received[index].append((line, bool(matches))))
+        group.add(port)
+    group.start()
+    try:
+        for index, port in enumerate(ports):
+            port.get_port().write(('ERR%d\nERR%d\n' % (index, (index + 1) % 8)).encode())
+        assert wait_for(lambda: all(len(lines) == 2 for lines in received))
+        assert received == [[('ERR%d' % index, True), ('ERR%d' % ((index + 1) % 8), False)] for index in range(8)]
+        readers = [thread.name for thread in threading.enumerate() if thread.name.startswith('etsm-rx')]
+        assert readers == ['etsm-rx']
+    finally:
+        group.close()
+        for port in ports:
+            port.close_port()
+
+
+def test_group_send_command_to_unknown_port():
+    group = PortGroup()
+    port = make_port()
+    port._port_name = 'board'
+    group.add(port)
+    try:
+        assert group.get('board') is port
+        assert group.get('other') is None
+        assert not group.send_command('other', 'reboot')
+        assert group.send_command('board', 'reboot')
+        assert wait_for(lambda: port.get_port().in_waiting == 7)
+    finally:
+        group.close()
+        port.close_port()
+
+
+def test_supervisor_gives_reconnected_port_back():
+    group = PortGroup()
+    port = make_port()
+    group.add(port)
+    group.start()
+    try:
+        group._lose(port)
+        assert wait_for(lambda: port in list(group) and port.is_connected())
+    finally:
+        group.close()
+        port.close_port()
+
+
+def test_lost_port_removed_from_group_is_not_supervised():
+    group = PortGroup()
+    port = make_port()
+    group.add(port)
+    group.remove(port)
+    group._lose(port)
+    assert port.is_connected()
+    assert port.get_port().is_open
+    assert group._supervisor._lost == []
+    port.close_port()
+
+
+def test_reconnect_reopens_port():
+    port = make_port(['boot'])
+    received = []
+    port.sig_line_received.connect(lambda line, matches, t: received.append((line, bool(matches))))
+    port.disconnected()
+    assert not port.is_connected()
+    assert port.reconnect()
+    assert port.is_connected()
+    port.get_port().write(b'boot done\n')
+    assert wait_for(lambda: port.get_port().in_waiting)
+    port.read_available()
+    assert received == [('boot done', True)]
+    port.close_port()
+
+
+def test_group_fires_conditions_in_order_with_detection_pool():
+    pool = DetectionPool(2, min_batch=4)
+    group = PortGroup()
+    ports = [make_port(), make_port()]
+    received = [[], []]
+    try:
+        for index, port in enumerate(ports):
+            port._port_name = 'port' + str(index)
+            port.set_detection_pool(pool)
+            port.add_pattern('ERR')
+            port.sig_line_received.connect(
+                lambda line, matches, t, index=index: received[index].append((line, bool(matches))))
+            group.add(port)
+        group.start()
+        expected = []
+        for n in range(300):
+            line = 'line %d %s' % (n, 'ERR' if n % 7 == 0 else 'ok')
+            expected.append((line, n % 7 == 0))
+        for chunk in range(0, 300, 50):
+            for port in ports:
+                port.get_port().write(''.join(line + '\n' for line, matched in expected[chunk:chunk + 50]).encode())
+            time.sleep(0.01)
+        assert wait_for(lambda: len(received[0]) == 300 and len(received[1]) == 300)
+        assert received[0] == expected and received[1] == expected
+        assert sum(worker['lines'] for worker in pool.stats()) > 0
+    finally:
+        group.close()
+        for port in ports:
+            port.close_port()
+        assert pool._rules == {}
+        pool.close()
@@ -0,0 +1,205 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+
+import pytest
+
+from etsm_engine import Hook
+from etsm_scheduler import CommandScheduler, parse_delay, parse_script
+
+
+class FakeWriteQueue(object):
+    def pending(self):
+        return 0
+
+    def is_idle(self):
+        return True
+
+
+class FakePort(object):
+    """
+    Port receiving the lines emitted by the test instead of a device.
+    """
+
+    def __init__(self):
+        self.sig_line_received = Hook()
+        self.sent = []
+        self.is_open = True
+
+    def get_write_queue(self):
+        return FakeWriteQueue()
+
+    def get_port_name(self):
+        return 'fake'
+
+    def send_command(self, command):
+        if not self.is_open:
+            return False
+        self.sent.append(command)
+        return True
+
+    def receive(self, line):
+        self.sig_line_received.emit(line, [], time.perf_counter_ns())
+
+
+class PreemptedScheduler(CommandScheduler):
+    """
+    Scheduler whose thread is preempted after starting each expect step, before it
+    schedules the step again.
+    """
+
+    def _step(self, job):
+        starting = job.deadline is None
+        delay = CommandScheduler._step(self, job)
+        if starting and job.deadline is not None:
+            time.sleep(0.3)
+        return delay
+
+
+def run_script(scheduler, port, lines, timeout=10):
+    job = scheduler.submit(port, parse_script(lines), 'test')
+    start = time.monotonic()
+    while not job.done and time.monotonic() - start < timeout:
+        time.sleep(0.005)
+    return job, time.monotonic() - start
+
+
+def test_expect_continues_when_line_received():
+    port = FakePort()
+    scheduler = CommandScheduler()
+    threading.Timer(0.05, port.receive, ('login: ',)).start()
+    job, elapsed = run_script(scheduler, port, ['expect login: 5000', 'root'])
+    scheduler.stop()
+    assert job.done and port.sent == ['root']
+    assert job.results[0]['matched'] and elapsed < 1
+
+
+def test_expect_wake_during_step_is_not_lost():
+    # The line is received while the scheduler thread is still running the expect step:
+    # the wake-up must not be replaced by the timeout of the step.
+    port = FakePort()
+    scheduler = PreemptedScheduler()
+    threading.Timer(0.05, port.receive, ('OK',)).start()
+    job, elapsed = run_script(scheduler, port, ['expect OK 5000'])
+    scheduler.stop()
+    assert job.done and job.results[0]['matched']
+    assert elapsed < 1
+
+
+def test_expect_timeout_branches():
+    port = FakePort()
+    scheduler = CommandScheduler()
+    job, elapsed = run_script(scheduler, port, ['send_and_expect ping pong 50 else goto end', 'skipped',
+                                                'label end', 'expect nothing 50 else continue', 'last'])
+    scheduler.stop()
+    assert port.sent == ['ping', 'last']
+    assert [r['action'] for r in job.results] == ['goto end', 'continue']
+
+
+def test_expect_timeout_aborts():
+    port = FakePort()
+    scheduler = CommandScheduler()
+    job, elapsed = run_script(scheduler, port, ['expect nothing 50', 'unreachable'])
+    scheduler.stop()
+    assert job.done and port.sent == []
+    assert job.results[0]['action'] == 'abort'
+
+
+def test_lines_before_command_do_not_match():
+    port = FakePort()
+    scheduler = CommandScheduler()
+    port.receive('pong')
+    job, elapsed = run_script(scheduler, port, ['send_and_expect ping pong 100 else continue'])
+    scheduler.stop()
+    assert not job.results[0]['matched']
+
+
+def test_script_aborted_when_port_closed():
+    port = FakePort()
+    port.is_open = False
+    scheduler = CommandScheduler()
+    job, elapsed = run_script(scheduler, port, ['first', 'second'])
+    scheduler.stop()
+    assert job.done and port.sent == []
+
+
+def test_parse_delay_units():
+    assert parse_delay('2') == 2
+    assert parse_delay('1.5s') == 1.5
+    assert parse_delay('250ms') == 0.25
+    for text in ['-1', 'soon', '']:
+        with pytest.raises(ValueError):
+            parse_delay(text)
+
+
+def test_parse_script_steps():
+    assert parse_script(['reboot\r\n', 'delay 250ms', 'delay later', 'label end']) == [
+        ('send', 'reboot'), ('delay', 0.25), ('label', 'end')]
+
+
+def test_submit_does_not_block_and_delays_in_ms():
+    port = FakePort()
+    scheduler = CommandScheduler()
+    start = time.monotonic()
+    job = scheduler.submit(port, parse_script(['first', 'delay 200ms', 'second']), 'test')
+    assert time.monotonic() - start < 0.1
+    while not job.done and time.monotonic() - start < 5:
+        time.sleep(0.005)
+    elapsed = time.monotonic() - start
+    scheduler.stop()
+    assert port.sent == ['first', 'second']
+    assert 0.2 <= elapsed < 1
+
+
+def test_scripts_of_several_ports_run_concurrently():
+    ports = [FakePort(), FakePort()]
+    scheduler = CommandScheduler()
+    start = time.monotonic()
+    jobs = [scheduler.submit(port, parse_script(['a', 'delay 300ms', 'b'])) for port in ports]
+    while not all(job.done for job in jobs) and time.monotonic() - start < 5:
+        time.sleep(0.005)
+    scheduler.stop()
+    assert ports[0].sent == ports[1].sent == ['a', 'b']
+    assert time.monotonic() - start < 0.55
+
+
+def test_cancel_stops_a_delayed_script():
+    port = FakePort()
+    scheduler = CommandScheduler()
+    job = scheduler.submit(port, parse_script(['first', 'delay 5', 'second']))
+    time.sleep(0.1)
+    assert scheduler.jobs() == [job]
+    scheduler.cancel(job)
+    assert job.cancelled and scheduler.jobs() == []
+    time.sleep(0.05)
+    scheduler.stop()
+    assert port.sent == ['first']
@@ -0,0 +1,150 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+import pytest
+
+from etsm_scrollback import FLAG_DETECTED, LineFilter, LineStore
+
+
+def fill(store, count, flags=0):
+    for n in range(count):
+        store.append('line %d\r\n' % n, flags if n % 2 else 0, received=n + 1)
+
+
+def test_store_keeps_lines_below_limit_in_memory(tmp_path):
+    store = LineStore(LineStore.CHUNK_LINES, str(tmp_path))
+    try:
+        fill(store, 100)
+        assert len(store) == 100
+        assert store.get_history_size() == 0
+        assert store.get(0) == ('line 0', 0)
+        assert store.get(-1) == ('line 99', 0)
+    finally:
+        store.close()
+
+
+def test_store_spills_oldest_chunks_to_history(tmp_path):
+    store = LineStore(LineStore.CHUNK_LINES, str(tmp_path))
+    try:
+        fill(store, 5000, FLAG_DETECTED)
+        assert len(store) == 5000
+        assert store.get_history_size() > 0
+        assert len(store) - store.get_history_size() <= 2 * store.get_limit()
+        assert store.get(1) == ('line 1', FLAG_DETECTED)
+        assert store.get(4999) == ('line 4999', FLAG_DETECTED)
+        first = store.get_history_size()
+        assert store.get_range(first - 2, first + 2) == [
+            ('line %d' % n, FLAG_DETECTED if n % 2 else 0) for n in range(first - 2, first + 2)]
+        assert [line for line, flags in store.iter_range(step=700)] == ['line %d' % n for n in range(5000)]
+    finally:
+        store.close()
+
+
+def test_store_keeps_times_of_spilled_lines(tmp_path):
+    store = LineStore(LineStore.CHUNK_LINES, str(tmp_path))
+    try:
+        fill(store, 3000, FLAG_DETECTED)
+        assert store.get_times(0, 3) == [1, 2, 3]
+        assert store.get_times(2998, 3005) == [2999, 3000]
+        assert store.last_match_time(4) == 4
+        assert store.last_match_time(1) is None
+    finally:
+        store.close()
+
+
+def test_store_drops_spans_of_spilled_lines(tmp_path):
+    store = LineStore(LineStore.CHUNK_LINES, str(tmp_path))
+    try:
+        store.append('first', FLAG_DETECTED, [(0, 5, 1)])
+        assert store.get_spans(0, 1) == {0: [(0, 5, 1)]}
+        fill(store, 3000)
+        assert store.get_spans(0, 1) == {}
+        store.append('last', FLAG_DETECTED, [(0, 4, 2)])
+        assert store.get_spans(3001, 3002) == {3001: [(0, 4, 2)]}
+    finally:
+        store.close()
+
+
+def matching_rows(line_filter):
+    return [line_filter.get_line_index(row) for row in range(len(line_filter))]
+
+
+def test_filter_checks_new_lines_only():
+    store = LineStore()
+    for n in range(100):
+        store.append('line %d %s' % (n, 'ERR' if n % 10 == 0 else 'ok'))
+    line_filter = LineFilter(store, 'ERR')
+    assert not line_filter.update(30)
+    assert line_filter.get_progress() == 0.3
+    assert line_filter.update()
+    assert matching_rows(line_filter) == list(range(0, 100, 10))
+    store.append('late ERR')
+    assert not line_filter.is_complete()
+    line_filter.update()
+    assert matching_rows(line_filter)[-1] == 100
+    assert line_filter.get_range(len(line_filter) - 1, len(line_filter)) == [('late ERR', 0)]
+
+
+def test_refined_filter_checks_the_lines_of_its_base():
+    store = LineStore()
+    for n in range(1000):
+        store.append('ERR code=%d' % (n % 7) if n % 2 else 'ok')
+    base = LineFilter(store, 'ERR')
+    base.update()
+    refined = LineFilter(store, 'ERR code=3', base)
+    checked = []
+    get = store.get
+
+    def counting_get(index):
+        checked.append(index)
+        return get(index)
+    store.get = counting_get
+    refined.update()
+    assert len(checked) == len(base)
+    assert matching_rows(refined) == [n for n in range(1000) if n % 2 and n % 7 == 3]
+    assert not base.is_refined_by('re:ERR') and not LineFilter(store, 're:E').is_refined_by('ERR')
+
+
+def test_regex_filter_and_navigation():
+    store = LineStore()
+    for line in ['boot', 'ERR 1', 'ok', 'ERR 22', 'ok']:
+        store.append(line)
+    line_filter = LineFilter(store, r're:ERR \d+$')
+    line_filter.update()
+    assert matching_rows(line_filter) == [1, 3]
+    assert line_filter.next_match(-1) == 1
+    assert line_filter.next_match(1) == 3
+    assert line_filter.next_match(3) is None
+    assert line_filter.next_match(3, backward=True) == 1
+    assert line_filter.get_row(2) == 1
+    with pytest.raises(re.error):
+        LineFilter(store, 're:(')
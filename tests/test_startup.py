@@ -0,0 +1,87 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import etsm_stats
+from etsm_stats import StartupTimer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_startup_report_lists_new_steps_only(monkeypatch):
+    clock = iter([1.010, 1.0255, 1.5])
+    monkeypatch.setattr(etsm_stats.time, 'perf_counter', lambda: next(clock))
+    timer = StartupTimer(1.0)
+    timer.mark('ports opened')
+    timer.mark('user interface built')
+    assert timer.report().split('\n') == ['     10.0 ms     +10.0 ms  ports opened',
+                                          '     25.5 ms     +15.5 ms  user interface built']
+    timer.mark('first trace displayed')
+    assert timer.report() == '    500.0 ms    +474.5 ms  first trace displayed'
+    assert timer.report() == ''
+
+
+def test_gui_imports_only_the_needed_modules():
+    pytest.importorskip('PyQt5')
+    code = ('import sys, etsm; print(sorted(m for m in sys.modules if m.startswith("pyqtgraph") or '
+            'm == "serial.tools.list_ports"))')
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=env)
+    assert output.strip() == b'[]'
+
+
+def test_ports_are_enumerated_in_background(monkeypatch):
+    pytest.importorskip('PyQt5')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets
+    import etsm
+
+    def slow_enumeration():
+        time.sleep(1)
+        return ['/dev/ttyFAKE0']
+    monkeypatch.setattr(etsm, 'find_available_ports', slow_enumeration)
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    start = time.monotonic()
+    window = etsm.Etsm(port_name='loop://')
+    try:
+        assert time.monotonic() - start < 0.9
+        deadline = time.monotonic() + 5
+        while window.available_ports != ['/dev/ttyFAKE0'] and time.monotonic() < deadline:
+            app.processEvents()
+            time.sleep(0.01)
+        assert window.available_ports == ['/dev/ttyFAKE0']
+    finally:
+        window.shutdown()
@@ -0,0 +1,171 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import csv
+import datetime
+import json
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from etsm_stats import (LatencyHistogram, LatencyStats, MetricsServer, PortStats, export_latency, format_duration,
+                        format_interval, format_metrics, format_timestamp, wall_time)
+
+
+def test_rule_hits_count_once_per_line():
+    stats = PortStats()
+    stats.set_rules([('pattern', 'ERR'), ('condition', 1), ('condition', 'boot')])
+    stats.record_matches([(('pattern', 'ERR'), 0, 3), (('pattern', 'ERR'), 5, 8), (('condition', 'boot'), 0, 3),
+                          (('step', 1, 2), 0, 3)], 'ERR, ERR boot', 1000, 10.0)
+    rules = dict((rule['rule'], rule) for rule in stats.summary(10.5)['rules'])
+    assert rules['ERR']['hits'] == 1
+    assert rules['ERR']['last_line'] == 'ERR, ERR boot'
+    assert rules['1']['hits'] == 0
+    assert rules['1']['last_match'] is None
+    assert rules['boot']['hits'] == 1
+
+
+def test_summary_keeps_condition_ids_as_stored():
+    stats = PortStats()
+    stats.set_rules([('condition', 3), ('condition', 'boot')])
+    assert sorted((rule['rule'], rule['id']) for rule in stats.summary()['rules']) == [('3', 3), ('boot', 'boot')]
+
+
+def test_set_rules_keeps_counters_of_unchanged_rules():
+    stats = PortStats()
+    stats.set_rules([('pattern', 'ERR'), ('pattern', 'WARN')])
+    stats.record_matches([(('pattern', 'ERR'), 0, 3), (('pattern', 'WARN'), 4, 8)], 'ERR WARN', 1000, 10.0)
+    stats.set_rules([('pattern', 'ERR'), ('pattern', 'OK')])
+    rules = dict((rule['rule'], rule['hits']) for rule in stats.summary(10.5)['rules'])
+    assert rules == {'ERR': 1, 'OK': 0}
+
+
+def test_format_metrics():
+    stats = PortStats()
+    stats.set_rules([('pattern', 'say "hi"')])
+    stats.record_read(12, 2, 10.0)
+    stats.record_matches([(('pattern', 'say "hi"'), 0, 8)], 'say "hi"', 1000, 10.0)
+    text = format_metrics({'COM1': stats})
+    assert 'etsm_lines_total{port="COM1"} 2\n' in text
+    assert 'etsm_bytes_total{port="COM1"} 12\n' in text
+    assert 'etsm_rule_hits_total{port="COM1",type="pattern",rule="say \\"hi\\""} 1\n' in text
+    assert '# TYPE etsm_rule_hits_total counter\n' in text
+
+
+def test_histogram_percentiles_within_bucket_precision():
+    histogram = LatencyHistogram()
+    for value in range(1, 10001):
+        histogram.record(value)
+    assert histogram.count == 10000 and histogram.max == 10000
+    assert histogram.summary()['mean'] == 5000
+    for p in (50, 90, 99):
+        assert abs(histogram.percentile(p) - p * 100) <= p * 100 * 0.04
+    assert 9600 <= histogram.percentile(100) <= histogram.max
+
+
+def test_histogram_small_huge_and_negative_values():
+    histogram = LatencyHistogram()
+    assert histogram.summary() == {'count': 0, 'mean': 0, 'p50': 0, 'p99': 0, 'max': 0}
+    histogram.record(-5)
+    histogram.record(7)
+    assert histogram.percentile(50) == 0 and histogram.percentile(100) == 7
+    histogram.record(1 << 60)
+    assert histogram.max == 1 << 60 and histogram.percentile(100) <= 1 << 60
+    histogram.reset()
+    assert histogram.count == 0 and histogram.percentile(50) == 0
+
+
+def test_latency_stats_by_stage_and_condition():
+    latency = LatencyStats()
+    assert latency.short_summary() == ''
+    latency.record_line(0, 2000, 5000)
+    latency.record_action(1, 0, 6000, 9000)
+    latency.record_action(2, 0, 7000, 1500000)
+    summary = latency.summary()
+    assert summary['stages']['decode']['max'] == 2 and summary['stages']['detect']['max'] == 5
+    assert summary['stages']['complete']['count'] == 2
+    assert summary['conditions']['1']['complete']['max'] == 9
+    assert summary['conditions']['2']['dispatch']['max'] == 7
+    assert latency.short_summary().endswith('max 1.5ms (2)')
+
+
+def test_export_latency(tmp_path):
+    latency = LatencyStats()
+    latency.record_action(1, 0, 6000, 9000)
+    export_latency(str(tmp_path / 'latency.json'), {'COM1': latency})
+    assert json.loads((tmp_path / 'latency.json').read_text()) == {'COM1': latency.summary()}
+    export_latency(str(tmp_path / 'latency.csv'), {'COM1': latency})
+    with open(str(tmp_path / 'latency.csv'), newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0][:3] == ['port', 'condition', 'stage']
+    assert ['COM1', '1', 'complete', '1', '9', '9', '9', '9'] in rows
+
+
+def test_format_duration():
+    assert format_duration(999) == '999us'
+    assert format_duration(1500) == '1.5ms'
+    assert format_duration(2500000) == '2.50s'
+
+
+def test_receive_timestamps_convert_to_wall_clock():
+    now = time.perf_counter_ns()
+    assert abs(wall_time(now) - time.time()) < 0.5
+    assert abs(wall_time(now + 1500000) - wall_time(now) - 0.0015) < 1e-6
+    stamp = format_timestamp(now)
+    assert len(stamp) == len('12:34:56.123456')
+    assert stamp == datetime.datetime.fromtimestamp(wall_time(now)).strftime('%H:%M:%S.%f')
+
+
+def test_format_interval():
+    assert format_interval(1500) == '+0.000002'
+    assert format_interval(2500000000) == '+2.500000'
+
+
+def test_metrics_server_serves_live_counters():
+    stats = PortStats()
+    stats.set_rules([('pattern', 'ERR')])
+    server = MetricsServer(0, lambda: {'COM1': stats})
+    host, port = server.get_address()
+    url = 'http://%s:%d' % (host, port)
+    try:
+        assert host == '127.0.0.1'
+        stats.record_read(4, 1, time.monotonic())
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 'etsm_lines_total{port="COM1"} 1\n' in response.read().decode('utf-8')
+        stats.record_read(8, 2, time.monotonic())
+        with urllib.request.urlopen(url + '/metrics?x=1', timeout=5) as response:
+            assert 'etsm_lines_total{port="COM1"} 3\n' in response.read().decode('utf-8')
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other', timeout=5)
+    finally:
+        server.close()
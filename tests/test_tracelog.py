@@ -0,0 +1,91 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import gzip
+import os
+
+import pytest
+
+from etsm_tracelog import TraceLog
+
+
+def read_records(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return [line.decode('utf-8').rstrip('\n').split('\t') for line in f]
+
+
+def segments(tmp_path):
+    return sorted(str(p) for p in tmp_path.iterdir() if p.name != 'trace.log')
+
+
+def test_records_carry_flag_and_line(tmp_path):
+    path = str(tmp_path / 'trace.log')
+    log = TraceLog(path)
+    log.write('boot ok\r\n')
+    log.write('ERR timeout\n', matched=True)
+    log.write_event('reconnected')
+    log.close()
+    records = read_records(path)
+    assert [record[1:] for record in records] == [['-', 'boot ok'], ['M', 'ERR timeout'], ['#', 'reconnected']]
+    assert all(len(record[0]) == len('2026-01-01T00:00:00.000000') for record in records)
+    assert log.lines == 3
+
+
+def test_rotates_by_size_and_keeps_last_segments(tmp_path):
+    path = str(tmp_path / 'trace.log')
+    log = TraceLog(path, max_bytes=200, keep=2)
+    for n in range(100):
+        log.write('line %03d' % n)
+    log.close()
+    rotated = segments(tmp_path)
+    assert len(rotated) == 2
+    lines = [record[2] for segment in rotated for record in read_records(segment)] + [
+        record[2] for record in read_records(path)]
+    assert sorted(lines) == ['line %03d' % n for n in range(100 - len(lines), 100)]
+    assert all(os.path.getsize(segment) >= 200 for segment in rotated)
+
+
+def test_gzip_compresses_rotated_segments(tmp_path):
+    path = str(tmp_path / 'trace.log')
+    log = TraceLog(path, max_bytes=200, compress='gzip')
+    for n in range(50):
+        log.write('line %03d' % n)
+    log.close()
+    rotated = segments(tmp_path)
+    assert rotated and all(segment.endswith('.gz') for segment in rotated)
+    lines = [record[2] for segment in rotated for record in read_records(segment)] + [
+        record[2] for record in read_records(path)]
+    assert sorted(lines) == ['line %03d' % n for n in range(50)]
+
+
+def test_rejects_unknown_compression(tmp_path):
+    with pytest.raises(ValueError):
+        TraceLog(str(tmp_path / 'trace.log'), compress='lzma')
@@ -0,0 +1,149 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+
+from etsm_workers import DetectionPool
+
+LINES = ['line %d ERR' % n if n % 10 == 0 else 'line %d ok' % n for n in range(2000)]
+
+
+def make_pool(workers=1):
+    pool = DetectionPool(workers, min_batch=1)
+    pool.set_rules('port', [(('pattern', 'ERR'), 'ERR')], [])
+    return pool
+
+
+def matching(found):
+    return [n for n, line_found in enumerate(found) if line_found]
+
+
+def test_search_finds_the_rules():
+    pool = make_pool()
+    try:
+        assert matching(pool.search('port', LINES)) == list(range(0, 2000, 10))
+    finally:
+        pool.close()
+
+
+def test_submit_does_not_wait_and_keeps_batches_apart():
+    pool = make_pool(2)
+    pool.set_rules('other', [(('pattern', 'ok'), 'ok')], [])
+    done = []
+    pool.sig_done.connect(lambda: done.append(True))
+    try:
+        first = pool.submit('port', LINES)
+        second = pool.submit('other', LINES[:100])
+        assert first.wait(5) and second.wait(5)
+        assert matching(first.get_results()) == list(range(0, 2000, 10))
+        assert matching(second.get_results()) == [n for n in range(100) if n % 10]
+        assert len(done) == 2
+        # Both workers searched the chunks of the first batch.
+        assert all(worker['chunks'] for worker in pool.stats())
+    finally:
+        pool.close()
+
+
+def test_unknown_rule_set_is_not_submitted():
+    pool = make_pool()
+    try:
+        assert pool.submit('closed', LINES) is None
+    finally:
+        pool.close()
+
+
+def test_discard_rules_reaches_the_workers():
+    pool = make_pool(2)
+    try:
+        pool.search('port', LINES)
+        pool.discard_rules('port')
+        assert pool.submit('port', LINES) is None
+        deadline = time.monotonic() + 5
+        while any('port' in loaded for loaded in pool._loaded) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not any('port' in loaded for loaded in pool._loaded)
+    finally:
+        pool.close()
+
+
+def test_close_completes_every_batch():
+    pool = make_pool()
+    batches = [pool.submit('port', LINES) for _ in range(20)]
+    pool.close()
+    assert all(batch.is_done() for batch in batches)
+    results = [batch.get_results() for batch in batches]
+    # The queued batches are failed, to be searched by the reader threads.
+    assert results[-1] is None
+    assert all(found is None or matching(found) == list(range(0, 2000, 10)) for found in results)
+    assert pool.submit('port', LINES) is None
+    assert pool.get_error() is None
+
+
+def test_close_while_searching_from_another_thread():
+    pool = make_pool()
+    results = []
+    errors = []
+
+    def search():
+        try:
+            while True:
+                found = pool.search('port', LINES)
+                results.append(found)
+                if found is None:
+                    return
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=search)
+    thread.start()
+    time.sleep(0.5)
+    pool.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert errors == []
+    assert results[-1] is None
+
+
+def test_failed_worker_stops_the_pool():
+    pool = make_pool()
+    stopped = []
+    pool.sig_stopped.connect(stopped.append)
+    try:
+        pool._processes[0].terminate()
+        pool._processes[0].join()
+        batch = pool.submit('port', LINES)
+        assert batch.wait(5)
+        assert batch.get_results() is None
+        assert len(stopped) == 1
+        assert pool.short_summary().startswith("Workers stopped: ")
+        assert pool.submit('port', LINES) is None
+    finally:
+        pool.close()
@@ -0,0 +1,201 @@
+# Copyright 2022 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# Neither the name of the NXP Semiconductors nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+
+from etsm_port import Port, WriteQueue
+from etsm_stats import LatencyStats, PortStats
+
+WRITE_TIME = 0.05
+
+
+class SlowSerial(object):
+    """
+    Serial port taking WRITE_TIME to write each command.
+    """
+
+    def __init__(self):
+        self.written = []
+        self.out_waiting = 0
+
+    def write(self, data):
+        time.sleep(WRITE_TIME)
+        self.written.append(data)
+
+
+def wait_written(serial_port, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(serial_port.written) < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_direct_write_records_completion_after_write():
+    serial_port = SlowSerial()
+    latency = LatencyStats()
+    queue = WriteQueue(lambda: serial_port, PortStats(), 'test')
+    t_read = time.perf_counter_ns()
+    queue.put(b'cmd\r', (latency, 1, t_read, t_read))
+    assert serial_port.written == [b'cmd\r']
+    assert latency.stages['complete'].count == 1
+    assert latency.stages['complete'].max >= WRITE_TIME * 1e6
+    queue.close()
+
+
+def test_queued_write_records_completion_after_write():
+    serial_port = SlowSerial()
+    latency = LatencyStats()
+    queue = WriteQueue(lambda: serial_port, PortStats(), 'test')
+    queue.set_pacing(line_delay=0.01)
+    t_read = time.perf_counter_ns()
+    queue.put(b'first\r', (latency, 1, t_read, t_read))
+    queue.put(b'second\r', (latency, 2, t_read, t_read))
+    # Both commands are only queued.
+    assert latency.stages['complete'].count == 0
+    wait_written(serial_port, 2)
+    deadline = time.monotonic() + 5
+    while latency.stages['complete'].count < 2 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert serial_port.written == [b'first\r', b'second\r']
+    assert latency.conditions[1]['complete'].max >= WRITE_TIME * 1e6
+    assert latency.conditions[2]['complete'].max >= 2 * WRITE_TIME * 1e6
+    queue.close()
+
+
+def test_coalesced_writes_record_every_condition():
+    serial_port = SlowSerial()
+    latency = LatencyStats()
+    queue = WriteQueue(lambda: serial_port, PortStats(), 'test')
+    t_read = time.perf_counter_ns()
+    blocker = threading.Thread(target=queue.put, args=(b'busy\r',))
+    blocker.start()
+    time.sleep(WRITE_TIME / 5)
+    for cond_id in range(3):
+        queue.put(b'cmd\r', (latency, cond_id, t_read, t_read))
+    blocker.join()
+    wait_written(serial_port, 2)
+    deadline = time.monotonic() + 5
+    while latency.stages['complete'].count < 3 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert serial_port.written == [b'busy\r', b'cmd\rcmd\rcmd\r']
+    assert sorted(latency.conditions) == [0, 1, 2]
+    queue.close()
+
+
+class TimedSerial(object):
+    """
+    Serial port recording the time of each write, with an output buffer emptied by drain_later().
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.out_waiting = 0
+
+    def write(self, data):
+        self.writes.append((time.monotonic(), data))
+
+    def drain_later(self, delay):
+        self.out_waiting = 10
+        threading.Timer(delay, setattr, (self, 'out_waiting', 0)).start()
+
+
+def wait_idle(queue, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not queue.is_idle() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return queue.is_idle()
+
+
+def test_char_delay_writes_bytes_one_by_one():
+    serial_port = TimedSerial()
+    queue = WriteQueue(lambda: serial_port, PortStats(), 'test')
+    queue.set_pacing(char_delay=0.01)
+    start = time.monotonic()
+    queue.put(b'abcd\r')
+    # A paced command is written by the queue thread.
+    assert time.monotonic() - start < 0.01
+    assert wait_idle(queue)
+    assert [data for t, data in serial_port.writes] == [b'a', b'b', b'c', b'd', b'\r']
+    assert serial_port.writes[-1][0] - serial_port.writes[0][0] >= 0.04
+    queue.close()
+
+
+def test_line_delay_spaces_the_commands():
+    serial_port = TimedSerial()
+    queue = WriteQueue(lambda: serial_port, PortStats(), 'test')
+    queue.set_pacing(line_delay=0.05)
+    for command in (b'one\r', b'two\r', b'three\r'):
+        queue.put(command)
+    assert wait_idle(queue)
+    assert [data for t, data in serial_port.writes] == [b'one\r', b'two\r', b'three\r']
+    times = [t for t, data in serial_port.writes]
+    assert all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:]))
+    queue.close()
+
+
+def test_drain_waits_for_the_output_buffer():
+    serial_port = TimedSerial()
+    queue = WriteQueue(lambda: serial_port, PortStats(), 'test')
+    queue.set_pacing(drain=True)
+    serial_port.drain_later(0.1)
+    start = time.monotonic()
+    queue.put(b'cmd\r')
+    time.sleep(0.02)
+    assert not queue.is_idle()
+    assert wait_idle(queue)
+    assert time.monotonic() - start >= 0.1
+    queue.close()
+
+
+def test_clear_drops_the_queued_commands():
+    serial_port = SlowSerial()
+    stats = PortStats()
+    queue = WriteQueue(lambda: serial_port, stats, 'test')
+    queue.set_pacing(line_delay=0.01)
+    for n in range(5):
+        queue.put(b'cmd%d\r' % n)
+    time.sleep(WRITE_TIME / 2)
+    assert queue.pending() == 4 * 5
+    assert queue.clear() == 4 * 5
+    assert stats.dropped_bytes == 4 * 5
+    assert wait_idle(queue)
+    assert serial_port.written == [b'cmd0\r']
+    queue.close()
+
+
+def test_flow_controlled_port_does_not_write_from_the_caller():
+    port = Port('loop://', 115200, [], [], flow_control='rtscts')
+    try:
+        assert not port.get_write_queue().direct
+        assert port.send_command('reboot')
+        assert wait_idle(port.get_write_queue())
+        assert port.get_port().read(7) == b'reboot\r'
+    finally:
+        port.close_port()